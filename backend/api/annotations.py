@@ -9,6 +9,10 @@ T_CAPITAL_ID_INT = int
 T_CAPITAL_FIELD_NAME = str
 # Тип - ISO code валюты (RUB, USD, EUR)
 T_CURRENCY_ISO_CODE = str
+# Тип - id доли в операции
+T_SHARE_ID = str
+# Тип - id операции
+T_OPERATION_ID_INT = int
 
 
 # Тип - описание строения ValidatedData
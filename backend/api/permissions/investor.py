@@ -45,7 +45,7 @@ class RequestUserPermissions:
         message = 'Вы не являетесь совладельцем этого ИС'
 
         def has_object_permission(self, request, view, obj: 'InvestmentAccount'):
-            return request.user in obj.investors or request.user == obj.creator
+            return request.user == obj.creator or obj.investors.filter(pk=request.user.pk).exists()
 
     class CanRetrieveCoOwner(IsAuthenticated):
         """ Может ли пользователь получить информацию о совладельце/совладельцах """
@@ -66,7 +66,7 @@ class RequestUserPermissions:
         message = 'Вы не можете получить информацию об этом'
 
         def has_object_permission(self, request, view, obj: 'Capital'):
-            return request.user in obj.co_owner.investment_account.investors
+            return obj.co_owner.investment_account.investors.filter(pk=request.user.pk).exists()
 
     class CanEditCapital(IsAuthenticated):
         """ Может ли пользователь редактировать информацию о капитале """
@@ -88,3 +88,17 @@ class RequestUserPermissions:
 
         def has_object_permission(self, request, view, obj):
             return request.user == obj.operation.investment_account.creator
+
+    class CanRetrieveShareSchedule(IsAuthenticated):
+        """ Может ли пользователь получить информацию о расписании доли """
+        message = 'Вы не можете получить информацию об этом'
+
+        def has_object_permission(self, request, view, obj: 'ShareSchedule'):
+            return obj.co_owner.investment_account.investors.filter(pk=request.user.pk).exists()
+
+    class CanEditShareSchedule(IsAuthenticated):
+        """ Может ли пользователь редактировать расписание доли """
+        message = 'Вы не можете изменять это расписание доли'
+
+        def has_object_permission(self, request, view, obj: 'ShareSchedule'):
+            return request.user == obj.co_owner.investment_account.creator
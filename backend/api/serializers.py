@@ -1,17 +1,17 @@
 import logging
 import os
 
-from django.db.models import Sum
+from django.db.models import Q
+from django.utils import timezone
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
-from rest_framework.serializers import raise_errors_on_nested_writes
-from rest_framework.utils import model_meta
 
-from core.utils import ExcludeFieldsMixin
+from core.utils import ExcludeFieldsMixin, BulkUpdateSerializerMixin
+from market.services.shares import get_effective_total_shares, ShareScheduleIndex
 from operations.models import Share
 from tinkoff_api import TinkoffProfile
 from tinkoff_api.exceptions import InvalidTokenError
-from users.models import InvestmentAccount, Investor, CoOwner, Capital
+from users.models import InvestmentAccount, Investor, CoOwner, Capital, ShareSchedule, BalanceEntry
 
 logger = logging.getLogger(__name__)
 
@@ -53,7 +53,11 @@ class InvestmentAccountSerializer(serializers.ModelSerializer):
     """ Сериализатор для ИС """
     class Meta:
         model = InvestmentAccount
-        fields = ['id', 'name', 'creator', 'token', 'broker_account_id']
+        fields = [
+            'id', 'name', 'creator', 'token', 'broker_account_id',
+            'import_status', 'import_stage', 'import_progress', 'import_error'
+        ]
+        read_only_fields = ('import_status', 'import_stage', 'import_progress', 'import_error')
 
     creator = serializers.PrimaryKeyRelatedField(read_only=True)
     broker_account_id = serializers.ReadOnlyField()
@@ -84,41 +88,21 @@ class InvestmentAccountSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class CapitalSerializer(ExcludeFieldsMixin, serializers.ModelSerializer):
+class CapitalSerializer(ExcludeFieldsMixin, BulkUpdateSerializerMixin, serializers.ModelSerializer):
     """ Сериализатор капитала совладельца """
     class Meta:
         model = Capital
-        fields = ('id', 'co_owner', 'currency', 'value', 'default_share')
+        fields = ('id', 'co_owner', 'currency', 'value', 'default_share', 'balance')
+        read_only_fields = ('balance', )
 
     default_share = serializers.DecimalField(max_digits=7, decimal_places=6, min_value=0, max_value=1)
 
-    def __init__(self, *args, **kwargs):
-        self.is_bulk_update = kwargs.pop('bulk_update', False)
-        super().__init__(*args, **kwargs)
 
-    def validate(self, attrs):
-        if self.is_bulk_update:
-            info = model_meta.get_field_info(self.instance)
-            for attr, _ in attrs.items():
-                if attr in info.relations and info.relations[attr].to_many:
-                    raise ValidationError({attr: 'Нельзя изменять поля m2m через bulk_update'})
-        return super().validate(attrs)
-
-    def update(self, instance, validated_data):
-        """ Добавляет возможность одновременного обновления нескольких записей,
-            если нет полей m2m
-        """
-        if self.is_bulk_update:
-            raise_errors_on_nested_writes('update', self, validated_data)
-            info = model_meta.get_field_info(instance)
-            for attr, value in validated_data.items():
-                if attr in info.relations and info.relations[attr].to_many:
-                    raise ValidationError('Нельзя изменять поля m2m через bulk_update')
-                else:
-                    setattr(instance, attr, value)
-            return instance
-        else:
-            return super().update(instance, validated_data)
+class BalanceEntrySerializer(serializers.ModelSerializer):
+    """ Сериализатор записи журнала движения денег совладельца """
+    class Meta:
+        model = BalanceEntry
+        fields = ('id', 'kind', 'amount', 'balance', 'deal', 'date')
 
 
 class CoOwnerSerializer(serializers.ModelSerializer):
@@ -152,16 +136,120 @@ class CoOwnerSerializer(serializers.ModelSerializer):
             raise ValidationError('Вы не можете добавить совладельца к ИС, владельцем которого не являетесь')
 
 
-class ShareSerializer(serializers.ModelSerializer):
+class ShareSerializer(BulkUpdateSerializerMixin, serializers.ModelSerializer):
     """ Сериализатор для долей в операции """
     class Meta:
         model = Share
         fields = '__all__'
 
     def validate_value(self, value):
-        """ Сумма всех долей операции должна быть не больше 1 """
-        if self.instance is not None:
-            total_share = self.instance.operation.shares.aggregate(s=Sum('value'))['s']
+        """ Сумма всех долей операции должна быть не больше 1.
+            При bulk_update суммы проверяются сразу для всех операций одним запросом,
+            при создании - в validate, когда известны операция и совладелец
+        """
+        if self.instance is not None and not self.is_bulk_update:
+            total_share = get_effective_total_shares((self.instance.operation_id, ))[self.instance.operation_id]
             if total_share - self.instance.value + value > 1:
                 raise ValidationError('Доля не может быть такой большой')
         return value
+
+    def validate(self, attrs):
+        """ Новая доля задается только владельцем ИС, для совладельца того же ИС и заменяет
+            долю совладельца из расписания или долю по умолчанию (в разреженном режиме)
+        """
+        attrs = super().validate(attrs)
+        if self.instance is not None:
+            return attrs
+        operation, co_owner = attrs['operation'], attrs['co_owner']
+        if self.context['request'].user != operation.investment_account.creator:
+            raise ValidationError('Вы не можете изменять доли в операциях ИС, владельцем которого не являетесь')
+        if co_owner.investment_account_id != operation.investment_account_id:
+            raise ValidationError({'co_owner': 'Совладелец должен относиться к ИС операции'})
+        if Share.objects.filter(operation=operation, co_owner=co_owner).exists():
+            raise ValidationError('Доля совладельца в операции уже задана, ее можно изменить')
+        remaining_share = get_effective_total_shares((operation.pk, ), exclude_co_owner_id=co_owner.pk)
+        if remaining_share.get(operation.pk, 0) + attrs['value'] > 1:
+            raise ValidationError({'value': 'Доля не может быть такой большой'})
+        return attrs
+
+
+class ShareScheduleSerializer(serializers.ModelSerializer):
+    """ Сериализатор для расписания долей совладельца """
+    class Meta:
+        model = ShareSchedule
+        fields = ('id', 'co_owner', 'currency', 'value', 'effective_from', 'effective_to')
+
+    value = serializers.DecimalField(max_digits=9, decimal_places=8, min_value=0, max_value=1)
+
+    def validate_co_owner(self, co_owner):
+        """ Расписание долей может задавать только владелец ИС """
+        if self.context['request'].user == co_owner.investment_account.creator:
+            return co_owner
+        raise ValidationError('Вы не можете изменять доли совладельцев ИС, владельцем которого не являетесь')
+
+    def validate(self, attrs):
+        """ Периоды одного совладельца в одной валюте не должны пересекаться """
+        attrs = super().validate(attrs)
+        # При частичном обновлении недостающие значения берутся из instance
+        data = {
+            field: attrs.get(field, getattr(self.instance, field, None))
+            for field in ('co_owner', 'currency', 'effective_from', 'effective_to')
+        }
+        effective_from, effective_to = data['effective_from'], data['effective_to']
+        if effective_to is not None and effective_to <= effective_from:
+            raise ValidationError('Дата окончания периода должна быть больше даты начала')
+        overlapped = (
+            ShareSchedule.objects
+            .filter(co_owner=data['co_owner'], currency=data['currency'])
+            .filter(Q(effective_to__isnull=True) | Q(effective_to__gt=effective_from))
+        )
+        if effective_to is not None:
+            overlapped = overlapped.filter(effective_from__lt=effective_to)
+        if self.instance is not None:
+            overlapped = overlapped.exclude(pk=self.instance.pk)
+        if overlapped.exists():
+            raise ValidationError('Период пересекается с другим периодом этого совладельца')
+        value = attrs.get('value', getattr(self.instance, 'value', None))
+        self.validate_total_share(data['co_owner'], data['currency'], value, effective_from, effective_to)
+        return attrs
+
+    @staticmethod
+    def validate_total_share(co_owner: CoOwner, currency, value, effective_from, effective_to) -> None:
+        """ Сумма долей всех совладельцев в любой момент периода должна быть не больше 1.
+            У остальных совладельцев берется доля из их расписания или доля по умолчанию
+        """
+        investment_account_id = co_owner.investment_account_id
+        other_schedules = (
+            ShareSchedule.objects
+            .filter(co_owner__investment_account_id=investment_account_id, currency=currency)
+            .exclude(co_owner=co_owner)
+            .filter(Q(effective_to__isnull=True) | Q(effective_to__gt=effective_from))
+        )
+        if effective_to is not None:
+            other_schedules = other_schedules.filter(effective_from__lt=effective_to)
+        other_schedules = list(other_schedules)
+        schedule_index = ShareScheduleIndex(other_schedules)
+        default_shares = (
+            Capital.objects
+            .filter(co_owner__investment_account_id=investment_account_id, currency=currency)
+            .exclude(co_owner=co_owner)
+            .values_list('co_owner_id', 'default_share')
+        )
+        # Доли остальных совладельцев меняются только на границах их периодов
+        moments = {effective_from}
+        for schedule in other_schedules:
+            moments |= {
+                moment for moment in (schedule.effective_from, schedule.effective_to)
+                if moment is not None and moment > effective_from and (effective_to is None or moment < effective_to)
+            }
+        for moment in sorted(moments):
+            total_share = value
+            for co_owner_id, default_share in default_shares:
+                scheduled_share = schedule_index.get(co_owner_id, currency.pk, moment)
+                total_share += default_share if scheduled_share is None else scheduled_share
+            if total_share > 1:
+                moment = timezone.localtime(moment)
+                raise ValidationError(
+                    f'Сумма долей всех совладельцев на {moment:%d.%m.%Y %H:%M} будет {total_share:.4f}, '
+                    f'а должна быть не больше 1'
+                )
@@ -1,6 +1,6 @@
 from rest_framework.routers import DefaultRouter
 
-from api.views import InvestmentAccountView, InvestorView, ShareView, CoOwnerView, CapitalView
+from api.views import InvestmentAccountView, InvestorView, ShareView, CoOwnerView, CapitalView, ShareScheduleView
 
 router = DefaultRouter()
 router.register('investors', InvestorView, basename='investors')
@@ -8,5 +8,6 @@ router.register('investment-accounts', InvestmentAccountView, basename='investme
 router.register('co-owners', CoOwnerView, basename='co_owners')
 router.register('capital', CapitalView, basename='capital')
 router.register('shares', ShareView, basename='shares')
+router.register('share-schedules', ShareScheduleView, basename='share_schedules')
 
 urlpatterns = router.urls
@@ -1,10 +1,13 @@
 import collections
+import copy
 import decimal
 import logging
 import os
 from typing import List, Dict, Any, Set, Optional
 
+from django.db import transaction
 from django.db.models import F, Sum
+from django.utils.dateparse import parse_datetime
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
@@ -13,13 +16,20 @@ from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
 from core.utils import PermissionsByActionMixin, CheckObjectPermissionMixin
+from market.models import Deal
+from market.services.recalculation_queue import mark_deal_dirty, mark_deals_dirty
+from market.services.shares import get_effective_total_shares, is_sparse_storage
 from operations.models import Share
-from users.models import InvestmentAccount, Investor, Capital, CoOwner
+from users.models import InvestmentAccount, Investor, Capital, CoOwner, ShareSchedule, BalanceEntry
+from users.services.account_deletion import mark_deleted
+from users.services.account_import import enqueue_import, is_stale
+from users.services.portfolio import get_portfolio
 from .annotations import T_CAPITAL_ID, T_CAPITAL_FIELD_NAME, T_CAPITAL_ID_INT, T_CURRENCY_ISO_CODE, \
-    TValidatedDataByCurrency
+    TValidatedDataByCurrency, T_SHARE_ID, T_OPERATION_ID_INT
 from .permissions import RequestUserPermissions
 from .serializers import InvestmentAccountSerializer, CoOwnerSerializer, \
-    ShareSerializer, SimplifiedInvestorSerializer, ExtendedInvestorSerializer, CapitalSerializer
+    ShareSerializer, SimplifiedInvestorSerializer, ExtendedInvestorSerializer, CapitalSerializer, \
+    ShareScheduleSerializer, BalanceEntrySerializer
 
 logger = logging.getLogger(__name__)
 
@@ -73,7 +83,9 @@ class InvestmentAccountView(PermissionsByActionMixin, ModelViewSet):
         'update': RequestUserPermissions.CanEditInvestmentAccount,
         'partial_update': RequestUserPermissions.CanEditInvestmentAccount,
         'destroy': RequestUserPermissions.CanEditInvestmentAccount,
-        'update_shares_by_default_share': RequestUserPermissions.CanEditDefaultInvestmentAccount
+        'update_shares_by_default_share': RequestUserPermissions.CanEditDefaultInvestmentAccount,
+        'portfolio': RequestUserPermissions.CanRetrieveInvestmentAccount,
+        'retry_import': RequestUserPermissions.CanEditInvestmentAccount
     }
     queryset = InvestmentAccount.objects.all()
 
@@ -82,6 +94,10 @@ class InvestmentAccountView(PermissionsByActionMixin, ModelViewSet):
         queryset = super().filter_queryset(queryset)
         return queryset.filter(creator=self.request.user)
 
+    def perform_destroy(self, instance):
+        """ ИС только помечается на удаление, данные удаляются в фоне """
+        mark_deleted(instance)
+
     @action(detail=False, methods=['post'])
     def update_shares_by_default_share(self, request):
         """ Обновление долей в операциях ИС установленного по умолчанию
@@ -90,6 +106,26 @@ class InvestmentAccountView(PermissionsByActionMixin, ModelViewSet):
         request.user.default_investment_account.update_shares_by_default_share()
         return Response(status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=['post'])
+    def retry_import(self, request, pk=None):
+        """ Повторный импорт ИС, импорт которого завершился ошибкой или был прерван """
+        investment_account = self.get_object()
+        is_failed = investment_account.import_status == InvestmentAccount.ImportStatuses.FAILED
+        if not is_failed and not is_stale(investment_account):
+            raise ValidationError('Повторить можно только импорт, завершившийся ошибкой или прерванный')
+        enqueue_import(investment_account)
+        return Response(status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'])
+    def portfolio(self, request, pk=None):
+        """ Портфель ИС на момент последней синхронизации """
+        portfolio = get_portfolio(self.get_object())
+        return Response({
+            'fetched_at': portfolio.fetched_at,
+            'sync_version': portfolio.sync_version,
+            'positions': list(portfolio)
+        })
+
 
 class CoOwnerView(PermissionsByActionMixin, ModelViewSet):
     """ Совладелец """
@@ -118,10 +154,39 @@ class CapitalView(PermissionsByActionMixin, CheckObjectPermissionMixin, ModelVie
         'list': RequestUserPermissions.HasDefaultInvestmentAccount,
         'update': RequestUserPermissions.CanEditCapital,
         'partial_update': RequestUserPermissions.CanEditCapital,
-        'destroy': RequestUserPermissions.CanEditCapital
+        'destroy': RequestUserPermissions.CanEditCapital,
+        'history': RequestUserPermissions.CanRetrieveCapital
     }
     queryset = Capital.objects.all()
 
+    def perform_update(self, serializer):
+        previous_value = serializer.instance.value
+        previous_default_share = serializer.instance.default_share
+        with transaction.atomic():
+            capital = serializer.save()
+            BalanceEntry.objects.append_allocations(((capital, previous_value), ))
+        capital.refresh_from_db(fields=('balance', ))
+        if is_sparse_storage() and capital.default_share != previous_default_share:
+            # Доли по умолчанию используются при расчете дохода всех сделок ИС
+            deals = Deal.objects.filter(investment_account_id=capital.co_owner.investment_account_id)
+            deals.reset_income_state()
+            mark_deals_dirty(deals.values_list('pk', flat=True))
+
+    @action(detail=True, methods=['get'])
+    def history(self, request, pk=None):
+        """ Движения денег совладельца в валюте капитала.
+            Период можно ограничить параметрами date_from и date_to (ISO 8601)
+        """
+        capital = self.get_object()
+        period = {}
+        for param in ('date_from', 'date_to'):
+            if param in request.query_params:
+                period[param] = parse_datetime(request.query_params[param])
+                if period[param] is None:
+                    raise ValidationError({param: 'Неверный формат даты'})
+        entries = capital.balance_history(**period)
+        return Response(BalanceEntrySerializer(entries, many=True).data)
+
     @action(detail=False, methods=['patch'])
     def multiple_updates(self, request):
         """ Обновление сразу нескольких capital одного ИС с помощью bulk_update.
@@ -156,6 +221,8 @@ class CapitalView(PermissionsByActionMixin, CheckObjectPermissionMixin, ModelVie
         # id ИС, капиталы которого будут обновляться, ИС каждого капитала будет сравниваться с этим
         # значением, если id ИС капитала отличается, будет возбужден ValidationError
         investment_account_id: Optional[T_CAPITAL_ID_INT] = None
+        # Значения капиталов до обновления, для журнала движения денег совладельцев
+        previous_values: Dict[T_CAPITAL_ID_INT, decimal.Decimal] = {}
         # Словарь, содержащий в себе информацию о сумме всех прошедших валидацию default_share и value,
         # сгруппированных по currency
         # Нужен чтобы проверить не превышает ли
@@ -173,6 +240,7 @@ class CapitalView(PermissionsByActionMixin, CheckObjectPermissionMixin, ModelVie
             instance_data = request.data[str(instance.pk)]
             # Добавляем в множество полей для bulk_update все изменяемые поля текущего instance
             update_fields |= set(instance_data.keys())
+            previous_values[instance.pk] = instance.value
             # Аргумент bulk_update позволит после вызова метода .save()
             # не вызывать .save() у instance сериализатора, а только изменить поля и вернуть instance
             # !нельзя изменять m2m поля
@@ -189,6 +257,9 @@ class CapitalView(PermissionsByActionMixin, CheckObjectPermissionMixin, ModelVie
                     serializer.validated_data.get('value', instance.value)
             else:
                 errors[instance.pk] = serializer.errors
+        # Капиталы, которых нет или которые недоступны пользователю, не пропускаются молча
+        for instance_id in set(instances_ids) - {str(instance.pk) for instance in instances}:
+            errors[instance_id] = {'non_field_errors': ['Капитал не найден']}
         if errors:
             return Response(errors, status=status.HTTP_400_BAD_REQUEST)
         else:
@@ -244,7 +315,12 @@ class CapitalView(PermissionsByActionMixin, CheckObjectPermissionMixin, ModelVie
                     raise ValidationError(f'Сумма всех капиталов валюты {currency} > {info_total_capital}')
 
             bulk_update_objs = [serializer.save() for serializer in save_serializers]
-            Capital.objects.bulk_update(bulk_update_objs, fields=update_fields)
+            with transaction.atomic():
+                Capital.objects.bulk_update(bulk_update_objs, fields=update_fields)
+                if 'value' in update_fields:
+                    BalanceEntry.objects.append_allocations(
+                        (capital, previous_values[capital.pk]) for capital in bulk_update_objs
+                    )
             logger.info(update_default_share)
             for key, value in update_default_share.items():
                 (
@@ -252,14 +328,20 @@ class CapitalView(PermissionsByActionMixin, CheckObjectPermissionMixin, ModelVie
                     .filter(co_owner__investment_account_id=investment_account_id, currency_id=key)
                     .update(default_share=F('default_share')*value)
                 )
+            if is_sparse_storage() and 'default_share' in update_fields:
+                # Доли по умолчанию используются при расчете дохода всех сделок ИС
+                deals = Deal.objects.filter(investment_account_id=investment_account_id)
+                deals.reset_income_state()
+                mark_deals_dirty(deals.values_list('pk', flat=True))
             return Response({'ids': instances_ids}, status=200)
 
 
-class ShareView(PermissionsByActionMixin, ModelViewSet):
+class ShareView(PermissionsByActionMixin, CheckObjectPermissionMixin, ModelViewSet):
     """ Доли в операциях """
     permissions_by_action = {
         'retrieve': RequestUserPermissions.CanRetrieveShare,
         'list': RequestUserPermissions.HasDefaultInvestmentAccount,
+        'create': RequestUserPermissions.CanEditShare,
         'update': RequestUserPermissions.CanEditShare,
         'partial_update': RequestUserPermissions.CanEditShare,
         'destroy': RequestUserPermissions.CanEditShare
@@ -267,7 +349,127 @@ class ShareView(PermissionsByActionMixin, ModelViewSet):
     serializer_class = ShareSerializer
     queryset = Share.objects.all()
 
+    @action(detail=False, methods=['patch'])
+    def multiple_updates(self, request):
+        """ Обновление сразу нескольких долей (в том числе разных операций) с помощью bulk_update.
+            Данные приходят в формате:
+            {
+                '1': {'value': 0.5},
+                '2': {'value': 0.25}
+            }
+            где ключ - id доли, значение - изменяемые поля (можно изменять только value).
+            Доход каждой затронутой сделки пересчитывается один раз
+        """
+        logger.info('Share множественное обновление')
+        instances_ids: List[T_SHARE_ID] = list(request.data.keys())
+        instances = (
+            self.get_queryset()
+            .filter(pk__in=instances_ids)
+            .select_related('operation__investment_account__creator')
+        )
+        errors: Dict[T_SHARE_ID, Dict[str, Any]] = {}
+        save_serializers: List['serializers.ModelSerializer'] = []
+        # Сумма новых долей для каждой операции
+        validated_total_share: collections.defaultdict[T_OPERATION_ID_INT, decimal.Decimal] = \
+            collections.defaultdict(decimal.Decimal)
+        for instance in instances:
+            self.check_object_permission(request, instance, RequestUserPermissions.CanEditShare)
+            instance_data = request.data[str(instance.pk)]
+            if set(instance_data.keys()) - {'value'}:
+                errors[instance.pk] = {'non_field_errors': ['Можно изменять только value']}
+                continue
+            serializer = self.get_serializer(instance=instance, data=instance_data, bulk_update=True, partial=True)
+            if serializer.is_valid():
+                save_serializers.append(serializer)
+                validated_total_share[instance.operation_id] += \
+                    serializer.validated_data.get('value', instance.value)
+            else:
+                errors[instance.pk] = serializer.errors
+        # Доли, которых нет или которые относятся к чужому ИС, не пропускаются молча
+        for instance_id in set(instances_ids) - {str(instance.pk) for instance in instances}:
+            errors[instance_id] = {'non_field_errors': ['Доля не найдена']}
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        # Суммы всех долей операций (с учетом долей по умолчанию), одним запросом для всех операций
+        effective_total_share = get_effective_total_shares(validated_total_share.keys())
+        # Текущие значения изменяемых долей
+        current_total_share: collections.defaultdict[T_OPERATION_ID_INT, decimal.Decimal] = \
+            collections.defaultdict(decimal.Decimal)
+        for serializer in save_serializers:
+            current_total_share[serializer.instance.operation_id] += serializer.instance.value
+        for operation_id, total_share in validated_total_share.items():
+            remaining_total_share = effective_total_share[operation_id] - current_total_share[operation_id]
+            if total_share + remaining_total_share > 1:
+                raise ValidationError(f'Сумма долей операции {operation_id} не может быть больше 1')
+
+        bulk_update_objs = [serializer.save() for serializer in save_serializers]
+        Share.objects.bulk_update(bulk_update_objs, fields=('value', ))
+        # bulk_update не вызывает post_save, поэтому состояние дохода сбрасывается явно
+        deal_ids = {share.operation.deal_id for share in bulk_update_objs}
+        Deal.objects.filter(pk__in=deal_ids).reset_income_state()
+        mark_deals_dirty(deal_ids)
+        return Response({'ids': instances_ids}, status=200)
+
+    def perform_create(self, serializer):
+        """ Создание доли - единственный способ задать долю, отличную от доли по умолчанию,
+            в разреженном режиме, где доли по умолчанию не сохраняются
+        """
+        operation = serializer.validated_data['operation']
+        self.check_object_permission(self.request, Share(operation=operation), RequestUserPermissions.CanEditShare)
+        instance = serializer.save()
+        mark_deal_dirty(instance.operation.deal_id)
+
     def perform_update(self, serializer):
-        """ После изменения доли в операции, перерасчитывается доход от сделки """
+        """ После изменения доли в операции, сделка помечается для перерасчета дохода,
+            перерасчет выполняется один раз для сделки в конце запроса или фоновым обработчиком
+        """
         instance = serializer.save()
-        instance.operation.deal.recalculation_income()
+        mark_deal_dirty(instance.operation.deal_id)
+
+
+class ShareScheduleView(PermissionsByActionMixin, ModelViewSet):
+    """ Расписание долей совладельцев """
+    permissions_by_action = {
+        'retrieve': RequestUserPermissions.CanRetrieveShareSchedule,
+        'list': RequestUserPermissions.HasDefaultInvestmentAccount,
+        'create': RequestUserPermissions.HasDefaultInvestmentAccount,
+        'update': RequestUserPermissions.CanEditShareSchedule,
+        'partial_update': RequestUserPermissions.CanEditShareSchedule,
+        'destroy': RequestUserPermissions.CanEditShareSchedule
+    }
+    serializer_class = ShareScheduleSerializer
+    queryset = ShareSchedule.objects.all()
+
+    def filter_queryset(self, queryset):
+        """ Расписания долей только того ИС, который установлен по умолчанию """
+        queryset = super().filter_queryset(queryset)
+        return queryset.filter(co_owner__investment_account=self.request.user.default_investment_account)
+
+    @staticmethod
+    def apply_schedules(*schedules: ShareSchedule):
+        """ При разреженном хранении долей расписание влияет на доход всех сделок ИС,
+            иначе доли совладельца переписываются в операциях за периоды расписаний
+            (до и после изменения), доход затронутых сделок пересчитывается
+        """
+        investment_account = schedules[0].co_owner.investment_account
+        if is_sparse_storage():
+            deals = Deal.objects.filter(investment_account=investment_account)
+            deals.reset_income_state()
+            mark_deals_dirty(deals.values_list('pk', flat=True))
+            return
+        for schedule in schedules:
+            investment_account.update_shares_by_schedule(
+                schedule.co_owner_id, schedule.currency_id, schedule.effective_from, schedule.effective_to
+            )
+
+    def perform_create(self, serializer):
+        self.apply_schedules(serializer.save())
+
+    def perform_update(self, serializer):
+        previous = copy.copy(serializer.instance)
+        self.apply_schedules(previous, serializer.save())
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        self.apply_schedules(instance)
@@ -1,57 +1,162 @@
-from typing import Dict
+import functools
+from typing import Dict, Tuple
 
 from django.db import models
 from django.db.models import Q
+from django.db.models.signals import class_prepared
+from django.dispatch import receiver
+from rest_framework.exceptions import ValidationError
+from rest_framework.serializers import raise_errors_on_nested_writes
+from rest_framework.utils import model_meta
 
 
 class ProxyConstraintsError(Exception):
     pass
 
 
+class ProxyTypes:
+    """ Типы, которые может иметь экземпляр прокси-модели.
+        Вычисляются один раз при создании класса модели (register_proxy_model)
+    """
+    def __init__(self, possible_types, type_codes: Dict[str, int], is_abstract: bool):
+        """
+        :param possible_types: типы из proxy_constraints, первый - тип по умолчанию при создании
+        :param type_codes: код (номер бита) каждого типа базовой модели
+        :param is_abstract: можно ли сохранять экземпляры модели
+        """
+        self.possible_types = tuple(str(possible_type) for possible_type in possible_types)
+        self.types = frozenset(self.possible_types)
+        self.mask = 0
+        for possible_type in self.possible_types:
+            self.mask |= 1 << type_codes[possible_type]
+        self.is_abstract = is_abstract
+
+
+# Ключ - прокси-модель, значение - ее типы
+_proxy_types: Dict[type, ProxyTypes] = {}
+# Ключ - базовая (не прокси) модель, значение - словарь, где ключ - тип, значение - его код
+_type_codes: Dict[type, Dict[str, int]] = {}
+
+
+def _get_proxy_constraints(proxy_model):
+    if not hasattr(proxy_model, 'proxy_constraints'):
+        raise ProxyConstraintsError(f'В модели {proxy_model} не определен proxy_constraints')
+    if not hasattr(proxy_model.proxy_constraints, proxy_model.__name__):
+        raise ProxyConstraintsError(f'В proxy_constraints модели {proxy_model} не определен класс {proxy_model}')
+    proxy_constraints = getattr(proxy_model.proxy_constraints, proxy_model.__name__)
+    possible_types = getattr(proxy_constraints, 'possible_types')
+    if possible_types is None:
+        raise ProxyConstraintsError(
+            f'В proxy_constraints модели {proxy_model} не определен {proxy_model}.possible_types'
+        )
+    elif not isinstance(possible_types, (list, tuple)):
+        raise ProxyConstraintsError(
+            f'В proxy_constraints модели {proxy_model}, '
+            f'{proxy_model}.possible_types должен быть типа list/tuple'
+        )
+    return proxy_constraints
+
+
+def get_type_codes(model) -> Dict[str, int]:
+    """ Коды типов базовой модели - номера в possible_types базовой модели """
+    concrete_model = model._meta.concrete_model
+    try:
+        return _type_codes[concrete_model]
+    except KeyError:
+        possible_types = _get_proxy_constraints(concrete_model).possible_types
+        _type_codes[concrete_model] = {str(possible_type): code for code, possible_type in enumerate(possible_types)}
+        return _type_codes[concrete_model]
+
+
+def get_proxy_types(proxy_model) -> ProxyTypes:
+    """ Типы прокси-модели из реестра, если модели там нет - вычисляет и добавляет """
+    try:
+        return _proxy_types[proxy_model]
+    except KeyError:
+        pass
+    proxy_constraints = _get_proxy_constraints(proxy_model)
+    type_codes = get_type_codes(proxy_model)
+    unknown_types = set(map(str, proxy_constraints.possible_types)) - set(type_codes)
+    if unknown_types:
+        raise ProxyConstraintsError(
+            f'Типы {unknown_types} модели {proxy_model} не определены в базовой модели '
+            f'{proxy_model._meta.concrete_model}'
+        )
+    _proxy_types[proxy_model] = ProxyTypes(
+        proxy_constraints.possible_types, type_codes, getattr(proxy_constraints, 'is_abstract', False)
+    )
+    return _proxy_types[proxy_model]
+
+
+@receiver(class_prepared)
+def register_proxy_model(sender, **kwargs):
+    """ Вычисляет типы модели с proxy_constraints при создании ее класса,
+        ошибки в proxy_constraints появятся при использовании модели
+    """
+    if hasattr(sender, 'proxy_constraints'):
+        try:
+            get_proxy_types(sender)
+        except ProxyConstraintsError:
+            pass
+
+
+@functools.lru_cache(maxsize=None)
+def get_types_by_proxy_models(proxy_models: Tuple[type, ...]) -> Tuple[str, ...]:
+    """ Объединение типов нескольких прокси-моделей одной базовой модели, по порядку кодов """
+    if len({proxy_model._meta.concrete_model for proxy_model in proxy_models}) > 1:
+        raise ProxyConstraintsError(f'У моделей {proxy_models} разные базовые модели')
+    mask = 0
+    for proxy_model in proxy_models:
+        mask |= get_proxy_types(proxy_model).mask
+    return tuple(
+        possible_type for possible_type, code in get_type_codes(proxy_models[0]).items() if mask & (1 << code)
+    )
+
+
 def _get_is_abstract_by_proxy_model(proxy_model, raise_exception=False):
     try:
-        is_abstract = getattr(proxy_model.proxy_constraints, proxy_model.__name__).is_abstract
-        if is_abstract and raise_exception:
-            raise ValueError('Класс является абстрактным, его экземпляр нельзя сохранить')
-        return is_abstract
-    except AttributeError:
+        is_abstract = get_proxy_types(proxy_model).is_abstract
+    except ProxyConstraintsError:
         return False
+    if is_abstract and raise_exception:
+        raise ValueError('Класс является абстрактным, его экземпляр нельзя сохранить')
+    return is_abstract
 
 
 def _get_possible_types_by_proxy_model(proxy_model):
-    if hasattr(proxy_model, 'proxy_constraints'):
-        if hasattr(proxy_model.proxy_constraints, proxy_model.__name__):
-            possible_types = getattr(getattr(proxy_model.proxy_constraints, proxy_model.__name__), 'possible_types')
-            if possible_types is None:
-                raise ProxyConstraintsError(
-                    f'В proxy_constraints модели {proxy_model} не определен {proxy_model}.possible_types'
-                )
-            elif isinstance(possible_types, (list, tuple)):
-                return possible_types
-            else:
-                raise ProxyConstraintsError(
-                    f'В proxy_constraints модели {proxy_model}, '
-                    f'{proxy_model}.possible_types должен быть типа list/tuple'
-                )
-        else:
-            raise ProxyConstraintsError(f'В proxy_constraints модели {proxy_model} не определен класс {proxy_model}')
-    else:
-        raise ProxyConstraintsError(f'В модели {proxy_model} не определен proxy_constraints')
+    return get_proxy_types(proxy_model).possible_types
 
 
 def is_proxy_instance(_model, proxy_instances):
     if isinstance(proxy_instances, (tuple, list)):
         for proxy_instance in proxy_instances:
-            if _model.type in _get_possible_types_by_proxy_model(proxy_instance):
+            if _model.type in get_proxy_types(proxy_instance).types:
                 return proxy_instance
         return False
-    return _model.type in _get_possible_types_by_proxy_model(proxy_instances)
+    return _model.type in get_proxy_types(proxy_instances).types
+
+
+@functools.lru_cache(maxsize=None)
+def compile_proxy_lookup(lookup: str, proxy_models: Tuple[type, ...]) -> Tuple[str, Tuple[str, ...]]:
+    """ Условие на тип вместо proxy_instance_of, например
+        ('deal__operations__proxy_instance_of', (SaleOperation, )) -> ('deal__operations__type__in', ('Sell', ))
+    """
+    return lookup.replace('proxy_instance_of', 'type__in'), get_types_by_proxy_models(proxy_models)
+
+
+def is_proxy_lookup(lookup: str) -> bool:
+    return (
+        lookup == 'proxy_instance_of' or
+        lookup.endswith('__proxy_instance_of') and lookup.count('proxy_instance_of') == 1
+    )
 
 
 class ProxyInheritanceQuerySet(models.QuerySet):
     def _filter_or_exclude(self, negate, *args, **kwargs):
-        args = args + (ProxyQ(**kwargs), )
-        kwargs = {}
+        # ProxyQ нужен только для proxy_instance_of, остальные условия передаются как есть
+        if any(map(is_proxy_lookup, kwargs)):
+            args = args + (ProxyQ(**kwargs), )
+            kwargs = {}
         return super()._filter_or_exclude(negate, *args, **kwargs)
 
 
@@ -60,7 +165,12 @@ class ProxyInheritanceManager(models.Manager):
         всех моделей в одной базовой модели
     """
     def get_queryset(self):
-        return ProxyInheritanceQuerySet(self.model, using=self._db).filter(ProxyQ(proxy_instance_of=self.model))
+        queryset = ProxyInheritanceQuerySet(self.model, using=self._db)
+        proxy_types = get_proxy_types(self.model)
+        # У базовой модели все типы, условие на тип выполняется для любой записи
+        if len(proxy_types.types) == len(get_type_codes(self.model)):
+            return queryset
+        return queryset.filter(type__in=proxy_types.possible_types)
 
     def bulk_create(self, objs, *args, **kwargs):
         _get_is_abstract_by_proxy_model(self.model, raise_exception=True)
@@ -83,21 +193,15 @@ class ProxyInheritanceManager(models.Manager):
 
 class ProxyQ(Q):
     def __init__(self, *args, _connector=None, _negated=False, **kwargs):
-        for kwarg in kwargs.copy():
-            is_proxy_kwarg = (
-                kwarg == 'proxy_instance_of' or
-                kwarg.endswith('__proxy_instance_of') and kwarg.count('proxy_instance_of') == 1
-            )
-            if is_proxy_kwarg:
+        for kwarg in tuple(kwargs):
+            if is_proxy_lookup(kwarg):
                 proxy_instance_of = kwargs.pop(kwarg)
                 if isinstance(proxy_instance_of, (list, tuple)):
                     proxy_instance_of = tuple(proxy_instance_of)
                 else:
                     proxy_instance_of = (proxy_instance_of, )
-                types = set()
-                for proxy_instance in proxy_instance_of:
-                    types |= set(_get_possible_types_by_proxy_model(proxy_instance))
-                kwargs[kwarg.replace('proxy_instance_of', 'type__in')] = types
+                lookup, types = compile_proxy_lookup(kwarg, proxy_instance_of)
+                kwargs[lookup] = types
         super().__init__(*args, _connector=_connector, _negated=_negated, **kwargs)
 
 
@@ -132,6 +236,40 @@ class ExcludeFieldsMixin:
         return fields
 
 
+class BulkUpdateSerializerMixin:
+    """ Добавляет в сериализатор аргумент bulk_update.
+        Если он передан, то .save() не сохраняет instance, а только изменяет его поля,
+        чтобы потом сохранить сразу несколько записей через bulk_update
+    """
+    def __init__(self, *args, **kwargs):
+        self.is_bulk_update = kwargs.pop('bulk_update', False)
+        super().__init__(*args, **kwargs)
+
+    def validate(self, attrs):
+        if self.is_bulk_update:
+            info = model_meta.get_field_info(self.instance)
+            for attr, _ in attrs.items():
+                if attr in info.relations and info.relations[attr].to_many:
+                    raise ValidationError({attr: 'Нельзя изменять поля m2m через bulk_update'})
+        return super().validate(attrs)
+
+    def update(self, instance, validated_data):
+        """ Добавляет возможность одновременного обновления нескольких записей,
+            если нет полей m2m
+        """
+        if self.is_bulk_update:
+            raise_errors_on_nested_writes('update', self, validated_data)
+            info = model_meta.get_field_info(instance)
+            for attr, value in validated_data.items():
+                if attr in info.relations and info.relations[attr].to_many:
+                    raise ValidationError('Нельзя изменять поля m2m через bulk_update')
+                else:
+                    setattr(instance, attr, value)
+            return instance
+        else:
+            return super().update(instance, validated_data)
+
+
 class PermissionsByActionMixin:
     """ Получение permissions в зависимости от action """
     permissions_by_action: Dict[str, 'BasePermission'] = {}
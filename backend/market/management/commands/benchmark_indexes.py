@@ -0,0 +1,228 @@
+import datetime
+import json
+import logging
+import statistics
+import uuid
+from typing import Callable, Dict, List, Tuple
+
+import pytz
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+
+from core.utils import get_types_by_proxy_models
+from market.models import Deal, StockInstrument
+from operations.models import Operation, Share, PurchaseOperation, SaleOperation, DividendOperation
+from users.models import Investor, InvestmentAccount, CoOwner
+
+logger = logging.getLogger(__name__)
+
+# Индексы, которые проверяются: до - без них, после - с ними
+BENCHMARK_INDEXES = ('operation_without_deal', 'dividend_without_tax')
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-a', '--accounts',
+            type=int,
+            default=20,
+            help='Количество синтетических ИС'
+        )
+        parser.add_argument(
+            '-o', '--operations',
+            type=int,
+            default=20000,
+            help='Количество операций в каждом ИС'
+        )
+        parser.add_argument(
+            '-i', '--instruments',
+            type=int,
+            default=50,
+            help='Количество ценных бумаг'
+        )
+        parser.add_argument(
+            '-r', '--repeat',
+            type=int,
+            default=5,
+            help='Сколько раз выполнять каждый запрос'
+        )
+
+    def handle(self, *args, **options):
+        """ Замер частых запросов через EXPLAIN ANALYZE на синтетических данных,
+            с индексами из BENCHMARK_INDEXES и без них.
+            Все выполняется в одной транзакции, которая откатывается в конце,
+            но на время замера таблица операций блокируется, поэтому не запускайте на рабочей базе
+        """
+        with transaction.atomic():
+            context = self.create_dataset(options['accounts'], options['operations'], options['instruments'])
+            queries = self.get_queries(context)
+            after = self.run_queries(queries, options['repeat'])
+            with connection.cursor() as cursor:
+                for index in BENCHMARK_INDEXES:
+                    cursor.execute(f'DROP INDEX IF EXISTS {connection.ops.quote_name(index)}')
+                cursor.execute(f'ANALYZE {Operation._meta.db_table}')
+            before = self.run_queries(queries, options['repeat'])
+            transaction.set_rollback(True)
+
+        self.stdout.write(f'{"Запрос":<28} {"До, мс":>10} {"После, мс":>10}  План до -> план после')
+        for name in queries:
+            self.stdout.write(
+                f'{name:<28} {before[name][0]:>10.3f} {after[name][0]:>10.3f}  {before[name][1]} -> {after[name][1]}'
+            )
+
+    def create_dataset(self, accounts: int, operations: int, instruments: int) -> Dict[str, int]:
+        """ Синтетические ИС, операции, сделки и доли.
+            Модели создаются через bulk_create, чтобы не срабатывали сигналы (синхронизация с Tinkoff API),
+            операции и доли - одним INSERT ... SELECT
+        """
+        logger.info(f'Создание данных: {accounts} ИС по {operations} операций')
+        prefix = uuid.uuid4().hex[:8]
+        investors = Investor.objects.bulk_create([
+            Investor(username=f'benchmark_{prefix}_{i}', password='!') for i in range(accounts * 2)
+        ])
+        investment_accounts = InvestmentAccount.objects.bulk_create([
+            InvestmentAccount(name=f'benchmark_{prefix}', creator=investors[i * 2], token='-', broker_account_id='-')
+            for i in range(accounts)
+        ])
+        co_owners = CoOwner.objects.bulk_create([
+            CoOwner(investor=investors[i * 2 + j], investment_account=investment_account)
+            for i, investment_account in enumerate(investment_accounts) for j in range(2)
+        ])
+        stock_instruments = StockInstrument.objects.bulk_create([
+            StockInstrument(
+                figi=f'BENCH{prefix}{i}', name=f'Benchmark {i}', ticker=f'B{prefix}{i}', isin=f'B{prefix}{i}',
+                lot=1, currency_id='USD'
+            )
+            for i in range(instruments)
+        ])
+        Deal.objects.bulk_create([
+            Deal(investment_account=investment_account, instrument=instrument, currency_id='USD')
+            for investment_account in investment_accounts for instrument in stock_instruments
+        ])
+        account_ids = [investment_account.pk for investment_account in investment_accounts]
+        figis = [instrument.figi for instrument in stock_instruments]
+        deal_types = get_types_by_proxy_models((PurchaseOperation, SaleOperation, DividendOperation))
+        # Тип операции зависит от номера: 0-3 покупки, 4-6 продажи, 7 дивиденды, 8 пополнения, 9 комиссии.
+        # Почти все операции покупки/продажи/дивидендов уже в сделках, в update_deals попадают только последние 5%.
+        # Сделка указывается сразу при вставке, а не отдельным UPDATE, чтобы в индексах не было мертвых строк.
+        # Операции разных ИС вставляются вперемешку по дате, как при обычной синхронизации
+        sql = f"""
+            INSERT INTO {Operation._meta.db_table} (
+                investment_account_id, type, date, is_margin_call, payment, currency_id, instrument_id,
+                quantity, commission, _id, deal_id, dividend_tax, dividend_tax_date
+            )
+            SELECT operation.account_id, operation.type, operation.date, false, operation.payment, 'USD',
+                operation.instrument_id, operation.quantity, operation.commission, operation._id,
+                CASE WHEN operation.type IN %(deal_types)s AND operation.n < %(operations)s * 0.95 THEN deal.id END,
+                CASE WHEN operation.type = 'Dividend' AND operation.n %% 20 = 7 THEN -1 ELSE 0 END,
+                CASE WHEN operation.type = 'Dividend' AND operation.n %% 20 = 7 THEN operation.date END
+            FROM (
+                SELECT account_id, n, kind.type, kind.payment, kind.quantity, kind.commission,
+                    %(start)s + n * interval '1 minute' AS date,
+                    %(prefix)s || '-' || account_id || '-' || n AS _id,
+                    CASE WHEN kind.has_instrument THEN (%(figis)s::varchar[])[1 + n %% %(instruments)s] END
+                        AS instrument_id
+                FROM unnest(%(account_ids)s::integer[]) AS account_id
+                CROSS JOIN generate_series(1, %(operations)s) AS n
+                JOIN (VALUES
+                    (0, 'Buy', -10, true, 1, -1), (1, 'Buy', -10, true, 1, -1), (2, 'Buy', -10, true, 1, -1),
+                    (3, 'BuyCard', -10, true, 1, -1), (4, 'Sell', 11, true, 1, -1), (5, 'Sell', 11, true, 1, -1),
+                    (6, 'Sell', 11, true, 1, -1), (7, 'Dividend', 1, true, 0, 0), (8, 'PayIn', 100, false, 0, 0),
+                    (9, 'ServiceCommission', -1, false, 0, 0)
+                ) AS kind (number, type, payment, has_instrument, quantity, commission) ON kind.number = n %% 10
+            ) AS operation
+            LEFT JOIN {Deal._meta.db_table} AS deal
+                ON deal.investment_account_id = operation.account_id AND deal.instrument_id = operation.instrument_id
+            ORDER BY operation.date, operation.account_id
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {
+                'start': datetime.datetime(2015, 1, 1, tzinfo=pytz.UTC), 'figis': figis, 'instruments': instruments,
+                'prefix': prefix, 'account_ids': account_ids, 'operations': operations, 'deal_types': deal_types
+            })
+            cursor.execute(f"""
+                INSERT INTO {Share._meta.db_table} (operation_id, co_owner_id, value)
+                SELECT operation.id, co_owner.id, 0.5
+                FROM {Operation._meta.db_table} AS operation
+                JOIN {CoOwner._meta.db_table} AS co_owner
+                    ON co_owner.investment_account_id = operation.investment_account_id
+                WHERE operation.investment_account_id = ANY(%s) AND operation.type IN %s
+            """, [account_ids, deal_types])
+            for model in (Operation, Share, Deal):
+                cursor.execute(f'ANALYZE {model._meta.db_table}')
+        logger.info('Данные созданы')
+
+        investment_account_id = account_ids[len(account_ids) // 2]
+        dividend = (
+            DividendOperation.objects
+            .filter(investment_account_id=investment_account_id, dividend_tax_date__isnull=True)
+            .order_by('-date')
+            .values('instrument_id', 'date')
+            .first()
+        )
+        return {
+            'investment_account_id': investment_account_id,
+            'deal_id': Deal.objects.filter(investment_account_id=investment_account_id).values_list('pk', flat=True)[0],
+            'co_owner_id': co_owners[len(co_owners) // 2].pk,
+            'dividend_figi': dividend['instrument_id'],
+            'dividend_date': dividend['date']
+        }
+
+    @staticmethod
+    def get_queries(context: Dict[str, int]) -> Dict[str, Callable]:
+        """ Частые запросы в том виде, в котором их строит код проекта """
+        investment_account_id = context['investment_account_id']
+        return {
+            'update_deals': lambda: (
+                Operation.objects
+                .filter(proxy_instance_of=(PurchaseOperation, SaleOperation, DividendOperation),
+                        deal__isnull=True, investment_account_id=investment_account_id)
+                .order_by('date')
+            ),
+            'recalculation_income': lambda: (
+                Operation.objects
+                .filter(deal_id=context['deal_id'],
+                        proxy_instance_of=(PurchaseOperation, SaleOperation, DividendOperation))
+                .order_by('date', 'pk')
+            ),
+            'shares_by_operation': lambda: Share.objects.filter(
+                operation__in=Operation.objects.filter(deal_id=context['deal_id']).values('pk')
+            ),
+            'shares_by_co_owner': lambda: Share.objects.filter(co_owner_id=context['co_owner_id']),
+            'dividend_without_tax': lambda: (
+                DividendOperation.objects
+                .filter(investment_account_id=investment_account_id, instrument__figi=context['dividend_figi'],
+                        date__lte=context['dividend_date'], dividend_tax_date__isnull=True)
+                .order_by('-date')[:1]
+            )
+        }
+
+    @staticmethod
+    def run_queries(queries: Dict[str, Callable], repeat: int) -> Dict[str, Tuple[float, str]]:
+        """ Медиана времени выполнения каждого запроса и его план (узлы и индексы) """
+        result = {}
+        with connection.cursor() as cursor:
+            for name, get_queryset in queries.items():
+                sql, params = get_queryset().query.sql_with_params()
+                timings = []
+                plan = None
+                for _ in range(max(repeat, 1)):
+                    cursor.execute(f'EXPLAIN (ANALYZE, FORMAT JSON) {sql}', params)
+                    explain = cursor.fetchone()[0]
+                    if isinstance(explain, str):
+                        explain = json.loads(explain)
+                    timings.append(explain[0]['Execution Time'])
+                    plan = explain[0]['Plan']
+                result[name] = (statistics.median(timings), ', '.join(Command._describe_plan(plan)))
+        return result
+
+    @staticmethod
+    def _describe_plan(plan: dict) -> List[str]:
+        """ Узлы плана, которые читают таблицы или индексы """
+        nodes = []
+        if 'Relation Name' in plan or 'Index Name' in plan:
+            index = f'({plan["Index Name"]})' if 'Index Name' in plan else ''
+            nodes.append(f'{plan["Node Type"]}{index}')
+        for subplan in plan.get('Plans', ()):
+            nodes.extend(Command._describe_plan(subplan))
+        return nodes
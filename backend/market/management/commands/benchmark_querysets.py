@@ -0,0 +1,69 @@
+import statistics
+import time
+from typing import Callable, Dict
+
+from django.core.management import BaseCommand
+
+from core.utils import compile_proxy_lookup, get_types_by_proxy_models
+from market.models import Deal, StockInstrument, InstrumentType
+from operations.models import Operation, PurchaseOperation, SaleOperation, DividendOperation
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--number',
+            type=int,
+            default=2000,
+            help='Сколько раз строить каждый queryset'
+        )
+
+    def handle(self, *args, **options):
+        """ Замер стоимости построения querysets моделей с наследованием через прокси-модели
+            и компиляции их в SQL. Запросы в базу не выполняются.
+            "Без кеша" - построение с очисткой кеша условий proxy_instance_of перед каждым вызовом
+        """
+        number = max(options['number'], 1)
+        self.stdout.write(f'{"Queryset":<28} {"Построение, мкс":>16} {"Без кеша, мкс":>14} {"SQL, мкс":>10}')
+        for name, get_queryset in self.get_querysets().items():
+            build = self.measure(get_queryset, number)
+            build_without_cache = self.measure(lambda: self.clear_cache() or get_queryset(), number)
+            compile_sql = self.measure(lambda: get_queryset().query.sql_with_params(), number)
+            self.stdout.write(f'{name:<28} {build:>16.2f} {build_without_cache:>14.2f} {compile_sql:>10.2f}')
+        self.clear_cache()
+
+    @staticmethod
+    def get_querysets() -> Dict[str, Callable]:
+        """ Querysets в том виде, в котором их строит код проекта """
+        deal_operations = (PurchaseOperation, SaleOperation, DividendOperation)
+        return {
+            'operations': lambda: Operation.objects.filter(investment_account_id=1),
+            'sale_operations': lambda: SaleOperation.objects.filter(investment_account_id=1),
+            'operations_without_deal': lambda: (
+                Operation.objects
+                .filter(proxy_instance_of=deal_operations, deal__isnull=True, investment_account_id=1)
+                .order_by('date')
+            ),
+            'deal_operations': lambda: (
+                Operation.objects.filter(deal_id=1, proxy_instance_of=deal_operations).order_by('date', 'pk')
+            ),
+            'deals_with_statistics': lambda: Deal.objects.filter(investment_account_id=1).with_statistics(),
+            'instruments': lambda: InstrumentType.objects.filter(figi='BBG000B9XRY4'),
+            'stock_instruments': lambda: StockInstrument.objects.filter(figi='BBG000B9XRY4')
+        }
+
+    @staticmethod
+    def clear_cache() -> None:
+        compile_proxy_lookup.cache_clear()
+        get_types_by_proxy_models.cache_clear()
+
+    @staticmethod
+    def measure(function: Callable, number: int) -> float:
+        """ Медиана времени одного вызова в микросекундах по 5 замерам """
+        timings = []
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            timings.append((time.perf_counter() - start) / number * 10 ** 6)
+        return statistics.median(timings)
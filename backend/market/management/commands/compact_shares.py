@@ -0,0 +1,30 @@
+import logging
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from market.services.shares import is_sparse_storage
+from operations.models import Share, Operation
+from users.models import Capital
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        """ Удаляет доли, которые совпадают с долей по умолчанию.
+            Используется при переходе на разреженное хранение долей
+        """
+        if not is_sparse_storage():
+            raise CommandError('Включите разреженное хранение долей: PROJECT_SPARSE_SHARES=1')
+        sql = f"""
+            DELETE FROM {Share._meta.db_table} AS share
+            USING {Operation._meta.db_table} AS operation, {Capital._meta.db_table} AS capital
+            WHERE share.operation_id = operation.id
+                AND capital.co_owner_id = share.co_owner_id
+                AND capital.currency_id = operation.currency_id
+                AND share.value = capital.default_share
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            logger.info(f'Удалено долей, совпадающих с долей по умолчанию: {cursor.rowcount}')
@@ -69,8 +69,13 @@ class Command(BaseCommand):
         with TinkoffProfile(token) as tp:
             stocks = tp.market_stocks()
             currencies_instrument = tp.market_currencies()
+        currency_iso_codes = set(Currency.objects.values_list('iso_code', flat=True))
         for instrument in currencies_instrument['payload']['instruments']:
             logger.info(f'Валюта: {instrument}')
+            base_currency_id = CurrencyInstrument.get_base_currency_iso_code(instrument['ticker'])
+            if base_currency_id not in currency_iso_codes:
+                logger.warning(f'Неизвестная базовая валюта у {instrument["ticker"]}')
+                base_currency_id = None
             CurrencyInstrument.objects.update_or_create(
                 figi=instrument['figi'],
                 defaults={
@@ -78,6 +83,7 @@ class Command(BaseCommand):
                     'min_price_increment': instrument['minPriceIncrement'],
                     'lot': instrument['lot'],
                     'currency_id': instrument['currency'],
+                    'base_currency_id': base_currency_id,
                     'name': instrument['name'],
                 }
             )
@@ -0,0 +1,31 @@
+import logging
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from operations.models import Operation
+from operations.services.partitioning import partition_operations
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p', '--partitions',
+            type=int,
+            default=8,
+            help='Количество секций'
+        )
+
+    def handle(self, *args, **options):
+        """ Переводит таблицу операций уже развернутой БД на секционирование по хешу ИС
+            (новая БД секционируется миграцией, если задан PROJECT_OPERATION_PARTITIONS),
+            подробнее в operations.services.partitioning
+        """
+        if connection.vendor != 'postgresql':
+            raise CommandError('Секционирование поддерживается только для PostgreSQL')
+        try:
+            partition_operations(connection, Operation._meta.db_table, options['partitions'])
+        except ValueError as e:
+            raise CommandError(str(e))
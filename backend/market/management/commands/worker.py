@@ -0,0 +1,51 @@
+import logging
+import time
+
+from django.core.management import BaseCommand
+
+from market.services import recalculation_queue
+from users.services import account_import, account_deletion
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help='Обработать очереди один раз и завершиться'
+        )
+        parser.add_argument(
+            '-i', '--interval',
+            type=float,
+            default=5,
+            help='Пауза между проверками очередей в секундах'
+        )
+
+    def handle(self, *args, **options):
+        """ Фоновый обработчик отложенных задач """
+        logger.info('Фоновый обработчик запущен')
+        while True:
+            try:
+                processed = recalculation_queue.process_queue()
+                if processed:
+                    logger.info(f'Пересчитано сделок: {processed}')
+            except Exception:
+                logger.exception('Ошибка при перерасчете сделок')
+            try:
+                imported = account_import.process_queue()
+                if imported:
+                    logger.info(f'Импортировано ИС: {imported}')
+            except Exception:
+                logger.exception('Ошибка при импорте ИС')
+            try:
+                deleted = account_deletion.process_queue()
+                if deleted:
+                    logger.info(f'Удалено ИС: {deleted}')
+            except Exception:
+                logger.exception('Ошибка при удалении ИС')
+            if options['once']:
+                break
+            time.sleep(options['interval'])
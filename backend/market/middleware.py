@@ -0,0 +1,19 @@
+from market.services.recalculation_queue import deferred_recalculation, enqueue_dirty_deals
+
+
+class DeferredRecalculationMiddleware:
+    """ Перерасчет дохода сделок, измененных за время запроса, выполняется один раз для каждой сделки
+        после обработки запроса view, но до возврата ответа - время ответа зависит от размера сделок.
+        При PROJECT_DEFERRED_RECALCULATION_MODE=worker сделки только ставятся в очередь фоновому обработчику.
+        Если запрос завершился ошибкой, сделки тоже только ставятся в очередь
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with deferred_recalculation():
+            response = self.get_response(request)
+            # Исключение view Django превращает в ответ 500, изменения запроса могли откатиться
+            if response.status_code >= 500:
+                enqueue_dirty_deals()
+            return response
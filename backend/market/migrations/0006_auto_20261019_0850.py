@@ -0,0 +1,35 @@
+# Generated by Django 3.0.8 on 2026-10-19 05:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0003_operation_co_owners'),
+        ('market', '0005_dealincome_currency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deal',
+            name='is_income_state_actual',
+            field=models.BooleanField(default=False, verbose_name='Состояние дохода актуально'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='last_processed_operation',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='operations.Operation', verbose_name='Последняя учтенная операция'),
+        ),
+        migrations.AddField(
+            model_name='dealincome',
+            name='last_dividend_share',
+            field=models.DecimalField(decimal_places=18, default=0, max_digits=20, verbose_name='Доля с последних дивидендов'),
+        ),
+        migrations.AddField(
+            model_name='dealincome',
+            name='stock_quantity',
+            field=models.DecimalField(decimal_places=12, default=0, max_digits=30, verbose_name='Количество ценных бумаг'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.0.8 on 2026-10-19 05:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0006_auto_20261019_0850'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deal',
+            name='is_recalculation_required',
+            field=models.BooleanField(default=False, verbose_name='Требуется перерасчет'),
+        ),
+        migrations.AddIndex(
+            model_name='deal',
+            index=models.Index(condition=models.Q(is_recalculation_required=True), fields=['id'], name='deal_recalculation_queue'),
+        ),
+    ]
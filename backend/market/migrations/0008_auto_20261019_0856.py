@@ -0,0 +1,37 @@
+# Generated by Django 3.0.8 on 2026-10-19 05:56
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_auto_20261019_0854'),
+        ('market', '0007_auto_20261019_0851'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DealLots',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(choices=[('FIFO', 'FIFO'), ('Average', 'По средней цене')], max_length=16, verbose_name='Метод учета')),
+                ('realized_income', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Реализованный доход')),
+                ('open_quantity', models.DecimalField(decimal_places=12, default=0, max_digits=30, verbose_name='Количество в открытых лотах')),
+                ('cost_basis', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Стоимость открытых лотов')),
+                ('open_lots', django.contrib.postgres.fields.jsonb.JSONField(default=list, verbose_name='Открытые лоты')),
+                ('co_owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deal_lots', to='users.CoOwner', verbose_name='Совладелец')),
+                ('deal', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lots', to='market.Deal', verbose_name='Сделка')),
+            ],
+            options={
+                'verbose_name': 'Лоты сделки',
+                'verbose_name_plural': 'Лоты сделок',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='deallots',
+            constraint=models.UniqueConstraint(fields=('deal', 'co_owner', 'method'), name='unique_deal_lots'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.0.8 on 2026-10-19 05:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0003_operation_co_owners'),
+        ('users', '0004_auto_20261019_0854'),
+        ('market', '0008_auto_20261019_0856'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DealIncomeSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(verbose_name='Дата операции')),
+                ('stock_quantity', models.DecimalField(decimal_places=12, default=0, max_digits=30, verbose_name='Количество ценных бумаг')),
+                ('capital', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Доход')),
+                ('last_dividend_share', models.DecimalField(decimal_places=18, default=0, max_digits=20, verbose_name='Доля с последних дивидендов')),
+                ('co_owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users.CoOwner', verbose_name='Совладелец')),
+                ('deal', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='income_snapshots', to='market.Deal', verbose_name='Сделка')),
+                ('operation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='operations.Operation', verbose_name='Операция')),
+            ],
+            options={
+                'verbose_name': 'Контрольная точка дохода за сделку',
+                'verbose_name_plural': 'Контрольные точки дохода за сделки',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='dealincomesnapshot',
+            index=models.Index(fields=['deal', 'date', 'operation'], name='deal_income_snapshot_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='dealincomesnapshot',
+            constraint=models.UniqueConstraint(fields=('deal', 'operation', 'co_owner'), name='unique_deal_income_snapshot'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Заполнение состояния существующих сделок по их операциям
+FILL_DEAL_STATE_SQL = """
+    UPDATE market_deal AS deal
+    SET bought_quantity = state.bought_quantity, sold_quantity = state.sold_quantity,
+        is_closed = state.bought_quantity = state.sold_quantity AND state.bought_quantity > 0,
+        opened_at = state.opened_at,
+        closed_at = CASE
+            WHEN state.bought_quantity = state.sold_quantity AND state.bought_quantity > 0 THEN state.last_trade_at
+        END,
+        currency_id = state.currency_id
+    FROM (
+        SELECT operation.deal_id,
+            COALESCE(SUM(operation.quantity) FILTER (WHERE operation.type IN ('Buy', 'BuyCard')), 0)
+                AS bought_quantity,
+            COALESCE(SUM(operation.quantity) FILTER (WHERE operation.type = 'Sell'), 0) AS sold_quantity,
+            MIN(operation.date) AS opened_at,
+            MAX(operation.date) FILTER (WHERE operation.type IN ('Buy', 'BuyCard', 'Sell')) AS last_trade_at,
+            MIN(operation.currency_id) AS currency_id
+        FROM operations_operation AS operation
+        WHERE operation.deal_id IS NOT NULL
+        GROUP BY operation.deal_id
+    ) AS state
+    WHERE deal.id = state.deal_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0003_operation_co_owners'),
+        ('market', '0009_auto_20261019_0858'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deal',
+            name='bought_quantity',
+            field=models.BigIntegerField(default=0, verbose_name='Куплено'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='closed_at',
+            field=models.DateTimeField(null=True, verbose_name='Дата закрытия'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='currency',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='operations.Currency', verbose_name='Валюта'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='is_closed',
+            field=models.BooleanField(default=False, verbose_name='Закрыта'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='opened_at',
+            field=models.DateTimeField(null=True, verbose_name='Дата открытия'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='sold_quantity',
+            field=models.BigIntegerField(default=0, verbose_name='Продано'),
+        ),
+        migrations.AddIndex(
+            model_name='deal',
+            index=models.Index(condition=models.Q(is_closed=False), fields=['investment_account', 'instrument'], name='deal_opened'),
+        ),
+        migrations.RunSQL(FILL_DEAL_STATE_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0010_auto_20261019_0901'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deal',
+            name='closed_deal_income',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Доход закрытой сделки'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='commission',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Комиссии'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='dividend_income',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Дивиденды'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='opened_deal_income',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Реализованный доход открытой сделки'),
+        ),
+    ]
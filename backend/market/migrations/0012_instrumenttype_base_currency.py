@@ -0,0 +1,30 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Базовая валюта существующих валютных пар - первые три буквы тикера (USD000UTSTOM, EUR_RUB__TOM, GBPRUB_TOM)
+FILL_BASE_CURRENCY_SQL = """
+    UPDATE market_instrumenttype AS instrument
+    SET base_currency_id = currency.iso_code
+    FROM operations_currency AS currency
+    WHERE instrument.type = 'Currency' AND currency.iso_code = LEFT(instrument.ticker, 3);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0006_auto_20261019_0915'),
+        ('market', '0011_auto_20261019_0903'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instrumenttype',
+            name='base_currency',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='operations.Currency', verbose_name='Базовая валюта'),
+        ),
+        migrations.RunSQL(FILL_BASE_CURRENCY_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0006_auto_20261019_0915'),
+        ('market', '0012_instrumenttype_base_currency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrencyRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('rate', models.DecimalField(decimal_places=8, max_digits=20, verbose_name='Курс')),
+                ('source', models.CharField(choices=[('Candle', 'Дневная свеча'), ('Trade', 'Сделки ИС')], max_length=16, verbose_name='Источник')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='operations.Currency', verbose_name='Валюта')),
+                ('quote_currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='operations.Currency', verbose_name='Валюта котировки')),
+            ],
+            options={
+                'verbose_name': 'Курс валюты',
+                'verbose_name_plural': 'Курсы валют',
+                'ordering': ('currency', 'date'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='currencyrate',
+            constraint=models.UniqueConstraint(fields=('currency', 'quote_currency', 'date'), name='unique_currency_rate'),
+        ),
+    ]
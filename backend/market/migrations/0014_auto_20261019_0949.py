@@ -0,0 +1,51 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:49
+
+from django.db import migrations, models
+
+
+# Сохраненное состояние сделок было округлено, следующий перерасчет пройдет по всем операциям
+RESET_INCOME_STATE_SQL = """
+    UPDATE market_dealincome SET capital = value;
+    UPDATE market_deal SET is_income_state_actual = false;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0013_auto_20261019_0933'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dealincome',
+            name='capital',
+            field=models.DecimalField(decimal_places=28, default=0, max_digits=40, verbose_name='Капитал'),
+        ),
+        migrations.AlterField(
+            model_name='dealincome',
+            name='last_dividend_share',
+            field=models.DecimalField(decimal_places=28, default=0, max_digits=40, verbose_name='Доля с последних дивидендов'),
+        ),
+        migrations.AlterField(
+            model_name='dealincome',
+            name='stock_quantity',
+            field=models.DecimalField(decimal_places=28, default=0, max_digits=40, verbose_name='Количество ценных бумаг'),
+        ),
+        migrations.AlterField(
+            model_name='dealincomesnapshot',
+            name='capital',
+            field=models.DecimalField(decimal_places=28, default=0, max_digits=40, verbose_name='Доход'),
+        ),
+        migrations.AlterField(
+            model_name='dealincomesnapshot',
+            name='last_dividend_share',
+            field=models.DecimalField(decimal_places=28, default=0, max_digits=40, verbose_name='Доля с последних дивидендов'),
+        ),
+        migrations.AlterField(
+            model_name='dealincomesnapshot',
+            name='stock_quantity',
+            field=models.DecimalField(decimal_places=28, default=0, max_digits=40, verbose_name='Количество ценных бумаг'),
+        ),
+        migrations.RunSQL(RESET_INCOME_STATE_SQL, migrations.RunSQL.noop),
+    ]
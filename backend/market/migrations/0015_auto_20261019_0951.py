@@ -0,0 +1,23 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0014_auto_20261019_0949'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deal',
+            name='recalculation_attempts',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Неудачных попыток перерасчета'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='recalculation_retry_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Повторить перерасчет после'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:59
+
+from django.db import migrations, models
+
+
+# Лоты дополняются новыми операциями от сохраненного состояния, а оно было округлено,
+# следующий перерасчет сделок пройдет по всем операциям
+RESET_INCOME_STATE_SQL = """
+    UPDATE market_deal SET is_income_state_actual = false;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0015_auto_20261019_0951'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='deallots',
+            name='realized_income',
+            field=models.DecimalField(decimal_places=28, default=0, max_digits=40, verbose_name='Реализованный доход'),
+        ),
+        migrations.RunSQL(RESET_INCOME_STATE_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.0.8 on 2026-10-19 07:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Курсы по сделкам были общими для всех ИС, какому ИС они принадлежат, неизвестно.
+# Они посчитаются заново для каждого ИС при следующем обновлении курсов
+DELETE_TRADE_RATES_SQL = """
+    DELETE FROM market_currencyrate WHERE source = 'Trade';
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_auto_20261019_0941'),
+        ('market', '0016_auto_20261019_0959'),
+    ]
+
+    operations = [
+        migrations.RunSQL(DELETE_TRADE_RATES_SQL, migrations.RunSQL.noop),
+        migrations.RemoveConstraint(
+            model_name='currencyrate',
+            name='unique_currency_rate',
+        ),
+        migrations.AddField(
+            model_name='currencyrate',
+            name='investment_account',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users.InvestmentAccount', verbose_name='Инвестиционный счет'),
+        ),
+        migrations.AddConstraint(
+            model_name='currencyrate',
+            constraint=models.UniqueConstraint(condition=models.Q(investment_account__isnull=True), fields=('currency', 'quote_currency', 'date'), name='unique_currency_rate'),
+        ),
+        migrations.AddConstraint(
+            model_name='currencyrate',
+            constraint=models.UniqueConstraint(condition=models.Q(investment_account__isnull=False), fields=('investment_account', 'currency', 'quote_currency', 'date'), name='unique_account_currency_rate'),
+        ),
+    ]
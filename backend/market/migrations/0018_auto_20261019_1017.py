@@ -0,0 +1,23 @@
+# Generated by Django 3.0.8 on 2026-10-19 07:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0017_auto_20261019_1009'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deal',
+            name='processed_operations_checksum',
+            field=models.BigIntegerField(default=0, verbose_name='Сумма id учтенных операций'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='processed_operations_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Учтено операций'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.0.8 on 2026-10-19 07:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0007_auto_20261019_1027'),
+        ('market', '0018_auto_20261019_1017'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='deal',
+            name='last_processed_operation',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='operations.Operation', verbose_name='Последняя учтенная операция'),
+        ),
+        migrations.AlterField(
+            model_name='dealincomesnapshot',
+            name='operation',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='operations.Operation', verbose_name='Операция'),
+        ),
+    ]
@@ -1,12 +1,46 @@
+import collections
+import logging
+import os
+from decimal import Decimal
+from typing import Dict, Iterable, List
+
 from django.core.validators import MinValueValidator
-from django.db import models
-from django.db.models import Sum, F, Q, Case, When
+from django.contrib.postgres.fields import JSONField
+from django.apps import apps
+from django.db import models, transaction, connection
+from django.db.models import Q, F, Sum, Count, prefetch_related_objects
 from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
-from core.utils import ProxyInheritanceManager, ProxyQ
-from market.models_constraints import InstrumentTypeConstraints, InstrumentTypeTypes
+from core.utils import ProxyInheritanceManager, ProxyQ, is_proxy_instance
+from market.models_constraints import InstrumentTypeConstraints, InstrumentTypeTypes, LotAccountingMethods, \
+    CurrencyRateSources
 from market.services.income_calculation import SmartInvestorSet
-from operations.models import SaleOperation, PurchaseOperation, DividendOperation
+from market.services.lot_accounting import LotAccountingSet
+from market.services.recalculation_queue import enqueue
+from market.services.shares import ShareResolver
+from operations.models import SaleOperation, PurchaseOperation, DividendOperation, Share
+from operations.models_constraints import OperationConstraints
+
+logger = logging.getLogger(__name__)
+
+# Точность сумм дохода со сделки (DealIncome.value) и журнала BalanceEntry
+BALANCE_PRECISION = Decimal('0.0001')
+# Точность сохраненного состояния участников сделки (DealIncome, DealIncomeSnapshot),
+# не меньше точности вычислений Decimal по умолчанию (28 знаков)
+STATE_MAX_DIGITS = 40
+STATE_PLACES = 28
+
+
+def get_income_snapshot_interval() -> int:
+    """ Через сколько операций сделки сохранять состояние участников (DealIncomeSnapshot), 0 - не сохранять """
+    return max(int(os.getenv('PROJECT_DEAL_INCOME_SNAPSHOT_INTERVAL', 20)), 0)
+
+
+def _after_operation_q(date, pk) -> Q:
+    """ Операции, которые идут после операции с датой date и id pk (в порядке date, pk) """
+    return Q(date__gt=date) | Q(date=date, pk__gt=pk)
 
 
 class InstrumentType(models.Model):
@@ -32,6 +66,12 @@ class InstrumentType(models.Model):
     lot = models.PositiveIntegerField(verbose_name='шт/лот')
     currency = models.ForeignKey('operations.Currency', verbose_name='Валюта', on_delete=models.CASCADE)
 
+    # Для валют: покупается базовая валюта, оплачивается в currency
+    base_currency = models.ForeignKey(
+        'operations.Currency', verbose_name='Базовая валюта', on_delete=models.PROTECT,
+        null=True, blank=True, related_name='+'
+    )
+
     # Для ценных бумаг
     isin = models.CharField(verbose_name='ISIN', max_length=32, default='')
 
@@ -49,6 +89,11 @@ class CurrencyInstrument(InstrumentType):
         verbose_name_plural = 'Валюты'
         proxy = True
 
+    @staticmethod
+    def get_base_currency_iso_code(ticker: str) -> str:
+        """ ISO код базовой валюты по тикеру валютной пары (USD000UTSTOM, EUR_RUB__TOM, GBPRUB_TOM) """
+        return ticker[:3]
+
 
 class StockInstrument(InstrumentType):
     """ Ценная акция на рынке """
@@ -58,36 +103,195 @@ class StockInstrument(InstrumentType):
         proxy = True
 
 
-class DealQuerySet(models.QuerySet):
-    _sale_filter = ProxyQ(operations__proxy_instance_of=SaleOperation)
-    _purchase_filter = ProxyQ(operations__proxy_instance_of=PurchaseOperation)
+class CurrencyRate(models.Model):
+    """ Курс валюты на дату: сколько стоит единица currency в quote_currency.
+        Заполняется по дневным свечам валютных инструментов (общие курсы) или по сделкам ИС с ними
+        (курсы только этого ИС), пересчет сумм между валютами - market.services.currency_rates
+    """
+    Sources = CurrencyRateSources
 
-    def _with_quantity_annotation_by_operation_type(self):
-        return self.annotate(
-            sold_quantity=Coalesce(Sum('operations__quantity', filter=self._sale_filter), 0),
-            bought_quantity=Coalesce(Sum('operations__quantity', filter=self._purchase_filter), 0)
-        )
+    class Meta:
+        verbose_name = 'Курс валюты'
+        verbose_name_plural = 'Курсы валют'
+        ordering = ('currency', 'date')
+        constraints = [
+            models.UniqueConstraint(fields=('currency', 'quote_currency', 'date'), name='unique_currency_rate',
+                                    condition=Q(investment_account__isnull=True)),
+            models.UniqueConstraint(fields=('investment_account', 'currency', 'quote_currency', 'date'),
+                                    name='unique_account_currency_rate', condition=Q(investment_account__isnull=False))
+        ]
+
+    currency = models.ForeignKey(
+        'operations.Currency', verbose_name='Валюта', on_delete=models.PROTECT, related_name='+'
+    )
+    quote_currency = models.ForeignKey(
+        'operations.Currency', verbose_name='Валюта котировки', on_delete=models.PROTECT, related_name='+'
+    )
+    date = models.DateField(verbose_name='Дата')
+    rate = models.DecimalField(verbose_name='Курс', max_digits=20, decimal_places=8)
+    source = models.CharField(verbose_name='Источник', max_length=16, choices=Sources.choices)
+    # Курсы по сделкам видны только в пересчетах сумм своего ИС
+    investment_account = models.ForeignKey(
+        'users.InvestmentAccount', verbose_name='Инвестиционный счет', on_delete=models.CASCADE,
+        related_name='+', null=True, blank=True
+    )
+
+    def __str__(self):
+        return f'{self.currency}/{self.quote_currency} {self.date}: {self.rate}'
 
+
+class DealQuerySet(models.QuerySet):
     def opened(self):
-        return (
-            self._with_quantity_annotation_by_operation_type()
-            .filter(~Q(sold_quantity=F('bought_quantity')) | Q(bought_quantity=0) | Q(sold_quantity=0))
-        )
+        return self.filter(is_closed=False)
 
     def closed(self):
-        return (
-            self._with_quantity_annotation_by_operation_type()
-            .filter(Q(sold_quantity=F('bought_quantity')) & ~Q(bought_quantity=0) & ~Q(sold_quantity=0))
-        )
+        return self.filter(is_closed=True)
 
     def with_closed_annotations(self):
-        return self._with_quantity_annotation_by_operation_type().annotate(
-            is_closed=Case(
-                When(Q(sold_quantity=F('bought_quantity')) & ~Q(buys=0) & ~Q(sells=0), then=True),
-                default=False, output_field=models.BooleanField()
-            )
+        # Признак закрытия сделки хранится в is_closed
+        return self.all()
+
+    def with_statistics(self):
+        """ Статистика по операциям каждой сделки одним сгруппированным запросом:
+            income - продажи и дивиденды (с комиссиями и налогами), expense - покупки с комиссиями,
+            commission_total - все комиссии, dividend_total - дивиденды с учетом налога
+        """
+        decimal_field = models.DecimalField(max_digits=20, decimal_places=4)
+        payment = F('operations__payment') + F('operations__commission')
+        dividend = F('operations__payment') + F('operations__dividend_tax')
+
+        def total(expression, proxy_instance_of=None):
+            condition = None if proxy_instance_of is None else ProxyQ(operations__proxy_instance_of=proxy_instance_of)
+            return Coalesce(Sum(expression, filter=condition, output_field=decimal_field), 0)
+
+        return self.annotate(
+            income=total(payment, SaleOperation) + total(dividend, DividendOperation),
+            expense=total(payment, PurchaseOperation),
+            commission_total=total(F('operations__commission')),
+            dividend_total=total(dividend, DividendOperation)
         )
 
+    def reset_income_state(self):
+        """ Сохраненное состояние расчета дохода становится неактуальным,
+            следующий перерасчет пройдет по всем операциям сделок
+        """
+        return self.update(is_income_state_actual=False)
+
+    def refresh_state(self) -> int:
+        """ Пересчитывает сохраняемое состояние сделок (количество, даты, валюту) по их операциям
+            одним запросом, нужен, если операции сделок менялись не через Deal.apply_operation
+        :return: количество обновленных сделок
+        """
+        deal_ids = tuple(self.values_list('pk', flat=True))
+        if not deal_ids:
+            return 0
+        operation_model = apps.get_model('operations', 'Operation')
+        purchase_types = tuple(OperationConstraints.PurchaseOperation.possible_types)
+        sale_types = tuple(OperationConstraints.SaleOperation.possible_types)
+        sql = f"""
+            UPDATE {Deal._meta.db_table} AS deal
+            SET bought_quantity = state.bought_quantity, sold_quantity = state.sold_quantity,
+                is_closed = state.bought_quantity = state.sold_quantity AND state.bought_quantity > 0,
+                opened_at = state.opened_at,
+                closed_at = CASE
+                    WHEN state.bought_quantity = state.sold_quantity AND state.bought_quantity > 0
+                    THEN state.last_trade_at
+                END,
+                currency_id = state.currency_id
+            FROM (
+                SELECT operation.deal_id,
+                    COALESCE(SUM(operation.quantity) FILTER (WHERE operation.type IN %s), 0) AS bought_quantity,
+                    COALESCE(SUM(operation.quantity) FILTER (WHERE operation.type IN %s), 0) AS sold_quantity,
+                    MIN(operation.date) AS opened_at,
+                    MAX(operation.date) FILTER (WHERE operation.type IN %s) AS last_trade_at,
+                    MIN(operation.currency_id) AS currency_id
+                FROM {operation_model._meta.db_table} AS operation
+                WHERE operation.deal_id IN %s
+                GROUP BY operation.deal_id
+            ) AS state
+            WHERE deal.id = state.deal_id
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [purchase_types, sale_types, purchase_types + sale_types, deal_ids])
+            return cursor.rowcount
+
+    def update_income_summary(self) -> None:
+        """ Пересчитывает вклад сделок в доход ИС (реализованный доход, дивиденды, комиссии)
+            и добавляет изменение вклада к InvestmentAccountIncome одним запросом.
+            Реализованный доход открытой сделки - выручка с продаж минус стоимость проданных бумаг
+            по средней цене покупки, у закрытой сделки - все продажи минус все покупки
+        """
+        deal_ids = tuple(self.values_list('pk', flat=True))
+        if not deal_ids:
+            return
+        operation_model = apps.get_model('operations', 'Operation')
+        income_model = apps.get_model('users', 'InvestmentAccountIncome')
+        purchase_types = tuple(OperationConstraints.PurchaseOperation.possible_types)
+        sale_types = tuple(OperationConstraints.SaleOperation.possible_types)
+        dividend_types = tuple(OperationConstraints.DividendOperation.possible_types)
+        sql = f"""
+            WITH old AS (
+                SELECT id, closed_deal_income, opened_deal_income, dividend_income, commission
+                FROM {Deal._meta.db_table}
+                WHERE id IN %(deal_ids)s AND currency_id IS NOT NULL
+                FOR UPDATE
+            ), totals AS (
+                SELECT operation.deal_id,
+                    COALESCE(SUM(operation.quantity) FILTER (WHERE operation.type IN %(purchase_types)s), 0)
+                        AS bought_quantity,
+                    COALESCE(SUM(operation.quantity) FILTER (WHERE operation.type IN %(sale_types)s), 0)
+                        AS sold_quantity,
+                    COALESCE(SUM(operation.payment + operation.commission)
+                             FILTER (WHERE operation.type IN %(purchase_types)s), 0) AS bought_payment,
+                    COALESCE(SUM(operation.payment + operation.commission)
+                             FILTER (WHERE operation.type IN %(sale_types)s), 0) AS sold_payment,
+                    COALESCE(SUM(operation.payment + operation.dividend_tax)
+                             FILTER (WHERE operation.type IN %(dividend_types)s), 0) AS dividend_income,
+                    COALESCE(SUM(operation.commission), 0) AS commission
+                FROM {operation_model._meta.db_table} AS operation
+                WHERE operation.deal_id IN (SELECT id FROM old)
+                GROUP BY operation.deal_id
+            ), new AS (
+                SELECT deal_id, dividend_income, commission,
+                    bought_quantity = sold_quantity AND bought_quantity > 0 AS is_closed,
+                    sold_payment + CASE
+                        WHEN bought_quantity > 0 THEN bought_payment * sold_quantity / bought_quantity ELSE 0
+                    END AS realized_income
+                FROM totals
+            ), updated AS (
+                UPDATE {Deal._meta.db_table} AS deal
+                SET closed_deal_income = CASE WHEN new.is_closed THEN new.realized_income ELSE 0 END,
+                    opened_deal_income = CASE WHEN new.is_closed THEN 0 ELSE new.realized_income END,
+                    dividend_income = new.dividend_income,
+                    commission = new.commission
+                FROM new
+                WHERE deal.id = new.deal_id
+                RETURNING deal.id, deal.investment_account_id, deal.currency_id, deal.closed_deal_income,
+                    deal.opened_deal_income, deal.dividend_income, deal.commission
+            )
+            INSERT INTO {income_model._meta.db_table} AS income
+                (investment_account_id, currency_id, closed_deal_income, opened_deal_income,
+                 dividend_income, commission)
+            SELECT updated.investment_account_id, updated.currency_id,
+                SUM(updated.closed_deal_income - old.closed_deal_income),
+                SUM(updated.opened_deal_income - old.opened_deal_income),
+                SUM(updated.dividend_income - old.dividend_income),
+                SUM(updated.commission - old.commission)
+            FROM updated JOIN old ON old.id = updated.id
+            GROUP BY updated.investment_account_id, updated.currency_id
+            ON CONFLICT (investment_account_id, currency_id) DO UPDATE
+            SET closed_deal_income = income.closed_deal_income + EXCLUDED.closed_deal_income,
+                opened_deal_income = income.opened_deal_income + EXCLUDED.opened_deal_income,
+                dividend_income = income.dividend_income + EXCLUDED.dividend_income,
+                commission = income.commission + EXCLUDED.commission
+        """
+        params = {
+            'deal_ids': deal_ids, 'purchase_types': purchase_types,
+            'sale_types': sale_types, 'dividend_types': dividend_types
+        }
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
 
 class DealManager(models.Manager):
     def get_queryset(self):
@@ -96,12 +300,24 @@ class DealManager(models.Manager):
     def closed(self):
         return self.get_queryset().closed()
 
+    def refresh_state(self):
+        return self.get_queryset().refresh_state()
+
+    def update_income_summary(self):
+        return self.get_queryset().update_income_summary()
+
+    def with_statistics(self):
+        return self.get_queryset().with_statistics()
+
     def opened(self):
         return self.get_queryset().opened()
 
     def with_closed_annotations(self):
         return self.get_queryset().with_closed_annotations()
 
+    def reset_income_state(self):
+        return self.get_queryset().reset_income_state()
+
 
 class Deal(models.Model):
     """ Набор операций для одной компании/фонда и т.д.
@@ -111,6 +327,15 @@ class Deal(models.Model):
     class Meta:
         verbose_name = 'Сделка'
         verbose_name_plural = 'Сделки'
+        indexes = [
+            models.Index(fields=('id', ), condition=Q(is_recalculation_required=True),
+                         name='deal_recalculation_queue'),
+            models.Index(fields=('investment_account', 'instrument'), condition=Q(is_closed=False),
+                         name='deal_opened')
+        ]
+
+    # Поля состояния сделки, которые обновляются при добавлении операций
+    STATE_FIELDS = ('bought_quantity', 'sold_quantity', 'is_closed', 'opened_at', 'closed_at', 'currency')
 
     objects = DealManager()
 
@@ -120,22 +345,143 @@ class Deal(models.Model):
         related_name='deals'
     )
     co_owners = models.ManyToManyField('users.CoOwner', through='DealIncome')
-
-    def recalculation_income(self):
-        """ Перерасчет дохода со сделки для каждого участника """
-        # XXX
-        # Получаем все операции покупки/продажи и операции получения дивидендов
-        operations = (
+    # Последняя операция, учтенная при расчете дохода,
+    # состояние участников сделки на момент этой операции хранится в DealIncome.
+    # Без внешнего ключа в БД, см. operations.services.partitioning
+    last_processed_operation = models.ForeignKey(
+        'operations.Operation', verbose_name='Последняя учтенная операция', on_delete=models.SET_NULL,
+        null=True, related_name='+', db_constraint=False
+    )
+    is_income_state_actual = models.BooleanField(verbose_name='Состояние дохода актуально', default=False)
+    # Количество и сумма id учтенных операций: если операции сделки до последней учтенной изменились
+    # (добавлена операция задним числом, операция убрана из сделки), нужен полный перерасчет
+    processed_operations_count = models.PositiveIntegerField(verbose_name='Учтено операций', default=0)
+    processed_operations_checksum = models.BigIntegerField(verbose_name='Сумма id учтенных операций', default=0)
+    # Сделка в очереди на перерасчет дохода фоновым обработчиком
+    is_recalculation_required = models.BooleanField(verbose_name='Требуется перерасчет', default=False)
+    # Неудачные попытки перерасчета подряд и время, раньше которого сделка не пересчитывается повторно
+    recalculation_attempts = models.PositiveSmallIntegerField(verbose_name='Неудачных попыток перерасчета', default=0)
+    recalculation_retry_at = models.DateTimeField(verbose_name='Повторить перерасчет после', null=True, blank=True)
+    # Состояние сделки, хранится, чтобы не считать по операциям при каждом запросе
+    bought_quantity = models.BigIntegerField(verbose_name='Куплено', default=0)
+    sold_quantity = models.BigIntegerField(verbose_name='Продано', default=0)
+    is_closed = models.BooleanField(verbose_name='Закрыта', default=False)
+    opened_at = models.DateTimeField(verbose_name='Дата открытия', null=True)
+    closed_at = models.DateTimeField(verbose_name='Дата закрытия', null=True)
+    currency = models.ForeignKey(
+        'operations.Currency', verbose_name='Валюта', on_delete=models.PROTECT, null=True, related_name='+'
+    )
+    # Вклад сделки в доход ИС (InvestmentAccountIncome), реализованный доход учитывается
+    # в closed_deal_income или opened_deal_income в зависимости от того, закрыта ли сделка
+    closed_deal_income = models.DecimalField(
+        verbose_name='Доход закрытой сделки', max_digits=20, decimal_places=4, default=0
+    )
+    opened_deal_income = models.DecimalField(
+        verbose_name='Реализованный доход открытой сделки', max_digits=20, decimal_places=4, default=0
+    )
+    dividend_income = models.DecimalField(verbose_name='Дивиденды', max_digits=20, decimal_places=4, default=0)
+    commission = models.DecimalField(verbose_name='Комиссии', max_digits=20, decimal_places=4, default=0)
+
+    def apply_operation(self, operation: 'operations.Operation') -> None:
+        """ Обновляет состояние сделки с учетом добавляемой операции, без сохранения """
+        if self.opened_at is None or operation.date < self.opened_at:
+            self.opened_at = operation.date
+        if self.currency_id is None:
+            self.currency_id = operation.currency_id
+        if is_proxy_instance(operation, PurchaseOperation):
+            self.bought_quantity += operation.quantity
+        elif is_proxy_instance(operation, SaleOperation):
+            self.sold_quantity += operation.quantity
+        else:
+            return
+        self.is_closed = self.bought_quantity == self.sold_quantity and self.bought_quantity > 0
+        if not self.is_closed:
+            self.closed_at = None
+        elif self.closed_at is None or operation.date > self.closed_at:
+            self.closed_at = operation.date
+
+    def get_income_operations(self):
+        """ Операции, которые учитываются при расчете дохода: покупки/продажи и получение дивидендов """
+        return (
             self.operations
             .filter(proxy_instance_of=(PurchaseOperation, SaleOperation, DividendOperation))
-            .prefetch_related('shares')
+            .select_related('currency')
+            .prefetch_related('shares__co_owner')
         )
-        # Для расчета дохода каждого инвестора от сделки используется этот класс
-        smart_investors_set = SmartInvestorSet()
-        smart_investors_set.add_operations(operations)
 
-        currency = operations.last().currency
-        DealIncome.objects.exclude(co_owner__in=smart_investors_set.investors).delete()
+    def recalculation_income(self, full=False):
+        """ Перерасчет дохода со сделки для каждого участника.
+            Состояние каждого участника (количество бумаг, капитал, доля с последних дивидендов)
+            хранится в DealIncome на момент последней учтенной операции, поэтому
+            учитываются только операции, которые были после нее.
+            Каждые PROJECT_DEAL_INCOME_SNAPSHOT_INTERVAL операций состояние сохраняется
+            в DealIncomeSnapshot для запросов дохода на дату (income_as_of)
+        :param full: пересчитать доход по всем операциям сделки
+        """
+        operations = self.get_income_operations()
+        last_operation = self.last_processed_operation if self.is_income_state_actual else None
+        if last_operation is not None and not full:
+            is_before_last_operation = (
+                Q(date__lt=last_operation.date) | Q(date=last_operation.date, pk__lt=last_operation.pk)
+            )
+            # Операции до последней учтенной должны совпадать с учтенными: операция, добавленная
+            # задним числом или убранная из сделки, делает состояние неактуальным
+            processed = (
+                operations.exclude(_after_operation_q(last_operation.date, last_operation.pk))
+                .order_by().aggregate(count=Count('pk'), checksum=Coalesce(Sum('pk'), 0))
+            )
+            full = (processed['count'], processed['checksum']) != (
+                self.processed_operations_count, self.processed_operations_checksum
+            )
+            if full:
+                logger.info(f'{self}: учтенные операции изменились, полный перерасчет')
+        else:
+            full = True
+
+        # Для расчета дохода каждого инвестора от сделки используется этот класс
+        share_resolver = ShareResolver(self.investment_account_id)
+        smart_investors_set = SmartInvestorSet(share_resolver)
+        snapshot_interval = get_income_snapshot_interval()
+        if not full:
+            operations_since_snapshot = self._count_operations_since_snapshot(operations, last_operation)
+            operations = operations.exclude(is_before_last_operation).exclude(pk=last_operation.pk)
+            for deal_income in self.income_set.select_related('co_owner', 'currency'):
+                smart_investors_set.currency = deal_income.currency
+                smart_investors_set.restore_investor(
+                    deal_income.co_owner, deal_income.stock_quantity,
+                    deal_income.capital, deal_income.last_dividend_share
+                )
+        else:
+            # Сохраненные контрольные точки могли быть посчитаны по старым долям
+            self.income_snapshots.all().delete()
+            operations_since_snapshot = 0
+        operations = list(operations.order_by('date', 'pk'))
+        if not operations:
+            logger.info(f'{self}: новых операций нет')
+            if full:
+                self.lots.all().delete()
+            return
+        snapshots = []
+        for operation in operations:
+            smart_investors_set.add_operation(operation)
+            operations_since_snapshot += 1
+            if snapshot_interval and operations_since_snapshot >= snapshot_interval:
+                operations_since_snapshot = 0
+                snapshots.extend(
+                    DealIncomeSnapshot(
+                        deal=self, operation=operation, date=operation.date, co_owner=smart_investor.investor,
+                        stock_quantity=smart_investor.stock_quantity, capital=smart_investor.capital,
+                        last_dividend_share=smart_investor.last_dividend_share
+                    )
+                    for smart_investor in smart_investors_set
+                )
+        DealIncomeSnapshot.objects.bulk_create(snapshots)
+
+        currency = operations[-1].currency
+        removed_income_set = self.income_set.exclude(co_owner__in=smart_investors_set.investors)
+        # Доход совладельцев до перерасчета, по нему считается изменение баланса совладельцев
+        previous_values = dict(removed_income_set.values_list('co_owner_id', 'value'))
+        removed_income_set.delete()
         DealIncome.objects.bulk_create(
             [
                 DealIncome(deal=self, co_owner=i, currency=currency)
@@ -146,9 +492,176 @@ class Deal(models.Model):
         deal_income_set = DealIncome.objects.filter(deal=self).select_related('co_owner')
         deal_income_bulk_update = []
         for deal_income in deal_income_set:
-            deal_income.value = smart_investors_set[deal_income.co_owner].capital
+            smart_investor = smart_investors_set[deal_income.co_owner]
+            previous_values[deal_income.co_owner_id] = deal_income.value
+            deal_income.value = smart_investor.capital
+            deal_income.capital = smart_investor.capital
+            deal_income.stock_quantity = smart_investor.stock_quantity
+            deal_income.last_dividend_share = smart_investor.last_dividend_share
             deal_income_bulk_update.append(deal_income)
-        DealIncome.objects.bulk_update(deal_income_bulk_update, fields=['value'])
+        DealIncome.objects.bulk_update(
+            deal_income_bulk_update, fields=['value', 'capital', 'stock_quantity', 'last_dividend_share']
+        )
+        self._append_balance_entries(smart_investors_set, previous_values, currency, full)
+        if full:
+            self.processed_operations_count = self.processed_operations_checksum = 0
+        self.processed_operations_count += len(operations)
+        self.processed_operations_checksum += sum(operation.pk for operation in operations)
+        self.last_processed_operation = operations[-1]
+        self.is_income_state_actual = True
+        self.save(update_fields=(
+            'last_processed_operation', 'is_income_state_actual',
+            'processed_operations_count', 'processed_operations_checksum'
+        ))
+        Deal.objects.filter(pk=self.pk).update_income_summary()
+        self.recalculation_lots(share_resolver, None if full else operations)
+
+    def _append_balance_entries(self, smart_investors_set: SmartInvestorSet, previous_values: Dict[int, Decimal],
+                                currency, full: bool) -> None:
+        """ Записывает изменение дохода каждого совладельца со сделки в журнал BalanceEntry,
+            отдельно дивиденды, комиссии и остальной доход.
+            При полном перерасчете дивиденды и комиссии считаются заново, поэтому в журнал
+            записывается разница с уже записанными по сделке суммами. Если у совладельца есть
+            доход со сделки до ведения журнала, в нем уже учтены прошлые дивиденды и комиссии,
+            и при полном перерасчете записывается только изменение дохода
+        :param previous_values: доход совладельцев со сделки до перерасчета
+        """
+        BalanceEntry = apps.get_model('users', 'BalanceEntry')
+        recorded = collections.defaultdict(Decimal)
+        if full:
+            recorded_entries = (
+                BalanceEntry.objects
+                .filter(deal=self, kind__in=(
+                    BalanceEntry.Kinds.DIVIDEND, BalanceEntry.Kinds.COMMISSION, BalanceEntry.Kinds.OPENING_DEAL_INCOME
+                ))
+                .values_list('co_owner_id', 'kind')
+                .order_by()
+                .annotate(Sum('amount'))
+            )
+            for co_owner_id, kind, amount in recorded_entries:
+                recorded[co_owner_id, kind] = amount
+        smart_investors = {smart_investor.investor.pk: smart_investor for smart_investor in smart_investors_set}
+        entries = []
+        for co_owner_id, previous_value in previous_values.items():
+            smart_investor = smart_investors.get(co_owner_id)
+            if smart_investor is None:
+                value = dividend_income = commission = Decimal(0)
+            else:
+                value, dividend_income, commission = (
+                    amount.quantize(BALANCE_PRECISION)
+                    for amount in (smart_investor.capital, smart_investor.dividend_income, smart_investor.commission)
+                )
+            if (co_owner_id, BalanceEntry.Kinds.OPENING_DEAL_INCOME) in recorded:
+                dividend_income = commission = Decimal(0)
+            else:
+                dividend_income -= recorded[co_owner_id, BalanceEntry.Kinds.DIVIDEND]
+                commission -= recorded[co_owner_id, BalanceEntry.Kinds.COMMISSION]
+            amounts = {
+                BalanceEntry.Kinds.DIVIDEND: dividend_income,
+                BalanceEntry.Kinds.COMMISSION: commission,
+                BalanceEntry.Kinds.DEAL_INCOME: value - previous_value - dividend_income - commission
+            }
+            entries.extend(
+                BalanceEntry(co_owner_id=co_owner_id, currency=currency, kind=kind, amount=amount, deal=self)
+                for kind, amount in amounts.items()
+            )
+        BalanceEntry.objects.append(entries)
+
+    def _count_operations_since_snapshot(self, operations, last_operation) -> int:
+        """ Количество операций после последней контрольной точки до last_operation включительно """
+        operations = operations.exclude(_after_operation_q(last_operation.date, last_operation.pk))
+        last_snapshot = self.income_snapshots.order_by('-date', '-operation_id').values('date', 'operation_id').first()
+        if last_snapshot is not None:
+            operations = operations.filter(_after_operation_q(last_snapshot['date'], last_snapshot['operation_id']))
+        return operations.count()
+
+    def income_as_of(self, date) -> SmartInvestorSet:
+        """ Состояние участников сделки с учетом всех операций до date включительно """
+        return self.income_history((date, ))[date]
+
+    def income_history(self, dates: Iterable) -> Dict[object, SmartInvestorSet]:
+        """ Состояние участников сделки на каждую дату из dates.
+            Состояние восстанавливается из ближайшей контрольной точки не позже первой даты,
+            дальше операции проигрываются один раз до последней даты.
+            Ничего не сохраняет: если состояние сделки неактуально, контрольные точки могли быть
+            посчитаны по старым долям, поэтому операции проигрываются с начала сделки,
+            а сделка только ставится в очередь перерасчета фоновому обработчику
+        :return: словарь, где ключ - дата, значение - SmartInvestorSet
+        """
+        dates = sorted(set(dates))
+        if not dates:
+            return {}
+        smart_investors_set = SmartInvestorSet(ShareResolver(self.investment_account_id))
+        operations = self.get_income_operations().filter(date__lte=dates[-1])
+        if self.is_income_state_actual:
+            last_snapshot = (
+                self.income_snapshots
+                .filter(date__lte=dates[0])
+                .order_by('-date', '-operation_id')
+                .values('date', 'operation_id')
+                .first()
+            )
+        else:
+            if not self.is_recalculation_required:
+                enqueue((self.pk,))
+            last_snapshot = None
+        if last_snapshot is not None:
+            snapshots = self.income_snapshots.filter(operation_id=last_snapshot['operation_id'])
+            for snapshot in snapshots.select_related('co_owner'):
+                smart_investors_set.restore_investor(
+                    snapshot.co_owner, snapshot.stock_quantity, snapshot.capital, snapshot.last_dividend_share
+                )
+            operations = operations.filter(_after_operation_q(last_snapshot['date'], last_snapshot['operation_id']))
+
+        history = {}
+        dates_iterator = iter(dates)
+        date = next(dates_iterator, None)
+        for operation in operations.order_by('date', 'pk'):
+            while date is not None and date < operation.date:
+                history[date] = smart_investors_set.copy()
+                date = next(dates_iterator, None)
+            smart_investors_set.add_operation(operation)
+        while date is not None:
+            history[date] = smart_investors_set.copy()
+            date = next(dates_iterator, None)
+        return history
+
+    def recalculation_lots(self, share_resolver: ShareResolver = None, operations: List['operations.Operation'] = None):
+        """ Пересчет лотов сделки (FIFO и по средней цене) для каждого участника.
+            Транзакции сделки обрабатываются за один проход
+        :param operations: новые операции сделки после уже учтенных в DealLots (по порядку date, pk),
+            лоты восстанавливаются из DealLots и дополняются только ими.
+            Если None - лоты пересчитываются по всем операциям
+        """
+        if share_resolver is None:
+            share_resolver = ShareResolver(self.investment_account_id)
+        lot_accounting_set = LotAccountingSet(share_resolver)
+        if operations is None:
+            operations = (
+                self.operations
+                .filter(proxy_instance_of=(PurchaseOperation, SaleOperation))
+                .order_by('date', 'pk')
+                .prefetch_related('shares__co_owner', 'transaction_set')
+            )
+        else:
+            for deal_lots in self.lots.select_related('co_owner'):
+                lot_accounting_set.restore_account(
+                    deal_lots.co_owner, deal_lots.method, deal_lots.open_lots, deal_lots.realized_income
+                )
+            prefetch_related_objects(operations, 'transaction_set')
+        lot_accounting_set.add_operations(operations)
+        with transaction.atomic():
+            self.lots.all().delete()
+            DealLots.objects.bulk_create([
+                DealLots(
+                    deal=self, co_owner=co_owner, method=method,
+                    realized_income=lot_account.realized_income,
+                    open_quantity=lot_account.open_quantity,
+                    cost_basis=lot_account.cost_basis,
+                    open_lots=lot_account.open_lots
+                )
+                for (co_owner, method), lot_account in lot_accounting_set
+            ])
 
     def __str__(self):
         return f'Deal({self.instrument.name})'
@@ -173,6 +686,105 @@ class DealIncome(models.Model):
     # Сколько совладелец заработал с конкретной сделки
     value = models.DecimalField(verbose_name='Доход', max_digits=20, decimal_places=4, default=0)
     currency = models.ForeignKey('operations.Currency', verbose_name='Валюта', on_delete=models.CASCADE)
+    # Состояние совладельца на момент последней учтенной операции сделки.
+    # Хранится без округления до копеек, иначе каждый инкрементальный расчет
+    # начинался бы с округленного капитала и расходился с расчетом по всем операциям
+    capital = models.DecimalField(
+        verbose_name='Капитал', max_digits=STATE_MAX_DIGITS, decimal_places=STATE_PLACES, default=0
+    )
+    stock_quantity = models.DecimalField(
+        verbose_name='Количество ценных бумаг', max_digits=STATE_MAX_DIGITS, decimal_places=STATE_PLACES, default=0
+    )
+    last_dividend_share = models.DecimalField(
+        verbose_name='Доля с последних дивидендов', max_digits=STATE_MAX_DIGITS, decimal_places=STATE_PLACES,
+        default=0
+    )
 
     def __str__(self):
         return f'{self.deal}: {self.co_owner} ({self.value})'
+
+
+class DealIncomeSnapshot(models.Model):
+    """ Состояние участника сделки после операции (контрольная точка).
+        Сохраняется не после каждой операции, а раз в несколько операций,
+        чтобы доход на любую дату считался от ближайшей точки, а не с начала сделки
+    """
+    class Meta:
+        verbose_name = 'Контрольная точка дохода за сделку'
+        verbose_name_plural = 'Контрольные точки дохода за сделки'
+        constraints = [
+            models.UniqueConstraint(fields=('deal', 'operation', 'co_owner'), name='unique_deal_income_snapshot')
+        ]
+        indexes = [
+            models.Index(fields=('deal', 'date', 'operation'), name='deal_income_snapshot_date')
+        ]
+
+    deal = models.ForeignKey(
+        Deal, verbose_name='Сделка', on_delete=models.CASCADE, related_name='income_snapshots'
+    )
+    # Последняя учтенная операция и ее дата (без внешнего ключа в БД, см. operations.services.partitioning)
+    operation = models.ForeignKey(
+        'operations.Operation', verbose_name='Операция', on_delete=models.CASCADE, related_name='+',
+        db_constraint=False
+    )
+    date = models.DateTimeField(verbose_name='Дата операции')
+    co_owner = models.ForeignKey(
+        'users.CoOwner', verbose_name='Совладелец', on_delete=models.CASCADE, related_name='+'
+    )
+    stock_quantity = models.DecimalField(
+        verbose_name='Количество ценных бумаг', max_digits=STATE_MAX_DIGITS, decimal_places=STATE_PLACES, default=0
+    )
+    capital = models.DecimalField(
+        verbose_name='Доход', max_digits=STATE_MAX_DIGITS, decimal_places=STATE_PLACES, default=0
+    )
+    last_dividend_share = models.DecimalField(
+        verbose_name='Доля с последних дивидендов', max_digits=STATE_MAX_DIGITS, decimal_places=STATE_PLACES,
+        default=0
+    )
+
+    def __str__(self):
+        return f'{self.deal}: {self.co_owner} ({self.date})'
+
+
+class DealLots(models.Model):
+    """ Учет лотов сделки для каждого участника.
+        Хранит результат последнего пересчета на момент Deal.last_processed_operation,
+        чтобы не проходить по транзакциям при чтении и при добавлении новых операций
+    """
+    Methods = LotAccountingMethods
+
+    class Meta:
+        verbose_name = 'Лоты сделки'
+        verbose_name_plural = 'Лоты сделок'
+        constraints = [
+            models.UniqueConstraint(fields=('deal', 'co_owner', 'method'), name='unique_deal_lots')
+        ]
+
+    deal = models.ForeignKey(Deal, verbose_name='Сделка', on_delete=models.CASCADE, related_name='lots')
+    co_owner = models.ForeignKey(
+        'users.CoOwner', verbose_name='Совладелец', on_delete=models.CASCADE, related_name='deal_lots'
+    )
+    method = models.CharField(verbose_name='Метод учета', max_length=16, choices=Methods.choices)
+    # Хранится без округления, от него продолжается расчет при добавлении новых операций
+    realized_income = models.DecimalField(
+        verbose_name='Реализованный доход', max_digits=STATE_MAX_DIGITS, decimal_places=STATE_PLACES, default=0
+    )
+    open_quantity = models.DecimalField(
+        verbose_name='Количество в открытых лотах', max_digits=30, decimal_places=12, default=0
+    )
+    cost_basis = models.DecimalField(
+        verbose_name='Стоимость открытых лотов', max_digits=20, decimal_places=4, default=0
+    )
+    # Список открытых лотов: [{'date': ..., 'quantity': ..., 'price': ...}, ...]
+    open_lots = JSONField(verbose_name='Открытые лоты', default=list)
+
+    def __str__(self):
+        return f'{self.deal}: {self.co_owner} ({self.method})'
+
+
+@receiver(post_save, sender=Share)
+@receiver(post_delete, sender=Share)
+def share_post_save(**kwargs):
+    # После изменения доли в операции сохраненное состояние расчета дохода сделки неактуально
+    instance = kwargs['instance']
+    Deal.objects.filter(operations=instance.operation_id).reset_income_state()
@@ -12,6 +12,16 @@ class InstrumentTypeTypes(models.TextChoices):
     # TODO: Еще Bond, Etf
 
 
+class LotAccountingMethods(models.TextChoices):
+    FIFO = 'FIFO', 'FIFO'
+    AVERAGE = 'Average', 'По средней цене'
+
+
+class CurrencyRateSources(models.TextChoices):
+    CANDLE = 'Candle', 'Дневная свеча'
+    TRADE = 'Trade', 'Сделки ИС'
+
+
 class InstrumentTypeConstraints:
     class InstrumentType:
         possible_types = [i[0] for i in InstrumentTypeTypes.choices]
@@ -0,0 +1,169 @@
+""" Курсы валют и пересчет сумм между валютами.
+    Курсы хранятся в CurrencyRate относительно одной валюты котировки (PROJECT_CURRENCY_RATE_QUOTE),
+    сумма в валюте A переводится в валюту B через нее: amount * курс(A) / курс(B),
+    берется последний курс не позже даты суммы.
+    Курсы по свечам общие, курсы по сделкам ИС используются только в пересчетах сумм этого ИС,
+    на одну дату курс по свечам важнее
+"""
+import datetime
+import logging
+import os
+from decimal import Decimal
+from typing import Iterable, List, Optional, Tuple
+
+from django.apps import apps
+from django.db import connection, models
+from django.db.models import Case, When, F, Q, Value, Subquery, OuterRef, ExpressionWrapper
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+# Сумма, ISO код валюты, дата
+T_AMOUNT_ROW = Tuple[Decimal, str, datetime.date]
+
+
+def get_quote_currency() -> str:
+    """ Валюта, относительно которой хранятся курсы """
+    return os.getenv('PROJECT_CURRENCY_RATE_QUOTE', 'RUB')
+
+
+def save_candle_rates(currency_instrument: 'market.CurrencyInstrument', candles: List[dict]) -> int:
+    """ Сохраняет общие курсы по дневным свечам валютного инструмента (курс - цена закрытия)
+    :return: количество сохраненных курсов
+    """
+    if not candles:
+        return 0
+    currency_rate_model = apps.get_model('market', 'CurrencyRate')
+    sql = f"""
+        INSERT INTO {currency_rate_model._meta.db_table} (currency_id, quote_currency_id, date, rate, source)
+        SELECT %(currency)s, %(quote_currency)s, candle.date, candle.rate, %(source)s
+        FROM unnest(%(dates)s::date[], %(rates)s::numeric[]) AS candle (date, rate)
+        ON CONFLICT (currency_id, quote_currency_id, date) WHERE investment_account_id IS NULL DO UPDATE
+        SET rate = EXCLUDED.rate
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {
+            'currency': currency_instrument.base_currency_id,
+            'quote_currency': currency_instrument.currency_id,
+            'source': currency_rate_model.Sources.CANDLE,
+            'dates': [timezone.localtime(parse_datetime(candle['time'])).date() for candle in candles],
+            'rates': [Decimal(str(candle['c'])) for candle in candles]
+        })
+        return cursor.rowcount
+
+
+def update_rates_from_trades(investment_account_id: int) -> int:
+    """ Курсы ИС по его сделкам с валютными инструментами (средневзвешенная цена за день),
+        в общие курсы они не попадают
+    :return: количество сохраненных курсов
+    """
+    currency_rate_model = apps.get_model('market', 'CurrencyRate')
+    instrument_model = apps.get_model('market', 'InstrumentType')
+    operation_model = apps.get_model('operations', 'Operation')
+    transaction_model = apps.get_model('operations', 'Transaction')
+    sql = f"""
+        INSERT INTO {currency_rate_model._meta.db_table} (
+            currency_id, quote_currency_id, date, rate, source, investment_account_id
+        )
+        SELECT instrument.base_currency_id, instrument.currency_id,
+            (transaction.date AT TIME ZONE %(time_zone)s)::date,
+            SUM(transaction.price * transaction.quantity) / SUM(transaction.quantity), %(source)s,
+            %(investment_account_id)s
+        FROM {transaction_model._meta.db_table} AS transaction
+        JOIN {operation_model._meta.db_table} AS operation ON operation.id = transaction.operation_id
+        JOIN {instrument_model._meta.db_table} AS instrument ON instrument.figi = operation.instrument_id
+        WHERE operation.investment_account_id = %(investment_account_id)s
+            AND instrument.type = %(currency_type)s AND instrument.base_currency_id IS NOT NULL
+            AND transaction.quantity > 0
+        GROUP BY 1, 2, 3
+        ON CONFLICT (investment_account_id, currency_id, quote_currency_id, date)
+            WHERE investment_account_id IS NOT NULL DO UPDATE
+        SET rate = EXCLUDED.rate
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {
+            'time_zone': timezone.get_current_timezone_name(),
+            'source': currency_rate_model.Sources.TRADE,
+            'investment_account_id': investment_account_id,
+            'currency_type': instrument_model.Types.CURRENCY
+        })
+        return cursor.rowcount
+
+
+def convert(rows: Iterable[T_AMOUNT_ROW], currency: str,
+            investment_account_id: Optional[int] = None) -> List[Optional[Decimal]]:
+    """ Переводит суммы в валюту currency одним запросом
+    :param rows: суммы с валютой и датой, на которую берется курс
+    :param investment_account_id: ИС, курсы по сделкам которого тоже используются
+    :return: суммы в валюте currency в том же порядке, None - если нет курса
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+    currency_rate_model = apps.get_model('market', 'CurrencyRate')
+    # Курс валюты к валюте котировки на дату суммы, у самой валюты котировки - 1
+    rate_sql = f"""
+        SELECT CASE WHEN {{currency}} = %(quote)s THEN 1 ELSE (
+            SELECT rate
+            FROM {currency_rate_model._meta.db_table}
+            WHERE currency_id = {{currency}} AND quote_currency_id = %(quote)s AND date <= amount.date
+                AND (investment_account_id IS NULL OR investment_account_id = %(investment_account_id)s)
+            ORDER BY date DESC, investment_account_id NULLS FIRST
+            LIMIT 1
+        ) END AS rate
+    """
+    sql = f"""
+        SELECT CASE
+            WHEN amount.currency_id = %(currency)s THEN amount.amount
+            ELSE amount.amount * source.rate / target.rate
+        END
+        FROM unnest(%(amounts)s::numeric[], %(currencies)s::varchar[], %(dates)s::date[])
+            WITH ORDINALITY AS amount (amount, currency_id, date, position)
+        CROSS JOIN LATERAL ({rate_sql.format(currency='amount.currency_id')}) AS source
+        CROSS JOIN LATERAL ({rate_sql.format(currency='%(currency)s')}) AS target
+        ORDER BY amount.position
+    """
+    amounts, currencies, dates = zip(*rows)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {
+            'currency': currency, 'quote': get_quote_currency(), 'investment_account_id': investment_account_id,
+            'amounts': list(amounts), 'currencies': list(currencies), 'dates': list(dates)
+        })
+        return [row[0] for row in cursor.fetchall()]
+
+
+def converted_amount(amount: str, currency: str, date, target_currency: str,
+                     investment_account_id: Optional[int] = None) -> models.Expression:
+    """ Выражение для annotate/aggregate: поле amount в валюте target_currency.
+        Курсы подтягиваются подзапросами в том же запросе, без отдельных запросов на каждую строку
+    :param amount: поле суммы
+    :param currency: поле валюты суммы
+    :param date: дата курса - поле или значение
+    :param target_currency: ISO код валюты результата
+    :param investment_account_id: ИС, курсы по сделкам которого тоже используются
+    """
+    currency_rate_model = apps.get_model('market', 'CurrencyRate')
+    quote_currency = get_quote_currency()
+    if isinstance(date, str):
+        date = OuterRef(date)
+
+    def get_rate(rate_currency):
+        return Subquery(
+            currency_rate_model.objects
+            .filter(
+                Q(investment_account__isnull=True) | Q(investment_account_id=investment_account_id),
+                currency=rate_currency, quote_currency_id=quote_currency, date__lte=date
+            )
+            .order_by('-date', F('investment_account').asc(nulls_first=True))
+            .values('rate')[:1]
+        )
+
+    output_field = models.DecimalField(max_digits=30, decimal_places=8)
+    target_rate = Value(1) if target_currency == quote_currency else get_rate(target_currency)
+    return Case(
+        When(**{currency: target_currency}, then=F(amount)),
+        When(**{currency: quote_currency}, then=ExpressionWrapper(F(amount) / target_rate, output_field)),
+        default=ExpressionWrapper(F(amount) * get_rate(OuterRef(currency)) / target_rate, output_field),
+        output_field=output_field
+    )
@@ -2,9 +2,10 @@
 """
 import operator
 from decimal import Decimal
-from typing import Union, Dict, NoReturn
+from typing import Union, Dict, NoReturn, Optional
 
 from core.utils import is_proxy_instance
+from market.services.shares import ShareResolver
 from operations.models import DividendOperation, SaleOperation, PurchaseOperation
 
 
@@ -16,9 +17,14 @@ T_OPERATIONS_QUERYSET = Union['django.db.models.QuerySet']
 
 class SmartInvestorSet:
     """ Набор совладельцев одной сделки """
-    def __init__(self):
+    def __init__(self, share_resolver: Optional[ShareResolver] = None):
+        """
+        :param share_resolver: определяет доли совладельцев в операции,
+            если None - используются только сохраненные доли (operation.shares)
+        """
         self.investors: Dict[T_INVESTOR, 'SmartInvestor'] = {}
         self.currency = None
+        self.share_resolver = share_resolver
 
     def __getitem__(self, item: T_INVESTOR) -> 'SmartInvestor':
         try:
@@ -38,33 +44,63 @@ class SmartInvestorSet:
             for investor in self.investors.values():
                 # Капитал инвестора увеличивается на
                 # (доход с дивидендов + налог на дивиденды) * долю акций инвестора среди других инвесторов
-                investor.capital += (operation.payment + operation.dividend_tax) * investor.share_of_stock_quantity
+                dividend = (operation.payment + operation.dividend_tax) * investor.share_of_stock_quantity
+                investor.capital += dividend
+                investor.dividend_income += dividend
                 investor.last_dividend_share = investor.share_of_stock_quantity
         elif is_proxy_instance(operation, (PurchaseOperation, SaleOperation)):
-            for share in operation.shares.all():
-                investor = self[share.co_owner]
+            for co_owner, share_value in self.get_operation_shares(operation).items():
+                investor = self[co_owner]
+                investor.commission += operation.commission * share_value
                 if is_proxy_instance(operation, PurchaseOperation):
                     # Количество акций у инвестора увеличивается на
                     # количество купленных за операцию акций * долю инвестора в операции
-                    investor.stock_quantity += operation.quantity*share.value
+                    investor.stock_quantity += operation.quantity*share_value
                     # Количество денег уменьшается на
                     # (Стоимость операции + комиссия за операцию) * долю в операции
                     # P.S: стоимость операции - отрицательное число для покупок, а для продаж положительное,
                     # поэтому формулы одинаковые для покупки и продажи
-                    investor.capital += (operation.payment + operation.commission) * share.value
+                    investor.capital += (operation.payment + operation.commission) * share_value
                 else:
                     # Количество акций у инвестора уменьшается на
                     # количество проданых за операцию акций * долю инвестора в операции
-                    investor.stock_quantity -= operation.quantity*share.value/100
+                    investor.stock_quantity -= operation.quantity*share_value/100
                     # Количество денег у инвестора увеличивается на
                     # (Стоимость операции + комиссия за операцию) * долю в операции
-                    investor.capital += (operation.payment + operation.commission) * share.value
+                    investor.capital += (operation.payment + operation.commission) * share_value
+
+    def get_operation_shares(self, operation: T_OPERATIONS) -> Dict[T_INVESTOR, Decimal]:
+        """ Доли совладельцев в операции """
+        if self.share_resolver is not None:
+            return self.share_resolver.resolve(operation)
+        return {share.co_owner: share.value for share in operation.shares.all()}
 
     def add_operations(self, operations: T_OPERATIONS_QUERYSET) -> None:
         """ Добавляет список операций"""
-        for operation in operations.order_by('date'):
+        for operation in operations.order_by('date', 'pk'):
             self.add_operation(operation)
 
+    def restore_investor(self, investor: T_INVESTOR, stock_quantity: Decimal,
+                         capital: Decimal, last_dividend_share: Decimal) -> 'SmartInvestor':
+        """ Восстанавливает состояние инвестора, сохраненное после предыдущего расчета,
+            чтобы дальше добавлять только новые операции
+        """
+        smart_investor = self[investor]
+        smart_investor.stock_quantity = stock_quantity
+        smart_investor.capital = capital
+        smart_investor.last_dividend_share = last_dividend_share
+        return smart_investor
+
+    def copy(self) -> 'SmartInvestorSet':
+        """ Копия текущего состояния всех инвесторов """
+        smart_investor_set = SmartInvestorSet(self.share_resolver)
+        smart_investor_set.currency = self.currency
+        for investor in self:
+            smart_investor_set.restore_investor(
+                investor.investor, investor.stock_quantity, investor.capital, investor.last_dividend_share
+            )
+        return smart_investor_set
+
     def total_stock_quantity(self):
         """ Общее количество акций на руках инвесторов """
         return sum(map(operator.attrgetter('stock_quantity'), self.investors.values()))
@@ -91,6 +127,10 @@ class SmartInvestor:
         # Доля с последних дивидендов
         # Нужна чтобы расчитать, какую часть налога на дивиденды, инвестор должен отдать
         self.last_dividend_share = 0
+        # Дивиденды и комиссии, добавленные к капиталу с момента создания или восстановления инвестора.
+        # Нужны для записи в журнал движения денег совладельца (BalanceEntry)
+        self.dividend_income = Decimal(0)
+        self.commission = Decimal(0)
 
     @property
     def share_of_stock_quantity(self) -> Decimal:
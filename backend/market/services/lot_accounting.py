@@ -0,0 +1,150 @@
+""" Учет лотов сделки по методам FIFO и средней цены.
+    Транзакции сделки обрабатываются один раз по порядку, для каждого совладельца
+    считаются реализованный доход, открытые лоты и их стоимость (cost basis)
+"""
+import collections
+import logging
+from decimal import Decimal
+from typing import Dict, Iterable, List, Deque
+
+from django.utils.dateparse import parse_datetime
+
+from core.utils import is_proxy_instance
+from market.models_constraints import LotAccountingMethods
+from operations.models import PurchaseOperation, SaleOperation
+
+logger = logging.getLogger(__name__)
+
+
+class Lot:
+    """ Купленные за одну транзакцию ценные бумаги """
+    def __init__(self, date, quantity: Decimal, price: Decimal):
+        self.date = date
+        self.quantity = quantity
+        # Цена за штуку с учетом комиссии
+        self.price = price
+
+    @property
+    def cost(self) -> Decimal:
+        return self.quantity * self.price
+
+    def to_dict(self) -> Dict[str, str]:
+        return {'date': self.date.isoformat(), 'quantity': str(self.quantity), 'price': str(self.price)}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, str]) -> 'Lot':
+        return cls(parse_datetime(data['date']), Decimal(data['quantity']), Decimal(data['price']))
+
+
+class LotAccount:
+    """ Лоты одного совладельца по одному методу учета """
+    def __init__(self, method: str):
+        if method not in LotAccountingMethods.values:
+            raise ValueError(f'Неизвестный метод учета лотов: {method}')
+        self.method = method
+        self.lots: Deque[Lot] = collections.deque()
+        # Реализованный доход (выручка от продаж - стоимость проданных лотов)
+        self.realized_income = Decimal(0)
+
+    def buy(self, date, quantity: Decimal, price: Decimal) -> None:
+        if self.method == LotAccountingMethods.AVERAGE and self.lots:
+            # По средней цене все открытые бумаги - один лот
+            lot = self.lots[0]
+            total_cost = lot.cost + quantity * price
+            lot.quantity += quantity
+            lot.price = total_cost / lot.quantity
+        else:
+            self.lots.append(Lot(date, quantity, price))
+
+    def sell(self, date, quantity: Decimal, price: Decimal) -> Decimal:
+        """ Списывает лоты в порядке покупки
+        :return: реализованный доход с продажи
+        """
+        cost = Decimal(0)
+        left = quantity
+        while left > 0 and self.lots:
+            lot = self.lots[0]
+            sold = min(lot.quantity, left)
+            cost += sold * lot.price
+            lot.quantity -= sold
+            left -= sold
+            if lot.quantity == 0:
+                self.lots.popleft()
+        if left > 0:
+            logger.warning(f'Продано больше, чем было куплено ({date}): {left}')
+        income = quantity * price - cost
+        self.realized_income += income
+        return income
+
+    @property
+    def open_quantity(self) -> Decimal:
+        return sum((lot.quantity for lot in self.lots), Decimal(0))
+
+    @property
+    def cost_basis(self) -> Decimal:
+        """ Стоимость открытых лотов """
+        return sum((lot.cost for lot in self.lots), Decimal(0))
+
+    @property
+    def open_lots(self) -> List[Dict[str, str]]:
+        return [lot.to_dict() for lot in self.lots]
+
+
+class LotAccountingSet:
+    """ Лоты всех совладельцев одной сделки по всем методам учета """
+    def __init__(self, share_resolver: 'ShareResolver', methods: Iterable[str] = LotAccountingMethods.values):
+        self.share_resolver = share_resolver
+        self.methods = tuple(methods)
+        # Ключ - (совладелец, метод учета)
+        self.accounts: Dict[tuple, LotAccount] = {}
+
+    def __getitem__(self, item) -> LotAccount:
+        try:
+            return self.accounts[item]
+        except KeyError:
+            self.accounts[item] = LotAccount(item[1])
+            return self.accounts[item]
+
+    def restore_account(self, co_owner: 'users.CoOwner', method: str, open_lots: List[Dict[str, str]],
+                        realized_income: Decimal) -> LotAccount:
+        """ Восстанавливает лоты совладельца, сохраненные после предыдущего расчета,
+            чтобы дальше добавлять только новые операции
+        """
+        lot_account = self[co_owner, method]
+        lot_account.lots = collections.deque(Lot.from_dict(lot) for lot in open_lots)
+        lot_account.realized_income = realized_income
+        return lot_account
+
+    def add_transaction(self, operation: 'operations.Operation', date, quantity: int, price: Decimal) -> None:
+        """ Добавляет одну транзакцию операции покупки/продажи """
+        # Комиссия операции распределяется по транзакциям пропорционально количеству
+        commission_per_item = abs(operation.commission) / operation.quantity if operation.quantity else 0
+        is_purchase = is_proxy_instance(operation, PurchaseOperation)
+        for co_owner, share_value in self.share_resolver.resolve(operation).items():
+            co_owner_quantity = quantity * share_value
+            if not co_owner_quantity:
+                continue
+            for method in self.methods:
+                if is_purchase:
+                    self[co_owner, method].buy(date, co_owner_quantity, price + commission_per_item)
+                else:
+                    self[co_owner, method].sell(date, co_owner_quantity, price - commission_per_item)
+
+    def add_operations(self, operations: Iterable['operations.Operation']) -> None:
+        """ Добавляет операции покупки/продажи по порядку.
+            Транзакции операций (transaction_set) лучше получать через prefetch_related.
+            Если у операции нет транзакций, она считается одной транзакцией
+        """
+        for operation in operations:
+            if not is_proxy_instance(operation, (PurchaseOperation, SaleOperation)):
+                continue
+            transactions = sorted(operation.transaction_set.all(), key=lambda t: (t.date, t.pk))
+            if transactions:
+                for transaction in transactions:
+                    self.add_transaction(operation, transaction.date, transaction.quantity, transaction.price)
+            elif operation.quantity:
+                price = abs(operation.payment) / operation.quantity
+                self.add_transaction(operation, operation.date, operation.quantity, price)
+
+    def __iter__(self):
+        return iter(self.accounts.items())
@@ -0,0 +1,191 @@
+""" Отложенный перерасчет дохода сделок.
+    Сделки, у которых изменились доли в операциях, помечаются как "грязные",
+    а перерасчет запускается один раз для каждой сделки в конце запроса
+    (или фоновым обработчиком, если PROJECT_DEFERRED_RECALCULATION_MODE=worker).
+    Если запрос завершился ошибкой или перерасчет сделки не удался, сделка ставится в очередь
+    фоновому обработчику (manage.py worker), который разбирает очередь в обоих режимах
+"""
+import contextlib
+import datetime
+import logging
+import os
+import threading
+from typing import Iterable, Set
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Перерасчет в конце запроса
+MODE_REQUEST = 'request'
+# Перерасчет фоновым обработчиком (manage.py worker)
+MODE_WORKER = 'worker'
+
+# Пауза перед повтором перерасчета, завершившегося ошибкой, удваивается после каждой неудачи
+RETRY_DELAY = datetime.timedelta(minutes=1)
+MAX_RETRY_DELAY = datetime.timedelta(hours=1)
+
+_local = threading.local()
+
+
+def get_mode() -> str:
+    mode = os.getenv('PROJECT_DEFERRED_RECALCULATION_MODE', MODE_REQUEST)
+    if mode not in (MODE_REQUEST, MODE_WORKER):
+        raise ValueError(f'Неизвестный режим перерасчета сделок: {mode}')
+    return mode
+
+
+def _get_dirty_deals() -> Set[int]:
+    return getattr(_local, 'dirty_deals', None)
+
+
+@contextlib.contextmanager
+def deferred_recalculation():
+    """ Внутри блока перерасчет сделок откладывается до выхода из самого внешнего блока.
+        Если блок завершился исключением, сделки только ставятся в очередь, исключение не подменяется
+    """
+    if _get_dirty_deals() is not None:
+        yield
+        return
+    _local.dirty_deals = set()
+    try:
+        yield
+    except BaseException:
+        dirty_deals, _local.dirty_deals = _local.dirty_deals, None
+        enqueue(dirty_deals)
+        raise
+    dirty_deals, _local.dirty_deals = _local.dirty_deals, None
+    flush(dirty_deals)
+
+
+def enqueue_dirty_deals() -> None:
+    """ Ставит сделки, помеченные внутри deferred_recalculation, в очередь вместо перерасчета
+        при выходе из блока (запрос завершился ошибкой, часть изменений могла откатиться)
+    """
+    dirty_deals = _get_dirty_deals()
+    if dirty_deals:
+        enqueue(dirty_deals)
+        dirty_deals.clear()
+
+
+def mark_deals_dirty(deal_ids: Iterable[int]) -> None:
+    """ Помечает сделки, у которых надо пересчитать доход.
+        Вне deferred_recalculation перерасчет выполняется сразу
+    """
+    deal_ids = {deal_id for deal_id in deal_ids if deal_id is not None}
+    dirty_deals = _get_dirty_deals()
+    if dirty_deals is None:
+        flush(deal_ids)
+    else:
+        dirty_deals |= deal_ids
+
+
+def mark_deal_dirty(deal_id: int) -> None:
+    mark_deals_dirty((deal_id, ))
+
+
+def enqueue(deal_ids: Iterable[int]) -> None:
+    """ Ставит сделки в очередь фоновому обработчику """
+    deal_ids = set(deal_ids)
+    if not deal_ids:
+        return
+    try:
+        apps.get_model('market', 'Deal').objects.filter(pk__in=deal_ids).update(
+            is_recalculation_required=True, recalculation_retry_at=None
+        )
+    except Exception:
+        logger.exception(f'Не удалось поставить сделки {deal_ids} в очередь на перерасчет')
+        return
+    logger.info(f'Сделки {deal_ids} поставлены в очередь на перерасчет')
+
+
+def flush(deal_ids: Iterable[int]) -> None:
+    """ Перерасчет дохода сделок, каждая сделка пересчитывается один раз.
+        Ошибка перерасчета не прерывает вызывающий код: сделка ставится в очередь с паузой перед повтором
+    """
+    deal_ids = set(deal_ids)
+    if not deal_ids:
+        return
+    if get_mode() == MODE_WORKER:
+        enqueue(deal_ids)
+        return
+    deal_model = apps.get_model('market', 'Deal')
+    for deal in deal_model.objects.filter(pk__in=deal_ids):
+        try:
+            logger.info(f'Пересчет прибыли у {deal}')
+            with transaction.atomic():
+                deal.recalculation_income()
+        except Exception:
+            _postpone(deal)
+            continue
+        _reset_attempts(deal)
+
+
+def _postpone(deal: 'market.Deal') -> None:
+    """ Оставляет сделку в очереди после неудачного перерасчета с паузой перед повтором """
+    deal_model = apps.get_model('market', 'Deal')
+    attempts = deal.recalculation_attempts + 1
+    retry_at = timezone.now() + get_retry_delay(attempts)
+    logger.exception(f'Перерасчет {deal} не удался (попытка {attempts}), повтор после {retry_at}')
+    deal_model.objects.filter(pk=deal.pk).update(
+        is_recalculation_required=True, recalculation_attempts=F('recalculation_attempts') + 1,
+        recalculation_retry_at=retry_at
+    )
+
+
+def _reset_attempts(deal: 'market.Deal') -> None:
+    """ Сбрасывает счетчик неудачных попыток после успешного перерасчета """
+    if deal.recalculation_attempts:
+        apps.get_model('market', 'Deal').objects.filter(pk=deal.pk).update(
+            recalculation_attempts=0, recalculation_retry_at=None
+        )
+
+
+def get_retry_delay(attempts: int) -> datetime.timedelta:
+    """ Пауза перед следующей попыткой после attempts неудачных попыток """
+    return min(RETRY_DELAY * 2 ** max(attempts - 1, 0), MAX_RETRY_DELAY)
+
+
+def process_queue(batch_size: int = 100) -> int:
+    """ Пересчет сделок, поставленных в очередь, используется фоновым обработчиком.
+        Сделка, перерасчет которой завершился ошибкой, остается в очереди, но откладывается
+        (recalculation_retry_at), чтобы не задерживать остальные сделки
+    :param batch_size: максимальное количество сделок за один вызов
+    :return: количество пересчитанных сделок
+    """
+    deal_model = apps.get_model('market', 'Deal')
+    now = timezone.now()
+    deal_ids = list(
+        deal_model.objects
+        .filter(is_recalculation_required=True)
+        .filter(Q(recalculation_retry_at__isnull=True) | Q(recalculation_retry_at__lte=now))
+        .order_by('pk')
+        .values_list('pk', flat=True)[:batch_size]
+    )
+    processed = 0
+    for deal_id in deal_ids:
+        deal = deal_model.objects.filter(pk=deal_id).first()
+        if deal is None:
+            continue
+        try:
+            # Флаг снимается в одной транзакции с перерасчетом: если обработчик упадет, сделка останется
+            # в очереди. Строка сделки заблокирована до конца транзакции, поэтому изменения, пришедшие
+            # во время перерасчета, снова поставят сделку в очередь уже после него
+            with transaction.atomic():
+                taken = deal_model.objects.filter(pk=deal_id, is_recalculation_required=True).update(
+                    is_recalculation_required=False
+                )
+                if not taken:
+                    continue
+                deal.refresh_from_db()
+                logger.info(f'Пересчет прибыли у {deal}')
+                deal.recalculation_income()
+        except Exception:
+            _postpone(deal)
+            continue
+        _reset_attempts(deal)
+        processed += 1
+    return processed
@@ -0,0 +1,149 @@
+""" Доли совладельцев в операциях.
+    В обычном режиме для каждой пары (операция, совладелец) хранится запись Share.
+    В разреженном режиме (PROJECT_SPARSE_SHARES=1) хранятся только доли, которые отличаются
+    от доли по умолчанию, а остальные берутся из расписания долей (ShareSchedule)
+    или Capital.default_share в момент чтения
+"""
+import bisect
+import collections
+import datetime
+import decimal
+import operator
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.apps import apps
+from django.db import connection
+
+
+def is_sparse_storage() -> bool:
+    """ Хранятся ли только явно измененные доли """
+    return os.getenv('PROJECT_SPARSE_SHARES', '0').lower() in ('1', 'true', 'yes')
+
+
+class ShareScheduleIndex:
+    """ Индекс периодов действия долей (ShareSchedule).
+        Для каждой пары (совладелец, валюта) хранит отсортированные непересекающиеся периоды,
+        доля на любой момент времени находится бинарным поиском за O(log n)
+    """
+    def __init__(self, schedules: Iterable['users.ShareSchedule'] = ()):
+        # Ключ - (id совладельца, валюта), значение - начала периодов, отсортированные по возрастанию
+        self._starts: Dict[Tuple[int, str], List[datetime.datetime]] = collections.defaultdict(list)
+        # Ключ - (id совладельца, валюта), значение - (конец периода, доля) в том же порядке
+        self._periods: Dict[Tuple[int, str], List[Tuple[Optional[datetime.datetime], decimal.Decimal]]] = \
+            collections.defaultdict(list)
+        for schedule in sorted(schedules, key=operator.attrgetter('effective_from')):
+            self.add(schedule.co_owner_id, schedule.currency_id, schedule.effective_from,
+                     schedule.effective_to, schedule.value)
+
+    def add(self, co_owner_id: int, currency_id: str, effective_from: datetime.datetime,
+            effective_to: Optional[datetime.datetime], value: decimal.Decimal) -> None:
+        """ Добавляет период, периоды одного совладельца в одной валюте не должны пересекаться """
+        key = (co_owner_id, currency_id)
+        starts, periods = self._starts[key], self._periods[key]
+        position = bisect.bisect_right(starts, effective_from)
+        previous_end = periods[position - 1][0] if position else effective_from
+        is_overlapped = (
+            previous_end is None or previous_end > effective_from or
+            position < len(starts) and (effective_to is None or effective_to > starts[position])
+        )
+        if is_overlapped:
+            raise ValueError(f'Период доли {key} пересекается с другим периодом: {effective_from} - {effective_to}')
+        starts.insert(position, effective_from)
+        periods.insert(position, (effective_to, value))
+
+    def get(self, co_owner_id: int, currency_id: str, date: datetime.datetime) -> Optional[decimal.Decimal]:
+        """ Доля, действующая на момент date, или None, если ни один период не подходит """
+        key = (co_owner_id, currency_id)
+        starts = self._starts.get(key)
+        if not starts:
+            return None
+        position = bisect.bisect_right(starts, date) - 1
+        if position < 0:
+            return None
+        effective_to, value = self._periods[key][position]
+        if effective_to is not None and date >= effective_to:
+            return None
+        return value
+
+
+class ShareResolver:
+    """ Определение долей совладельцев в операциях одного ИС.
+        Явно заданные доли (Share) имеют приоритет над долями из расписания (ShareSchedule),
+        а они - над долями по умолчанию (Capital.default_share)
+    """
+    def __init__(self, investment_account_id: int, use_default_shares: bool = None):
+        """
+        :param investment_account_id: id ИС
+        :param use_default_shares: дополнять ли явно заданные доли долями по умолчанию,
+            если None - зависит от режима хранения долей
+        """
+        if use_default_shares is None:
+            use_default_shares = is_sparse_storage()
+        self.use_default_shares = use_default_shares
+        # Ключ - валюта, значение - словарь, где ключ - совладелец, значение - доля по умолчанию
+        self.default_shares: Dict[str, Dict['users.CoOwner', decimal.Decimal]] = collections.defaultdict(dict)
+        capital_model = apps.get_model('users', 'Capital')
+        capital_set = (
+            capital_model.objects
+            .filter(co_owner__investment_account_id=investment_account_id)
+            .select_related('co_owner')
+        )
+        for capital in capital_set:
+            self.default_shares[capital.currency_id][capital.co_owner] = capital.default_share
+        share_schedule_model = apps.get_model('users', 'ShareSchedule')
+        self.schedule_index = ShareScheduleIndex(
+            share_schedule_model.objects.filter(co_owner__investment_account_id=investment_account_id)
+        )
+
+    def get_default_shares(self, operation: 'operations.Operation') -> Dict['users.CoOwner', decimal.Decimal]:
+        """ Доли для операции, если они не заданы явно: из расписания на дату операции,
+            иначе доли по умолчанию для валюты операции
+        """
+        default_shares = {}
+        for co_owner, default_share in self.default_shares.get(operation.currency_id, {}).items():
+            scheduled_share = self.schedule_index.get(co_owner.pk, operation.currency_id, operation.date)
+            default_shares[co_owner] = default_share if scheduled_share is None else scheduled_share
+        return default_shares
+
+    def resolve(self, operation: 'operations.Operation') -> Dict['users.CoOwner', decimal.Decimal]:
+        """ Доли совладельцев в операции, operation.shares лучше получать через prefetch_related """
+        shares = dict(self.get_default_shares(operation)) if self.use_default_shares else {}
+        for share in operation.shares.all():
+            shares[share.co_owner] = share.value
+        return shares
+
+
+def get_effective_total_shares(operation_ids: Iterable[int],
+                               exclude_co_owner_id: Optional[int] = None) -> Dict[int, decimal.Decimal]:
+    """ Сумма долей всех совладельцев для каждой операции одним запросом.
+        Если доля совладельца не сохранена, берется доля из расписания или доля по умолчанию
+    :param exclude_co_owner_id: не учитывать долю этого совладельца
+    """
+    operation_ids = tuple(operation_ids)
+    if not operation_ids:
+        return {}
+    operation_model = apps.get_model('operations', 'Operation')
+    share_model = apps.get_model('operations', 'Share')
+    co_owner_model = apps.get_model('users', 'CoOwner')
+    capital_model = apps.get_model('users', 'Capital')
+    share_schedule_model = apps.get_model('users', 'ShareSchedule')
+    sql = f"""
+        SELECT operation.id, SUM(COALESCE(share.value, schedule.value, capital.default_share, 0))
+        FROM {operation_model._meta.db_table} AS operation
+        JOIN {co_owner_model._meta.db_table} AS co_owner
+            ON co_owner.investment_account_id = operation.investment_account_id
+        LEFT JOIN {share_model._meta.db_table} AS share
+            ON share.operation_id = operation.id AND share.co_owner_id = co_owner.id
+        LEFT JOIN {share_schedule_model._meta.db_table} AS schedule
+            ON schedule.co_owner_id = co_owner.id AND schedule.currency_id = operation.currency_id
+            AND schedule.effective_from <= operation.date
+            AND (schedule.effective_to IS NULL OR schedule.effective_to > operation.date)
+        LEFT JOIN {capital_model._meta.db_table} AS capital
+            ON capital.co_owner_id = co_owner.id AND capital.currency_id = operation.currency_id
+        WHERE operation.id IN %s AND co_owner.id IS DISTINCT FROM %s
+        GROUP BY operation.id
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [operation_ids, exclude_co_owner_id])
+        return dict(cursor.fetchall())
@@ -1,8 +1,4 @@
 from django import template
-from django.db import models
-from django.db.models import Sum, ExpressionWrapper
-
-from operations.models import SaleOperation, DividendOperation, PurchaseOperation
 
 register = template.Library()
 
@@ -32,26 +28,15 @@ def divide(value, arg):
     return value / arg
 
 
-# FIXME: Отпимизировать запрос и считать на бэке
 @register.filter
-def percent_profit_format(operations):
-    income = (
-        operations
-        .filter(proxy_instance_of=(SaleOperation, DividendOperation))
-        .aggregate(income=ExpressionWrapper(
-            Sum('payment') + Sum('commission') + Sum('dividend_tax'), output_field=models.DecimalField())
-        )
-    )['income']
-    expense = (
-        operations
-        .filter(proxy_instance_of=PurchaseOperation)
-        .aggregate(expense=Sum('payment') + Sum('commission'))
-    )['expense']
-    expense = abs(expense)
-    if income > expense:
+def percent_profit_format(deal):
+    """ Процент прибыли сделки, статистика сделки считается в Deal.objects.with_statistics() """
+    income = deal.income
+    expense = abs(deal.expense)
+    if income > expense and expense:
         percent_profit = ((income/expense)-1)*100
         return f'+{percent_profit:.2f}'
-    elif income < expense:
+    elif income < expense and income:
         percent_profit = (1-(expense/income))*100
         return f'{percent_profit:.2f}'
     return 0
@@ -2,36 +2,44 @@ from django import template
 from django.utils import timezone
 
 from core.utils import word2declension
+from users.services.portfolio import get_portfolio
 
 register = template.Library()
 
 
+def _get_position(context, figi):
+    """ Позиция по figi из портфеля ИС по умолчанию, портфель общий для всех тегов и представлений """
+    # У анонимного пользователя нет ИС по умолчанию
+    investment_account = getattr(context['request'].user, 'default_investment_account', None)
+    if investment_account is None:
+        return None
+    return get_portfolio(investment_account).get(figi)
+
+
 @register.simple_tag(takes_context=True)
 def expected_profit(context, figi):
-    portfolio = context['portfolio']
-    for asset in portfolio:
-        if figi == asset['figi']:
-            expected = asset['expectedYield']['value']
-            if expected > 0:
-                return f'+{expected}'
-            else:
-                return expected
+    asset = _get_position(context, figi)
+    if asset is not None:
+        expected = asset['expectedYield']['value']
+        if expected > 0:
+            return f'+{expected}'
+        else:
+            return expected
 
 
 @register.simple_tag(takes_context=True)
 def expected_percent_profit(context, figi):
-    portfolio = context['portfolio']
-    for asset in portfolio:
-        if figi == asset['figi']:
-            price = asset['averagePositionPrice']['value'] * asset['balance']
-            expected_price = price + asset['expectedYield']['value']
-            if price < expected_price:
-                income = ((expected_price / price)-1) * 100
-                return f'+{income:.2f}'
-            elif price > expected_price:
-                expense = (1-(expected_price / price)) * 100
-                return f'-{expense:.2f}'
-            return 0
+    asset = _get_position(context, figi)
+    if asset is not None:
+        price = asset['averagePositionPrice']['value'] * asset['balance']
+        expected_price = price + asset['expectedYield']['value']
+        if price < expected_price:
+            income = ((expected_price / price)-1) * 100
+            return f'+{income:.2f}'
+        elif price > expected_price:
+            expense = (1-(expected_price / price)) * 100
+            return f'-{expense:.2f}'
+        return 0
 
 
 @register.simple_tag(takes_context=AttributeError)
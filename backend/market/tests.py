@@ -1,3 +1,331 @@
+import base64
+import datetime
+import decimal
+import os
+from unittest import mock
+
+import pytz
 from django.test import TestCase
+from django.utils import timezone
+
+from market.models import Deal, DealIncome, StockInstrument
+from market.models_constraints import LotAccountingMethods
+from market.services.income_calculation import SmartInvestorSet
+from market.services import recalculation_queue
+from market.services.lot_accounting import LotAccount
+from market.services.shares import ShareScheduleIndex
+from market.views import _encode_cursor, _decode_cursor
+from operations.models import Currency, InvestmentAccountPurchaseOperation, SaleOperation, DividendOperation, \
+    Operation, Share
+from users.models import Investor, InvestmentAccount, CoOwner, ShareSchedule
+
+D = decimal.Decimal
+
+
+class DealTestCase(TestCase):
+    """ ИС с двумя совладельцами и сделкой по одной акции """
+    start = datetime.datetime(2020, 1, 1, tzinfo=pytz.UTC)
+
+    @classmethod
+    def setUpTestData(cls):
+        for iso_code in ('RUB', 'USD'):
+            Currency.objects.get_or_create(iso_code=iso_code, defaults={'abbreviation': iso_code, 'name': iso_code})
+        cls.instrument = StockInstrument.objects.create(
+            figi='FIGI1', name='Stock', ticker='STK', lot=1, currency_id='USD', isin='ISIN1'
+        )
+        creator = Investor.objects.create(username='creator')
+        cls.investment_account = InvestmentAccount.objects.create(
+            name='account', creator=creator, token='token', broker_account_id='broker'
+        )
+        CoOwner.objects.create(investor=Investor.objects.create(username='co_owner'),
+                               investment_account=cls.investment_account)
+        cls.co_owners = list(CoOwner.objects.filter(investment_account=cls.investment_account).order_by('pk'))
+
+    def setUp(self):
+        # Перерасчет только по явному вызову
+        patcher = mock.patch.dict(os.environ, {'PROJECT_DEFERRED_RECALCULATION_MODE': 'worker'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.deal = Deal.objects.create(instrument=self.instrument, investment_account=self.investment_account)
+        self.operations_count = 0
+
+    def add_operation(self, model, hours: int, shares=(D('0.6'), D('0.4')), **fields) -> Operation:
+        """ Операция сделки через hours часов от начала с долями совладельцев shares """
+        self.operations_count += 1
+        operation = model.objects.create(
+            investment_account=self.investment_account, deal=self.deal, instrument=self.instrument,
+            currency_id='USD', date=self.start + datetime.timedelta(hours=hours),
+            _id=f'operation{self.operations_count}', **fields
+        )
+        Share.objects.bulk_create(
+            Share(operation=operation, co_owner=co_owner, value=value)
+            for co_owner, value in zip(self.co_owners, shares)
+        )
+        return operation
+
+    def purchase(self, hours: int, quantity: int, price: int, **kwargs) -> Operation:
+        return self.add_operation(InvestmentAccountPurchaseOperation, hours, payment=-quantity * price,
+                                  quantity=quantity, commission=-1, **kwargs)
+
+    def sale(self, hours: int, quantity: int, price: int, **kwargs) -> Operation:
+        return self.add_operation(SaleOperation, hours, payment=quantity * price,
+                                  quantity=quantity, commission=-1, **kwargs)
+
+    def dividend(self, hours: int, payment: int, **kwargs) -> Operation:
+        return self.add_operation(DividendOperation, hours, payment=payment, dividend_tax=-1, **kwargs)
+
+    def get_income_state(self):
+        return {
+            deal_income.co_owner_id: (deal_income.value, deal_income.stock_quantity, deal_income.last_dividend_share)
+            for deal_income in DealIncome.objects.filter(deal=self.deal)
+        }
+
+
+class RecalculationIncomeTests(DealTestCase):
+    def recalculate(self, full=False) -> int:
+        """ Перерасчет дохода сделки
+        :return: сколько операций было проиграно
+        """
+        with mock.patch.object(SmartInvestorSet, 'add_operation', autospec=True,
+                               side_effect=SmartInvestorSet.add_operation) as add_operation:
+            self.deal.refresh_from_db()
+            self.deal.recalculation_income(full=full)
+        return add_operation.call_count
+
+    def assert_equal_to_full(self):
+        """ Состояние после перерасчета совпадает с полным перерасчетом всех операций """
+        incremental = self.get_income_state()
+        self.recalculate(full=True)
+        self.assertEqual(incremental, self.get_income_state())
+
+    def test_incremental_equals_full(self):
+        self.purchase(1, 10, 100)
+        self.purchase(2, 5, 110, shares=(D('0.5'), D('0.5')))
+        self.dividend(3, 20)
+        self.assertEqual(self.recalculate(), 3)
+        self.sale(4, 8, 120)
+        self.dividend(5, 10)
+        self.sale(6, 3, 90, shares=(D(1), D(0)))
+        self.assertEqual(self.recalculate(), 3)
+        self.assert_equal_to_full()
+
+    def test_backdated_operation(self):
+        self.purchase(1, 10, 100)
+        self.dividend(3, 20)
+        self.sale(4, 4, 120)
+        self.recalculate()
+        # Операция задним числом получает id больше последней учтенной
+        self.purchase(2, 6, 105, shares=(D('0.2'), D('0.8')))
+        self.sale(5, 3, 130)
+        self.assertEqual(self.recalculate(), 5)
+        self.assert_equal_to_full()
+
+    def test_removed_operation(self):
+        self.purchase(1, 10, 100)
+        dividend = self.dividend(2, 20)
+        self.sale(3, 4, 120)
+        self.recalculate()
+        Operation.objects.filter(pk=dividend.pk).update(deal=None)
+        self.purchase(4, 2, 110)
+        self.assertEqual(self.recalculate(), 3)
+        self.assert_equal_to_full()
+
+
+class LotAccountTests(TestCase):
+    date = datetime.datetime(2020, 1, 1, tzinfo=pytz.UTC)
+
+    def get_account(self, method: str) -> LotAccount:
+        lot_account = LotAccount(method)
+        lot_account.buy(self.date, D(10), D(100))
+        lot_account.buy(self.date, D(10), D(120))
+        return lot_account
+
+    def test_fifo(self):
+        lot_account = self.get_account(LotAccountingMethods.FIFO)
+        # Сначала списывается первый лот целиком, потом половина второго
+        self.assertEqual(lot_account.sell(self.date, D(15), D(130)), D(15 * 130 - 10 * 100 - 5 * 120))
+        self.assertEqual(lot_account.open_quantity, D(5))
+        self.assertEqual(lot_account.cost_basis, D(5 * 120))
+        self.assertEqual(len(lot_account.open_lots), 1)
+
+    def test_average(self):
+        lot_account = self.get_account(LotAccountingMethods.AVERAGE)
+        self.assertEqual(len(lot_account.open_lots), 1)
+        self.assertEqual(lot_account.sell(self.date, D(15), D(130)), D(15 * 130 - 15 * 110))
+        self.assertEqual(lot_account.open_quantity, D(5))
+        self.assertEqual(lot_account.cost_basis, D(5 * 110))
+        self.assertEqual(lot_account.realized_income, D(15 * 20))
+
+    def test_oversell(self):
+        for method in LotAccountingMethods.values:
+            with self.subTest(method=method):
+                lot_account = self.get_account(method)
+                with self.assertLogs('market.services.lot_accounting', 'WARNING'):
+                    income = lot_account.sell(self.date, D(25), D(130))
+                # Проданное сверх купленного считается без стоимости
+                self.assertEqual(income, D(25 * 130 - 10 * 100 - 10 * 120))
+                self.assertEqual(lot_account.open_quantity, 0)
+                self.assertEqual(lot_account.cost_basis, 0)
+                lot_account.buy(self.date, D(2), D(90))
+                self.assertEqual(lot_account.cost_basis, D(2 * 90))
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            LotAccount('LIFO')
+
+
+class ShareScheduleIndexTests(TestCase):
+    def setUp(self):
+        self.index = ShareScheduleIndex()
+        self.january, self.february, self.march, self.may = (
+            datetime.datetime(2020, month, 1, tzinfo=pytz.UTC) for month in (1, 2, 3, 5)
+        )
+        self.index.add(1, 'USD', self.january, self.february, D('0.1'))
+        # Следующий период начинается ровно в конце предыдущего
+        self.index.add(1, 'USD', self.february, self.march, D('0.2'))
+        # Бессрочный период после промежутка
+        self.index.add(1, 'USD', self.may, None, D('0.3'))
+
+    def test_boundaries(self):
+        second = datetime.timedelta(seconds=1)
+        cases = [
+            (self.january - second, None),
+            (self.january, D('0.1')),
+            (self.february - second, D('0.1')),
+            (self.february, D('0.2')),
+            (self.march - second, D('0.2')),
+            (self.march, None),
+            (self.may - second, None),
+            (self.may, D('0.3')),
+            (datetime.datetime(2100, 1, 1, tzinfo=pytz.UTC), D('0.3')),
+        ]
+        for date, value in cases:
+            with self.subTest(date=date):
+                self.assertEqual(self.index.get(1, 'USD', date), value)
+
+    def test_other_key(self):
+        self.assertIsNone(self.index.get(2, 'USD', self.january))
+        self.assertIsNone(self.index.get(1, 'RUB', self.january))
+
+    def test_overlap(self):
+        overlapped = [
+            (self.january - datetime.timedelta(days=1), self.january + datetime.timedelta(days=1)),
+            (self.march - datetime.timedelta(days=1), self.may),
+            (self.march, self.may + datetime.timedelta(days=1)),
+            (self.march, None),
+            (datetime.datetime(2021, 1, 1, tzinfo=pytz.UTC), None),
+        ]
+        for effective_from, effective_to in overlapped:
+            with self.subTest(effective_from=effective_from, effective_to=effective_to):
+                with self.assertRaises(ValueError):
+                    self.index.add(1, 'USD', effective_from, effective_to, D('0.5'))
+        # Промежуток между периодами можно заполнить целиком
+        self.index.add(1, 'USD', self.march, self.may, D('0.4'))
+        self.assertEqual(self.index.get(1, 'USD', self.march), D('0.4'))
+
+
+class ShareScheduleTests(DealTestCase):
+    def test_dense_shares_rewritten(self):
+        """ При обычном хранении долей расписание переписывает доли операций за свой период """
+        operations = [self.purchase(hours, 1, 100) for hours in (1, 2, 3)]
+        self.deal.recalculation_income(full=True)
+        co_owner = self.co_owners[1]
+        schedule = ShareSchedule.objects.create(
+            co_owner=co_owner, currency_id='USD', value=D('0.3'),
+            effective_from=operations[0].date, effective_to=operations[2].date
+        )
+        with mock.patch.dict(os.environ, {'PROJECT_SPARSE_SHARES': '0'}):
+            self.investment_account.update_shares_by_schedule(
+                co_owner.pk, 'USD', schedule.effective_from, schedule.effective_to
+            )
+        shares = Share.objects.filter(co_owner=co_owner).order_by('operation__date').values_list('value', flat=True)
+        self.assertEqual(list(shares), [D('0.3'), D('0.3'), D('0.4')])
+        self.deal.refresh_from_db()
+        self.assertFalse(self.deal.is_income_state_actual)
+        self.assertTrue(self.deal.is_recalculation_required)
+
+
+class OperationsCursorTests(TestCase):
+    def test_round_trip(self):
+        operation = Operation(pk=42, date=datetime.datetime(2020, 1, 1, 12, 30, tzinfo=pytz.UTC))
+        self.assertEqual(_decode_cursor(_encode_cursor(operation)), (operation.date, 42))
+
+    def test_malformed(self):
+        def encode(value: bytes) -> str:
+            return base64.urlsafe_b64encode(value).decode()
+
+        cursors = [
+            '',
+            'abc',
+            'не base64',
+            encode(b'\xff\xfe|1'),
+            encode(b'2020-01-01T12:30:00+00:00'),
+            encode(b'2020-01-01T12:30:00+00:00|1|2'),
+            encode(b'not a date|1'),
+            encode(b'2020-13-01T12:30:00+00:00|1'),
+            encode(b'2020-01-01T12:30:00+00:00|id'),
+        ]
+        for cursor in cursors:
+            with self.subTest(cursor=cursor):
+                self.assertIsNone(_decode_cursor(cursor))
+
+
+class RecalculationQueueTests(DealTestCase):
+    def setUp(self):
+        super().setUp()
+        Deal.objects.filter(pk=self.deal.pk).update(is_recalculation_required=True)
+
+    def process_queue(self, side_effect=None) -> int:
+        with mock.patch.object(Deal, 'recalculation_income', side_effect=side_effect) as recalculation_income:
+            processed = recalculation_queue.process_queue()
+        self.recalculation_calls = recalculation_income.call_count
+        self.deal.refresh_from_db()
+        return processed
+
+    def fail_queue(self) -> int:
+        with self.assertLogs('market.services.recalculation_queue', 'ERROR'):
+            return self.process_queue(RuntimeError)
+
+    def assert_postponed(self, attempts: int):
+        self.assertTrue(self.deal.is_recalculation_required)
+        self.assertEqual(self.deal.recalculation_attempts, attempts)
+        delay = self.deal.recalculation_retry_at - timezone.now()
+        expected_delay = recalculation_queue.get_retry_delay(attempts)
+        self.assertTrue(expected_delay - datetime.timedelta(seconds=10) < delay <= expected_delay, delay)
+
+    def test_retry_with_backoff(self):
+        self.assertEqual(self.fail_queue(), 0)
+        self.assert_postponed(1)
+        # До истечения паузы сделка не берется
+        self.assertEqual(self.process_queue(), 0)
+        self.assertEqual(self.recalculation_calls, 0)
+
+        Deal.objects.filter(pk=self.deal.pk).update(recalculation_retry_at=timezone.now())
+        self.assertEqual(self.fail_queue(), 0)
+        self.assert_postponed(2)
+
+        Deal.objects.filter(pk=self.deal.pk).update(recalculation_retry_at=timezone.now())
+        self.assertEqual(self.process_queue(), 1)
+        self.assertFalse(self.deal.is_recalculation_required)
+        self.assertEqual(self.deal.recalculation_attempts, 0)
+        self.assertIsNone(self.deal.recalculation_retry_at)
+
+    def test_retry_delay(self):
+        delays = [recalculation_queue.get_retry_delay(attempts) for attempts in range(1, 10)]
+        self.assertEqual(delays[0], recalculation_queue.RETRY_DELAY)
+        self.assertEqual(delays[1], recalculation_queue.RETRY_DELAY * 2)
+        self.assertEqual(delays[-1], recalculation_queue.MAX_RETRY_DELAY)
+        self.assertEqual(delays, sorted(delays))
 
-# Create your tests here.
+    def test_failed_block_enqueues(self):
+        """ Исключение внутри deferred_recalculation не подменяется, сделки ставятся в очередь """
+        Deal.objects.filter(pk=self.deal.pk).update(is_recalculation_required=False)
+        with mock.patch.dict(os.environ, {'PROJECT_DEFERRED_RECALCULATION_MODE': 'request'}), \
+                mock.patch.object(Deal, 'recalculation_income') as recalculation_income:
+            with self.assertRaises(KeyError):
+                with recalculation_queue.deferred_recalculation():
+                    recalculation_queue.mark_deal_dirty(self.deal.pk)
+                    raise KeyError
+        self.assertFalse(recalculation_income.called)
+        self.deal.refresh_from_db()
+        self.assertTrue(self.deal.is_recalculation_required)
@@ -1,14 +1,20 @@
+import base64
+import binascii
+import datetime
 import logging
+import os
+from typing import Optional, Tuple
 
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Max, Sum, Min, F, Subquery, OuterRef
+from django.db.models import Sum, F, Q
 from django.db.models.functions import Coalesce
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import make_aware
 from django.views.generic import TemplateView, ListView, RedirectView
 
-from market.models import StockInstrument, Deal, InstrumentType
-from operations.models import Operation
-from tinkoff_api import TinkoffProfile
+from market.models import StockInstrument, Deal
+from operations.models import Operation, Currency
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +22,8 @@ logger = logging.getLogger(__name__)
 class UpdateInvestmentAccountMixin:
     def get(self, *args, **kwargs):
         self.investment_account = getattr(self.request.user, 'default_investment_account', None)
-        if self.investment_account:
+        # Пока идет импорт нового ИС, синхронизацию выполняет только фоновый обработчик
+        if self.investment_account and self.investment_account.is_imported:
             self.investment_account.update_portfolio()
         return super().get(*args, **kwargs)
 
@@ -32,31 +39,85 @@ class IndexView(LoginRequiredMixin, RedirectView):
     pattern_name = 'operations'
 
 
+def _encode_cursor(operation: Operation) -> str:
+    """ Курсор страницы - дата и id последней операции на странице """
+    return base64.urlsafe_b64encode(f'{operation.date.isoformat()}|{operation.pk}'.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Optional[Tuple[datetime.datetime, int]]:
+    try:
+        date, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        date = parse_datetime(date)
+        return (date, int(pk)) if date is not None else None
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return None
+
+
 class OperationsView(LoginRequiredMixin, UpdateInvestmentAccountMixin, ListView):
+    """ Операции ИС постранично, страницы выбираются по курсору (дата, id), а не по OFFSET,
+        поэтому время ответа не зависит от количества операций.
+        Фильтры (GET параметры): type (можно несколько), figi, currency, date_from, date_to
+    """
     template_name = 'operations.html'
     context_object_name = 'operations'
     model = Operation
 
+    @staticmethod
+    def get_page_size() -> int:
+        return int(os.getenv('PROJECT_OPERATIONS_PAGE_SIZE', 50))
+
+    def get_filters(self) -> Q:
+        """ Фильтры из GET параметров, неизвестные значения игнорируются """
+        params = self.request.GET
+        filters = Q()
+        types = [i for i in params.getlist('type') if i in Operation.Types.values]
+        if types:
+            filters &= Q(type__in=types)
+        if params.get('figi'):
+            filters &= Q(instrument_id=params['figi'])
+        if params.get('currency'):
+            filters &= Q(currency_id=params['currency'])
+        date_from = parse_date(params.get('date_from', ''))
+        if date_from is not None:
+            filters &= Q(date__gte=make_aware(datetime.datetime.combine(date_from, datetime.time.min)))
+        date_to = parse_date(params.get('date_to', ''))
+        if date_to is not None:
+            filters &= Q(date__lt=make_aware(datetime.datetime.combine(date_to, datetime.time.min)) +
+                         datetime.timedelta(days=1))
+        return filters
+
     def get_queryset(self):
-        figi = self.request.GET.get('figi')
-        try:
-            instrument_object = InstrumentType.objects.get(figi=figi)
-        except ObjectDoesNotExist:
-            queryset = Operation.objects.filter(
-                investment_account=self.investment_account,
-            ).select_related()
-        else:
-            queryset = Operation.objects.filter(
-                investment_account=self.investment_account,
-                instrument=instrument_object
-            ).select_related()
-        # XXX
-        return (
-            queryset
+        queryset = (
+            Operation.objects
+            .filter(self.get_filters(), investment_account=self.investment_account)
             .annotate(lots=F('quantity')/Coalesce(F('instrument__lot'), 1))
             .select_related('currency', 'instrument')
-            .distinct().order_by('-date')
+            .prefetch_related('shares__co_owner__investor')
+            .order_by('-date', '-pk')
         )
+        cursor = _decode_cursor(self.request.GET.get('cursor', ''))
+        if cursor is not None:
+            date, pk = cursor
+            queryset = queryset.filter(Q(date__lt=date) | Q(date=date, pk__lt=pk))
+        page_size = self.get_page_size()
+        # Лишняя операция нужна только чтобы узнать, есть ли следующая страница
+        operations = list(queryset[:page_size + 1])
+        self.next_cursor = _encode_cursor(operations[page_size - 1]) if len(operations) > page_size else None
+        return operations[:page_size]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        params = self.request.GET.copy()
+        params.pop('cursor', None)
+        context['has_filters'] = bool(params)
+        context['filter_types'] = Operation.Types.choices
+        # type может быть передан несколько раз, выбранные значения сравниваются целиком
+        context['selected_types'] = self.request.GET.getlist('type')
+        context['filter_currencies'] = Currency.objects.values_list('iso_code', flat=True)
+        if self.next_cursor is not None:
+            params['cursor'] = self.next_cursor
+            context['next_page_query'] = params.urlencode()
+        return context
 
 
 class DealsView(LoginRequiredMixin, UpdateInvestmentAccountMixin, TemplateView):
@@ -70,47 +131,39 @@ class DealsView(LoginRequiredMixin, UpdateInvestmentAccountMixin, TemplateView):
         except ObjectDoesNotExist:
             queryset = Deal.objects.filter(investment_account=self.investment_account)
         else:
-            queryset = Deal.objects.filter(investment_account=self.investment_account, figi=figi_object)
+            queryset = Deal.objects.filter(investment_account=self.investment_account, instrument=figi_object)
 
         context = super().get_context_data(**kwargs)
         opened_deals = list(
             queryset.opened()
             .annotate(
-                earliest_operation_date=Min('operations__date'),
+                earliest_operation_date=F('opened_at'),
                 instrument_name=F('instrument__name'),
                 instrument_figi=F('instrument__figi'),
-                abbreviation=Subquery(
-                    Operation.objects.filter(deal=OuterRef('pk')).values('currency__abbreviation')[:1]
-                )
+                abbreviation=F('currency__abbreviation')
             )
-            .order_by('-earliest_operation_date')
+            .order_by('-opened_at')
             .values()
         )
         if self.investment_account:
-            with TinkoffProfile(self.investment_account.token) as tp:
-                portfolio = tp.portfolio()['payload']['positions']
-                portfolio = {i['figi']: i for i in portfolio}
+            # Позиции портфеля обновляются при синхронизации, см. Updater.update_holdings
+            holdings = {holding.instrument_id: holding for holding in self.investment_account.holdings.all()}
             for deal in opened_deals:
-                figi_figi = deal['instrument_figi']
-                asset = portfolio[figi_figi]
-                price = asset['averagePositionPrice']['value'] * asset['balance']
-                expected_price = price + asset['expectedYield']['value']
-                if price < expected_price:
-                    deal['expected_percent_profit'] = ((expected_price / price)-1)*100
-                else:
-                    deal['expected_percent_profit'] = -(1-(expected_price/price))*100
-                deal['expected_profit'] = asset['expectedYield']['value']
-                deal['lots_left'] = asset['lots']
+                holding = holdings.get(deal['instrument_figi'])
+                if holding is None:
+                    continue
+                deal['expected_percent_profit'] = holding.expected_percent_profit
+                deal['expected_profit'] = holding.expected_yield
+                deal['lots_left'] = holding.lots
         context['opened_deals'] = opened_deals
         context['closed_deals'] = (
             queryset.closed()
+            .with_statistics()
             .annotate(
-                latest_operation_date=Max('operations__date'),
-                earliest_operation_date=Min('operations__date'),
-                abbreviation=Subquery(
-                    Operation.objects.filter(deal=OuterRef('pk')).values('currency__abbreviation')[:1]
-                ),
+                latest_operation_date=F('closed_at'),
+                earliest_operation_date=F('opened_at'),
+                abbreviation=F('currency__abbreviation'),
                 profit=Sum('operations__payment')+Sum('operations__commission'))
-            .order_by('-latest_operation_date')
-        ).select_related('instrument').distinct()
+            .order_by('-closed_at')
+        ).select_related('instrument')
         return context
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0003_operation_co_owners'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(fields=['investment_account', 'date', 'id'], name='operation_account_date'),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(fields=['investment_account', 'type', 'date', 'id'], name='operation_account_type'),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(fields=['investment_account', 'instrument', 'date', 'id'], name='operation_account_instrument'),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(fields=['investment_account', 'currency', 'date', 'id'], name='operation_account_currency'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0004_auto_20261019_0906'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(condition=models.Q(('deal__isnull', True), models.Q(('type', 'Buy'), ('type', 'BuyCard'), ('type', 'Sell'), ('type', 'Dividend'), _connector='OR')), fields=['investment_account', 'date'], name='operation_without_deal'),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(condition=models.Q(('dividend_tax_date__isnull', True), ('type', 'Dividend')), fields=['investment_account', 'instrument', 'date'], name='dividend_without_tax'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0005_auto_20261019_0913'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='operation',
+            name='unique_id_$(class)s',
+        ),
+        migrations.AddConstraint(
+            model_name='operation',
+            constraint=models.UniqueConstraint(condition=models.Q(_id='', _negated=True), fields=('investment_account', '_id'), name='unique_id_$(class)s'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.8 on 2026-10-19 07:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0006_auto_20261019_0915'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='share',
+            name='operation',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='shares', to='operations.Operation', verbose_name='Операция'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='operation',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='operations.Operation', verbose_name='Операция'),
+        ),
+    ]
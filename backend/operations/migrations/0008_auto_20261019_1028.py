@@ -0,0 +1,26 @@
+# Generated by Django 3.0.8 on 2026-10-19 07:28
+
+from django.db import migrations
+
+from operations.services.partitioning import get_partitions_count, partition_operations
+
+
+def partition_if_enabled(apps, schema_editor):
+    """ Секционирование таблицы операций, если задан PROJECT_OPERATION_PARTITIONS """
+    partitions = get_partitions_count()
+    if partitions and schema_editor.connection.vendor == 'postgresql':
+        table = apps.get_model('operations', 'Operation')._meta.db_table
+        partition_operations(schema_editor.connection, table, partitions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0007_auto_20261019_1027'),
+        # На операции больше не ссылаются внешние ключи сделок
+        ('market', '0019_auto_20261019_1027'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_if_enabled, migrations.RunPython.noop),
+    ]
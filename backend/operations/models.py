@@ -1,5 +1,6 @@
 from django.core.validators import MaxValueValidator
 from django.db import models
+from django.db.models import Q
 
 from core.utils import ProxyInheritanceManager
 from operations.models_constraints import OperationTypes, OperationConstraints, OperationStatuses
@@ -29,6 +30,30 @@ class Operation(models.Model):
         verbose_name_plural = 'Операции'
         ordering = ('date', )
         constraints = OperationConstraints.ALL_CONSTRAINTS
+        # Для постраничного вывода операций ИС по курсору (дата, id) с фильтрами
+        indexes = [
+            models.Index(fields=('investment_account', 'date', 'id'), name='operation_account_date'),
+            models.Index(fields=('investment_account', 'type', 'date', 'id'), name='operation_account_type'),
+            models.Index(
+                fields=('investment_account', 'instrument', 'date', 'id'), name='operation_account_instrument'
+            ),
+            models.Index(fields=('investment_account', 'currency', 'date', 'id'), name='operation_account_currency'),
+            # Операции, еще не добавленные в сделки (Updater.update_deals).
+            # Типы перечислены через OR, а не IN: по IN для varchar PostgreSQL не может доказать,
+            # что условие запроса подходит под условие индекса
+            models.Index(
+                fields=('investment_account', 'date'), name='operation_without_deal',
+                condition=Q(deal__isnull=True) & (
+                    Q(type=OperationTypes.BUY) | Q(type=OperationTypes.BUY_CARD) |
+                    Q(type=OperationTypes.SELL) | Q(type=OperationTypes.DIVIDEND)
+                )
+            ),
+            # Дивиденды, к которым еще не привязан налог (Updater.process_secondary_operations)
+            models.Index(
+                fields=('investment_account', 'instrument', 'date'), name='dividend_without_tax',
+                condition=Q(type=OperationTypes.DIVIDEND, dividend_tax_date__isnull=True)
+            )
+        ]
 
     objects = ProxyInheritanceManager()
     proxy_constraints = OperationConstraints
@@ -153,7 +178,8 @@ class Transaction(models.Model):
         verbose_name_plural = 'Транзакции'
 
     id = models.CharField(verbose_name='ID', max_length=32, primary_key=True)
-    operation = models.ForeignKey(Operation, verbose_name='Операция', on_delete=models.CASCADE)
+    # Без внешнего ключа в БД, см. operations.services.partitioning
+    operation = models.ForeignKey(Operation, verbose_name='Операция', on_delete=models.CASCADE, db_constraint=False)
     date = models.DateTimeField(verbose_name='Дата')
     quantity = models.PositiveIntegerField(verbose_name='Количество шт.')
     price = models.DecimalField(verbose_name='Цена/шт.', max_digits=20, decimal_places=4)
@@ -204,8 +230,9 @@ class Share(models.Model):
         ]
         ordering = ['pk']
 
+    # Без внешнего ключа в БД, см. operations.services.partitioning
     operation = models.ForeignKey(Operation, verbose_name='Операция',
-                                  on_delete=models.CASCADE, related_name='shares')
+                                  on_delete=models.CASCADE, related_name='shares', db_constraint=False)
     co_owner = models.ForeignKey('users.CoOwner', verbose_name='Совладелец',
                                  on_delete=models.CASCADE, related_name='shares')
     value = models.DecimalField(verbose_name='Доля', max_digits=9, decimal_places=8)
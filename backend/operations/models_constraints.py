@@ -130,7 +130,9 @@ class OperationConstraints:
     ALL_PROXY_CONSTRAINTS |= Q(type=OperationTypes.UNKNOWN)
     ALL_CONSTRAINTS = [
         models.UniqueConstraint(fields=('investment_account', 'type', 'date'), name='unique_%(class)s'),
-        models.UniqueConstraint(fields=('_id',), condition=~Q(_id=''), name='unique_id_$(class)s'),
+        # id операции в Tinkoff API уникален в пределах брокерского счета.
+        # ИС входит в ограничение, чтобы оно работало и при секционировании таблицы по ИС
+        models.UniqueConstraint(fields=('investment_account', '_id'), condition=~Q(_id=''), name='unique_id_$(class)s'),
         models.UniqueConstraint(fields=('investment_account', 'type', 'instrument', 'dividend_tax_date'),
                                 condition=Q(dividend_tax_date__isnull=False), name='unique_div_tax_date'),
         models.CheckConstraint(
@@ -0,0 +1,123 @@
+""" Декларативное секционирование таблицы операций PostgreSQL по хешу ИС.
+    Таблица секционируется миграцией, если задан PROJECT_OPERATION_PARTITIONS,
+    или командой manage.py partition_operations для уже развернутой БД.
+    Первичный ключ секционированной таблицы дополняется investment_account_id, поэтому сослаться
+    на операцию внешним ключом по одному id нельзя: ссылки на операции (доли, транзакции, сделки,
+    контрольные точки дохода) объявлены с db_constraint=False и без секционирования.
+    Целостность ссылок обеспечивает приложение: связанные строки удаляет Django (on_delete),
+    фоновое удаление ИС (users.services.account_deletion) удаляет их раньше операций.
+    Уникальные ограничения операций содержат investment_account_id и переносятся на секционированную таблицу,
+    запросы операций одного ИС обращаются к одной секции
+"""
+import logging
+import os
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Поле, по хешу которого секционируется таблица операций
+PARTITION_KEY = 'investment_account_id'
+
+
+def get_partitions_count() -> int:
+    """ Количество секций, на которое миграция делит таблицу операций, 0 - не секционировать """
+    return int(os.getenv('PROJECT_OPERATION_PARTITIONS', 0))
+
+
+def is_partitioned(connection, table: str) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [table])
+        return cursor.fetchone() is not None
+
+
+def check_partitioning(connection, table: str) -> None:
+    """ Проверяет, что секционирование ничего не ослабит
+    :raise ValueError: на таблицу ссылаются внешние ключи или уникальный индекс не содержит ключ секционирования
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT conrelid::regclass, conname
+            FROM pg_constraint
+            WHERE confrelid = %s::regclass AND contype = 'f'
+        """, [table])
+        referencing_keys = [f'{name} ({referencing_table})' for referencing_table, name in cursor.fetchall()]
+        if referencing_keys:
+            raise ValueError(
+                'На операции ссылаются внешние ключи, которые нельзя перенести на секционированную таблицу: '
+                + ', '.join(referencing_keys)
+            )
+        cursor.execute("""
+            SELECT index.indexrelid::regclass
+            FROM pg_index AS index
+            JOIN pg_attribute AS attribute ON attribute.attrelid = index.indrelid AND attribute.attname = %s
+            WHERE index.indrelid = %s::regclass AND index.indisunique AND NOT index.indisprimary
+                AND NOT attribute.attnum = ANY(index.indkey)
+        """, [PARTITION_KEY, table])
+        weak_indexes = [str(name) for name, in cursor.fetchall()]
+        if weak_indexes:
+            raise ValueError(
+                f'Уникальные индексы {", ".join(weak_indexes)} не содержат {PARTITION_KEY}, '
+                f'секционирование их ослабит'
+            )
+
+
+def partition_operations(connection, table: str, partitions: int) -> None:
+    """ Переводит таблицу операций на секционирование по хешу ИС.
+        Секционированная таблица создается рядом со старой, данные копируются,
+        старая таблица удаляется, а новая получает ее имя, индексы и ограничения.
+        Первичный ключ становится (id, investment_account_id)
+    :param partitions: количество секций
+    :raise ValueError: если секционирование невозможно (см. check_partitioning)
+    """
+    if partitions < 1:
+        raise ValueError('Количество секций должно быть больше 0')
+    if is_partitioned(connection, table):
+        raise ValueError(f'Таблица {table} уже секционирована')
+    check_partitioning(connection, table)
+
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        # Запоминаем индексы и ограничения старой таблицы, чтобы создать их на новой.
+        # Проверочные ограничения копирует CREATE TABLE ... LIKE
+        cursor.execute("""
+            SELECT pg_get_indexdef(index.indexrelid)
+            FROM pg_index AS index
+            WHERE index.indrelid = %s::regclass AND NOT index.indisprimary
+                AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = index.indexrelid)
+        """, [table])
+        indexes = [row[0] for row in cursor.fetchall()]
+        cursor.execute("""
+            SELECT conname, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE conrelid = %s::regclass AND contype IN ('u', 'f')
+        """, [table])
+        constraints = cursor.fetchall()
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, 'id'])
+        sequence = cursor.fetchone()[0]
+
+        partitioned_table = f'{table}_partitioned'
+        cursor.execute(
+            f'CREATE TABLE {partitioned_table} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+            f'PARTITION BY HASH ({PARTITION_KEY})'
+        )
+        for remainder in range(partitions):
+            cursor.execute(
+                f'CREATE TABLE {table}_p{remainder} PARTITION OF {partitioned_table} '
+                f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})'
+            )
+        cursor.execute(f'INSERT INTO {partitioned_table} SELECT * FROM {table}')
+        logger.info(f'Скопировано операций: {cursor.rowcount}')
+
+        # Последовательность id принадлежит старой таблице и удалилась бы вместе с ней
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+        cursor.execute(f'DROP TABLE {table}')
+        cursor.execute(f'ALTER TABLE {partitioned_table} RENAME TO {table}')
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}.id')
+
+        cursor.execute(f'ALTER TABLE {table} ADD PRIMARY KEY (id, {PARTITION_KEY})')
+        for name, definition in constraints:
+            cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition}')
+        for index in indexes:
+            cursor.execute(index)
+        cursor.execute(f'ANALYZE {table}')
+    logger.info(f'Таблица {table} секционирована по хешу {PARTITION_KEY} на {partitions} секций')
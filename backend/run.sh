@@ -3,6 +3,7 @@ python manage.py migrate &&
 
 python manage.py init &&
 python manage.py collectstatic --noinput &&
+(python manage.py worker &) &&
 gunicorn core.wsgi:application --bind 0.0.0.0:9999
 
 tail -f
\ No newline at end of file
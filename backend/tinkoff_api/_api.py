@@ -163,6 +163,29 @@ class TinkoffProfile:
         logger.info('Операции получены')
         return response
 
+    @only_authorized
+    @generate_url
+    def market_candles(self, figi: str, from_datetime: dt.datetime, to_datetime: dt.datetime,
+                       interval: str = 'day', url: str = None):
+        """ Свечи инструмента в определенном временном интервале
+        :param figi: FIGI инструмента
+        :param from_datetime: дата начала промежутка
+        :param to_datetime: дата конца промежутка
+        :param interval: интервал свечи (1min, hour, day, week...), для day промежуток не больше года
+        :param url: куда отправлять запрос
+        :return: список свечей
+        """
+        logger.info(f'Получение от Tinkoff API: market/candles/ {figi} ({interval})')
+        self.check_date_range(from_datetime, to_datetime)
+        return self.response_to_json(self._session.get(
+            url, params={
+                'figi': figi,
+                'from': from_datetime.isoformat(),
+                'to': to_datetime.isoformat(),
+                'interval': interval
+            }
+        ))
+
     @staticmethod
     def check_date_range(from_datetime: dt.datetime, to_datetime: dt.datetime) -> True:
         """ Проверка дат на корректность.
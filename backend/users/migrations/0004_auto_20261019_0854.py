@@ -0,0 +1,40 @@
+# Generated by Django 3.0.8 on 2026-10-19 05:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0003_operation_co_owners'),
+        ('users', '0003_auto_20200819_1726'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShareSchedule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.DecimalField(decimal_places=8, max_digits=9, verbose_name='Доля')),
+                ('effective_from', models.DateTimeField(verbose_name='Действует с')),
+                ('effective_to', models.DateTimeField(blank=True, null=True, verbose_name='Действует до')),
+                ('co_owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='share_schedules', to='users.CoOwner', verbose_name='Совладелец')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='share_schedules', to='operations.Currency', verbose_name='Валюта')),
+            ],
+            options={
+                'verbose_name': 'Расписание доли совладельца',
+                'verbose_name_plural': 'Расписания долей совладельцев',
+                'ordering': ('co_owner', 'currency', 'effective_from'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='shareschedule',
+            index=models.Index(fields=['co_owner', 'currency', 'effective_from'], name='share_schedule_lookup'),
+        ),
+        migrations.AddConstraint(
+            model_name='shareschedule',
+            constraint=models.CheckConstraint(check=models.Q(('effective_to__isnull', True), ('effective_to__gt', django.db.models.expressions.F('effective_from')), _connector='OR'), name='share_schedule_period'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Заполнение вклада существующих сделок и дохода ИС по их операциям
+FILL_INCOME_SQL = """
+    UPDATE market_deal AS deal
+    SET closed_deal_income = CASE WHEN new.is_closed THEN new.realized_income ELSE 0 END,
+        opened_deal_income = CASE WHEN new.is_closed THEN 0 ELSE new.realized_income END,
+        dividend_income = new.dividend_income,
+        commission = new.commission
+    FROM (
+        SELECT deal_id, dividend_income, commission,
+            bought_quantity = sold_quantity AND bought_quantity > 0 AS is_closed,
+            sold_payment + CASE
+                WHEN bought_quantity > 0 THEN bought_payment * sold_quantity / bought_quantity ELSE 0
+            END AS realized_income
+        FROM (
+            SELECT deal_id,
+                COALESCE(SUM(quantity) FILTER (WHERE type IN ('Buy', 'BuyCard')), 0) AS bought_quantity,
+                COALESCE(SUM(quantity) FILTER (WHERE type = 'Sell'), 0) AS sold_quantity,
+                COALESCE(SUM(payment + commission) FILTER (WHERE type IN ('Buy', 'BuyCard')), 0) AS bought_payment,
+                COALESCE(SUM(payment + commission) FILTER (WHERE type = 'Sell'), 0) AS sold_payment,
+                COALESCE(SUM(payment + dividend_tax) FILTER (WHERE type = 'Dividend'), 0) AS dividend_income,
+                COALESCE(SUM(commission), 0) AS commission
+            FROM operations_operation
+            WHERE deal_id IS NOT NULL
+            GROUP BY deal_id
+        ) AS totals
+    ) AS new
+    WHERE deal.id = new.deal_id AND deal.currency_id IS NOT NULL;
+
+    INSERT INTO users_investmentaccountincome
+        (investment_account_id, currency_id, closed_deal_income, opened_deal_income, dividend_income, commission)
+    SELECT investment_account_id, currency_id, SUM(closed_deal_income), SUM(opened_deal_income),
+        SUM(dividend_income), SUM(commission)
+    FROM market_deal
+    WHERE currency_id IS NOT NULL
+    GROUP BY investment_account_id, currency_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0003_operation_co_owners'),
+        ('users', '0004_auto_20261019_0854'),
+        ('market', '0011_auto_20261019_0903'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvestmentAccountIncome',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('closed_deal_income', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Доход закрытых сделок')),
+                ('opened_deal_income', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Реализованный доход открытых сделок')),
+                ('dividend_income', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Дивиденды')),
+                ('commission', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Комиссии')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='operations.Currency', verbose_name='Валюта')),
+                ('investment_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='income_set', to='users.InvestmentAccount', verbose_name='Инвестиционный счет')),
+            ],
+            options={
+                'verbose_name': 'Доход ИС',
+                'verbose_name_plural': 'Доходы ИС',
+                'ordering': ('currency',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='investmentaccountincome',
+            constraint=models.UniqueConstraint(fields=('investment_account', 'currency'), name='unique_investment_account_income'),
+        ),
+        migrations.RunSQL(FILL_INCOME_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0003_operation_co_owners'),
+        ('market', '0011_auto_20261019_0903'),
+        ('users', '0005_auto_20261019_0903'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Holding',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Количество')),
+                ('lots', models.PositiveIntegerField(default=0, verbose_name='Лотов')),
+                ('average_position_price', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Средняя цена позиции')),
+                ('last_price', models.DecimalField(decimal_places=4, max_digits=20, null=True, verbose_name='Последняя цена')),
+                ('expected_yield', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Ожидаемый доход')),
+                ('reconciled_at', models.DateTimeField(null=True, verbose_name='Время сверки')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='operations.Currency', verbose_name='Валюта')),
+                ('instrument', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='market.InstrumentType', verbose_name='Ценная бумага')),
+                ('investment_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holdings', to='users.InvestmentAccount', verbose_name='Инвестиционный счет')),
+            ],
+            options={
+                'verbose_name': 'Позиция портфеля',
+                'verbose_name_plural': 'Позиции портфеля',
+                'ordering': ('instrument',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='holding',
+            constraint=models.UniqueConstraint(fields=('investment_account', 'instrument'), name='unique_holding'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:05
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_auto_20261019_0905'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investmentaccount',
+            name='sync_version',
+            field=models.PositiveIntegerField(default=0, verbose_name='Версия синхронизации'),
+        ),
+        migrations.CreateModel(
+            name='PortfolioSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('positions', django.contrib.postgres.fields.jsonb.JSONField(default=list, verbose_name='Позиции')),
+                ('fetched_at', models.DateTimeField(verbose_name='Время получения')),
+                ('investment_account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='portfolio_snapshot', to='users.InvestmentAccount', verbose_name='Инвестиционный счет')),
+            ],
+            options={
+                'verbose_name': 'Снимок портфеля',
+                'verbose_name_plural': 'Снимки портфелей',
+            },
+        ),
+    ]
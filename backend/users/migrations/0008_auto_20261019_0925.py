@@ -0,0 +1,61 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Заполнение общего капитала существующих ИС по их операциям
+FILL_CAPITAL_SQL = """
+    WITH operation AS (
+        SELECT operation.investment_account_id, operation.type, operation.currency_id, operation.payment,
+            operation.commission, operation.quantity, instrument.ticker
+        FROM operations_operation AS operation
+        LEFT JOIN market_instrumenttype AS instrument ON instrument.figi = operation.instrument_id
+        WHERE operation.type IN ('PayIn', 'PayOut', 'ServiceCommission')
+            OR operation.type IN ('Buy', 'BuyCard', 'Sell') AND instrument.type = 'Currency'
+    ), capital AS (
+        SELECT investment_account_id, currency_id, payment + commission AS value
+        FROM operation
+        UNION ALL
+        SELECT investment_account_id,
+            CASE WHEN ticker LIKE '%USD%' THEN 'USD' WHEN ticker LIKE '%EUR%' THEN 'EUR' END,
+            CASE WHEN type IN ('Buy', 'BuyCard') THEN quantity ELSE -quantity END
+        FROM operation
+        WHERE ticker IS NOT NULL
+    )
+    INSERT INTO users_investmentaccountcapital (investment_account_id, currency_id, total_capital)
+    SELECT investment_account_id, currency_id, SUM(value)
+    FROM capital
+    WHERE currency_id IS NOT NULL
+    GROUP BY investment_account_id, currency_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0006_auto_20261019_0915'),
+        ('users', '0007_auto_20261019_0905'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvestmentAccountCapital',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_capital', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Общий капитал')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='operations.Currency', verbose_name='Валюта')),
+                ('investment_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='capital_set', to='users.InvestmentAccount', verbose_name='Инвестиционный счет')),
+            ],
+            options={
+                'verbose_name': 'Капитал ИС',
+                'verbose_name_plural': 'Капиталы ИС',
+                'ordering': ('currency',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='investmentaccountcapital',
+            constraint=models.UniqueConstraint(fields=('investment_account', 'currency'), name='unique_investment_account_capital'),
+        ),
+        migrations.RunSQL(FILL_CAPITAL_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+# Начальные записи журнала движения денег: текущие капиталы и доход со сделок,
+# баланс после каждой записи - нарастающий итог по совладельцу и валюте.
+# Дивиденды и комиссии в доходе со сделок не выделены, поэтому он записывается отдельным типом.
+# Капиталы создаются для совладельцев, у которых есть доход в валюте, но нет капитала
+FILL_BALANCE_ENTRIES_SQL = """
+    WITH entry AS (
+        SELECT co_owner_id, currency_id, 'Allocation' AS kind, value AS amount, NULL::integer AS deal_id
+        FROM users_capital
+        WHERE value != 0
+        UNION ALL
+        SELECT co_owner_id, currency_id, 'OpeningIncome', value, deal_id
+        FROM market_dealincome
+        WHERE value != 0
+    )
+    INSERT INTO users_balanceentry (co_owner_id, currency_id, kind, amount, deal_id, date, balance)
+    SELECT co_owner_id, currency_id, kind, amount, deal_id, NOW(), SUM(amount) OVER (
+        PARTITION BY co_owner_id, currency_id ORDER BY kind, deal_id ROWS UNBOUNDED PRECEDING
+    )
+    FROM entry
+    ORDER BY co_owner_id, currency_id, kind, deal_id;
+
+    INSERT INTO users_capital AS capital (co_owner_id, currency_id, value, default_share, balance)
+    SELECT co_owner_id, currency_id, 0, 0, SUM(amount)
+    FROM users_balanceentry
+    GROUP BY co_owner_id, currency_id
+    ON CONFLICT (co_owner_id, currency_id) DO UPDATE
+    SET balance = EXCLUDED.balance;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0011_auto_20261019_0903'),
+        ('operations', '0006_auto_20261019_0915'),
+        ('users', '0008_auto_20261019_0925'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='capital',
+            name='balance',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Баланс'),
+        ),
+        migrations.CreateModel(
+            name='BalanceEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('Allocation', 'Изменение капитала'), ('DealIncome', 'Доход со сделки'), ('Commission', 'Комиссия'), ('Dividend', 'Дивиденды'), ('OpeningIncome', 'Доход со сделки до ведения журнала')], max_length=16, verbose_name='Тип')),
+                ('amount', models.DecimalField(decimal_places=4, max_digits=20, verbose_name='Сумма')),
+                ('balance', models.DecimalField(decimal_places=4, max_digits=20, verbose_name='Баланс после записи')),
+                ('date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата')),
+                ('co_owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_entries', to='users.CoOwner', verbose_name='Совладелец')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='operations.Currency', verbose_name='Валюта')),
+                ('deal', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='market.Deal', verbose_name='Сделка')),
+            ],
+            options={
+                'verbose_name': 'Движение денег совладельца',
+                'verbose_name_plural': 'Движения денег совладельцев',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='balanceentry',
+            index=models.Index(fields=['co_owner', 'currency', 'date', 'id'], name='balance_entry_history'),
+        ),
+        migrations.RunSQL(FILL_BALANCE_ENTRIES_SQL, migrations.RunSQL.noop),
+    ]
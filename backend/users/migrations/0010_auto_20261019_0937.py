@@ -0,0 +1,39 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_auto_20261019_0929'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investmentaccount',
+            name='import_error',
+            field=models.TextField(blank=True, default='', verbose_name='Ошибка импорта'),
+        ),
+        migrations.AddField(
+            model_name='investmentaccount',
+            name='import_progress',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Прогресс импорта, %'),
+        ),
+        migrations.AddField(
+            model_name='investmentaccount',
+            name='import_stage',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='Этап импорта'),
+        ),
+        # Существующие ИС уже импортированы
+        migrations.AddField(
+            model_name='investmentaccount',
+            name='import_status',
+            field=models.CharField(choices=[('Pending', 'Ожидает импорта'), ('Running', 'Импортируется'), ('Done', 'Импортирован'), ('Failed', 'Ошибка импорта')], default='Done', max_length=16, verbose_name='Статус импорта'),
+        ),
+        migrations.AlterField(
+            model_name='investmentaccount',
+            name='import_status',
+            field=models.CharField(choices=[('Pending', 'Ожидает импорта'), ('Running', 'Импортируется'), ('Done', 'Импортирован'), ('Failed', 'Ошибка импорта')], default='Pending', max_length=16, verbose_name='Статус импорта'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.0.8 on 2026-10-19 06:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_auto_20261019_0937'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='investmentaccount',
+            name='unique_inv_name',
+        ),
+        migrations.RemoveConstraint(
+            model_name='investmentaccount',
+            name='unique_token',
+        ),
+        migrations.AddField(
+            model_name='investmentaccount',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Время удаления'),
+        ),
+        migrations.AddConstraint(
+            model_name='investmentaccount',
+            constraint=models.UniqueConstraint(condition=models.Q(deleted_at__isnull=True), fields=('name', 'creator'), name='unique_inv_name'),
+        ),
+        migrations.AddConstraint(
+            model_name='investmentaccount',
+            constraint=models.UniqueConstraint(condition=models.Q(deleted_at__isnull=True), fields=('creator', 'token'), name='unique_token'),
+        ),
+    ]
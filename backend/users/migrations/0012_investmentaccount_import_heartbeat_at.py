@@ -0,0 +1,25 @@
+# Generated by Django 3.0.8 on 2026-10-19 07:12
+
+from django.db import migrations, models
+
+
+# Уже идущие импорты получают отметку, чтобы прерванные из них можно было забрать заново
+FILL_IMPORT_HEARTBEAT_SQL = """
+    UPDATE users_investmentaccount SET import_heartbeat_at = NOW() WHERE import_status = 'Running';
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_auto_20261019_0941'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investmentaccount',
+            name='import_heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Время последней отметки импорта'),
+        ),
+        migrations.RunSQL(FILL_IMPORT_HEARTBEAT_SQL, migrations.RunSQL.noop),
+    ]
@@ -1,24 +1,29 @@
-import collections
 import datetime
 import logging
 import os
-from typing import Dict
+from typing import Callable, Dict, Optional
 
 import pytz
 import requests
 from django.contrib.auth.models import AbstractUser, Group
-from django.db import models
-from django.db.models import Sum, Case, When, Q, F, ExpressionWrapper, Avg
+from django.contrib.postgres.fields import JSONField
+from django.db import models, transaction, connection
+from django.db.models import Sum, Case, When, Q, F, Min, Max, OuterRef, Subquery, Count
 from django.db.models.functions import Coalesce
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
 
-from core.utils import ProxyQ
-from market.models import Deal, DealIncome, CurrencyInstrument
+from core.utils import get_types_by_proxy_models
+from market.models import Deal, DealIncome, CurrencyInstrument, InstrumentType
+from market.services.currency_rates import converted_amount
+from market.services.recalculation_queue import mark_deals_dirty
+from market.services.shares import is_sparse_storage
 from operations.models import PurchaseOperation, SaleOperation, PayOperation, ServiceCommissionOperation, \
     DividendOperation, Currency, Operation, Share
 from tinkoff_api.exceptions import InvalidTokenError
+from users.models_constraints import BalanceEntryKinds, ImportStatuses
+from users.services.account_import import enqueue_import
 from users.services.update_service import Updater
 
 logger = logging.getLogger(__name__)
@@ -38,15 +43,32 @@ class InvestorGroup(Group):
         verbose_name_plural = 'Группы пользователей'
 
 
+class InvestmentAccountManager(models.Manager):
+    """ ИС без помеченных на удаление """
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class InvestmentAccount(models.Model):
+    ImportStatuses = ImportStatuses
+
     class Meta:
         verbose_name = 'Инвестиционный счет'
         verbose_name_plural = 'Инвестиционные счета'
         constraints = [
-            models.UniqueConstraint(fields=('name', 'creator'), name='unique_inv_name'),
-            models.UniqueConstraint(fields=('creator', 'token'), name='unique_token')
+            # Удаленный ИС, который еще не удален фоновым обработчиком, не мешает создать такой же
+            models.UniqueConstraint(
+                fields=('name', 'creator'), condition=Q(deleted_at__isnull=True), name='unique_inv_name'
+            ),
+            models.UniqueConstraint(
+                fields=('creator', 'token'), condition=Q(deleted_at__isnull=True), name='unique_token'
+            )
         ]
 
+    objects = InvestmentAccountManager()
+    # Вместе с помеченными на удаление, используется фоновым удалением (users.services.account_deletion)
+    all_objects = models.Manager()
+
     name = models.CharField(verbose_name='Название счета', max_length=256)
     creator = models.ForeignKey(
         Investor, verbose_name='Создатель счета', on_delete=models.CASCADE,
@@ -58,97 +80,216 @@ class InvestmentAccount(models.Model):
         verbose_name='Время последней синхронизации',
         default=datetime.datetime(1990, 1, 1, tzinfo=pytz.timezone('UTC'))
     )
+    # Увеличивается после каждой синхронизации, по ней сбрасываются закэшированные данные ИС
+    sync_version = models.PositiveIntegerField(verbose_name='Версия синхронизации', default=0)
+    # Импорт всей истории нового ИС выполняется в фоне (users.services.account_import)
+    import_status = models.CharField(
+        verbose_name='Статус импорта', max_length=16, choices=ImportStatuses.choices, default=ImportStatuses.PENDING
+    )
+    import_stage = models.CharField(verbose_name='Этап импорта', max_length=64, default='', blank=True)
+    import_progress = models.PositiveSmallIntegerField(verbose_name='Прогресс импорта, %', default=0)
+    import_error = models.TextField(verbose_name='Ошибка импорта', default='', blank=True)
+    # Обновляется обработчиком во время импорта, по нему находятся импорты, прерванные падением обработчика
+    import_heartbeat_at = models.DateTimeField(
+        verbose_name='Время последней отметки импорта', null=True, blank=True
+    )
+    # ИС удаляется частями в фоне (users.services.account_deletion), до этого он только помечается
+    deleted_at = models.DateTimeField(verbose_name='Время удаления', null=True, blank=True)
     investors = models.ManyToManyField(Investor, through='CoOwner')
     currencies = models.ManyToManyField('operations.Currency', through='CurrencyAsset')
 
     @property
-    def prop_total_income(self):
-        """ Расчет дохода инвестиционного счета """
-        total_income_of_closed_deals = (
-            self.deals.closed()
-            .annotate(_income=Sum('operations__payment')+Sum('operations__commission'))
-            .aggregate(s=Sum('_income'))['s']
-        )
+    def is_imported(self) -> bool:
+        return self.import_status == ImportStatuses.DONE
 
-        f_price = ExpressionWrapper(
-            (F('operations__payment')+F('operations__commission'))/F('operations__quantity'),
-            output_field=models.DecimalField()
-        )
-        q_purchase = ProxyQ(proxy_instance_of=PurchaseOperation)
-        q_sale = ProxyQ(proxy_instance_of=SaleOperation)
-        avg_sum = Avg(f_price, filter=q_purchase) + Avg(f_price, filter=q_sale)
-        pieces_sold = Sum('operations__quantity', filter=q_sale)
-        total_income_of_opened_deals = (
-            Deal.objects.opened()
-            .annotate(_income=Coalesce(ExpressionWrapper(avg_sum*pieces_sold, output_field=models.DecimalField()), 0))
-        ).aggregate(s=Sum('_income'))['s']
-        return total_income_of_closed_deals + total_income_of_opened_deals
-
-    def capital_info(self) -> Dict[str, 'decimal.Decimal']:
-        """ Расчет общего капитала для всего ИС,
-            расчет нераспределенных средств
+    @property
+    def prop_total_income(self) -> Dict[str, 'decimal.Decimal']:
+        """ Доход инвестиционного счета по валютам """
+        return {income.currency_id: income.total for income in self.income_set.all()}
+
+    def capital_info(self) -> Dict[str, Dict[str, 'decimal.Decimal']]:
+        """ Общий и нераспределенный капитал ИС по валютам одним запросом.
+            Общий капитал хранится в InvestmentAccountCapital и обновляется при синхронизации (update_capital),
+            нераспределенный - общий капитал за вычетом капиталов совладельцев
         """
-        # Общий капитал ИС
-        # Расчитывается как
-        # (пополнения счета + сервисная комиссия`<-отрицательная`) + покупки/продажи валюты + комиссия за операцию
-        total_capital_by_currency = (
-            self.operations
-            .filter(ProxyQ(proxy_instance_of=(PayOperation, ServiceCommissionOperation)) |
-                    ProxyQ(proxy_instance_of=(PurchaseOperation, SaleOperation),
-                           instrument__proxy_instance_of=CurrencyInstrument))
-            .values('currency').order_by()
-            .annotate(total_capital=Sum('payment')+Sum('commission'), abbreviation=F('currency__abbreviation'))
-        )
-        # Для каждой валюты вычисляем общий капитал
-        capital_info = collections.defaultdict(dict)
-        for capital in total_capital_by_currency:
-            capital_info[capital['currency']]['total_capital'] = capital['total_capital']
-
-        currency_purchases = self.operations.filter(
-            proxy_instance_of=PurchaseOperation, instrument__proxy_instance_of=CurrencyInstrument
-        ).values('instrument__ticker').annotate(s=Sum('quantity'))
-
-        currency_sales = self.operations.filter(
-            proxy_instance_of=SaleOperation, instrument__proxy_instance_of=CurrencyInstrument
-        ).values('instrument__ticker').annotate(s=Sum('quantity'))
-
-        for i in currency_purchases:
-            if 'USD' in i['instrument__ticker']:
-                capital_info['USD']['total_capital'] += i['s']
-            elif 'EUR' in i['instrument__ticker']:
-                capital_info['EUR']['total_capital'] += i['s']
-            else:
-                logger.error(f'Покупка неизвестной валюты: {i}')
-
-        for i in currency_sales:
-            if 'USD' in i['instrument__ticker']:
-                capital_info['USD']['total_capital'] -= i['s']
-            elif 'EUR' in i['instrument__ticker']:
-                capital_info['EUR']['total_capital'] -= i['s']
-            else:
-                logger.error(f'Продажа неизвестной валюты: {i}')
         distributed_capital = (
             Capital.objects
-            .filter(co_owner__investment_account=InvestmentAccount.objects.last())
-            .values('currency').order_by().annotate(distributed_capital=Sum('value')).distinct()
+            .filter(co_owner__investment_account=OuterRef('investment_account'), currency=OuterRef('currency'))
+            .values('currency').order_by()
+            .annotate(distributed_capital=Sum('value'))
+            .values('distributed_capital')
+        )
+        capital_set = (
+            self.capital_set
+            .select_related('currency')
+            .annotate(distributed_capital=Coalesce(Subquery(distributed_capital), 0))
         )
-        for capital in distributed_capital:
-            if capital['currency'] in capital_info:
-                capital_info[capital['currency']]['undistributed_capital'] = \
-                    capital_info[capital['currency']]['total_capital'] - capital['distributed_capital']
-        return dict(capital_info)
+        return {
+            capital.currency_id: {
+                'total_capital': capital.total_capital,
+                'undistributed_capital': capital.total_capital - capital.distributed_capital,
+                'abbreviation': capital.currency.abbreviation
+            }
+            for capital in capital_set
+        }
+
+    def total_capital_in(self, currency: str, date=None) -> Optional['decimal.Decimal']:
+        """ Общий капитал ИС во всех валютах, переведенный в currency по курсам на date (по умолчанию сегодня).
+            Курсы подтягиваются в том же запросе, None - если капитала нет или нет курса какой-то валюты
+        """
+        if date is None:
+            date = timezone.localdate()
+        capital_set = self.capital_set.annotate(
+            converted_capital=converted_amount('total_capital', 'currency_id', date, currency, self.pk)
+        )
+        result = capital_set.aggregate(
+            total=Sum('converted_capital'), missing=Count('pk', filter=Q(converted_capital__isnull=True))
+        )
+        return None if result['missing'] else result['total']
+
+    def currency_conversions(self) -> Dict[str, 'decimal.Decimal']:
+        """ Изменение денег ИС по валютам от покупок/продаж валюты одним сгруппированным запросом.
+            Каждая операция дает два движения: оплату в валюте операции и
+            купленную/проданную базовую валюту инструмента (InstrumentType.base_currency)
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(self._get_movements_sql(include_pay=False), self._get_capital_params())
+            return dict(cursor.fetchall())
+
+    def update_capital(self) -> None:
+        """ Пересчитывает общий капитал ИС по валютам (InvestmentAccountCapital) одним запросом.
+            Общий капитал - пополнения и выводы, сервисная комиссия и покупки/продажи валюты
+            (как в currency_conversions)
+        """
+        sql = f"""
+            WITH total (currency_id, total_capital) AS (
+                {self._get_movements_sql(include_pay=True)}
+            ), deleted AS (
+                DELETE FROM {InvestmentAccountCapital._meta.db_table}
+                WHERE investment_account_id = %(investment_account_id)s
+                    AND currency_id NOT IN (SELECT currency_id FROM total)
+            )
+            INSERT INTO {InvestmentAccountCapital._meta.db_table} (investment_account_id, currency_id, total_capital)
+            SELECT %(investment_account_id)s, currency_id, total_capital
+            FROM total
+            ON CONFLICT (investment_account_id, currency_id) DO UPDATE
+            SET total_capital = EXCLUDED.total_capital
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, self._get_capital_params())
+
+    @staticmethod
+    def _get_movements_sql(include_pay: bool) -> str:
+        """ Запрос движения денег ИС по валютам: покупки/продажи валюты,
+            а если include_pay - еще пополнения, выводы и сервисная комиссия
+        """
+        pay_condition = 'operation.type IN %(pay_types)s OR' if include_pay else ''
+        return f"""
+            SELECT movement.currency_id, SUM(movement.value)
+            FROM {Operation._meta.db_table} AS operation
+            LEFT JOIN {InstrumentType._meta.db_table} AS instrument ON instrument.figi = operation.instrument_id
+            CROSS JOIN LATERAL (VALUES
+                (operation.currency_id, operation.payment + operation.commission),
+                (
+                    instrument.base_currency_id,
+                    CASE WHEN operation.type IN %(purchase_types)s THEN operation.quantity ELSE -operation.quantity END
+                )
+            ) AS movement (currency_id, value)
+            WHERE operation.investment_account_id = %(investment_account_id)s AND (
+                {pay_condition}
+                operation.type IN %(currency_trade_types)s AND instrument.type IN %(currency_instrument_types)s
+            ) AND movement.currency_id IS NOT NULL
+            GROUP BY movement.currency_id
+        """
+
+    def _get_capital_params(self) -> dict:
+        """ Параметры запросов update_capital и currency_conversions """
+        return {
+            'investment_account_id': self.pk,
+            'pay_types': get_types_by_proxy_models((PayOperation, ServiceCommissionOperation)),
+            'currency_trade_types': get_types_by_proxy_models((PurchaseOperation, SaleOperation)),
+            'currency_instrument_types': get_types_by_proxy_models((CurrencyInstrument, )),
+            'purchase_types': get_types_by_proxy_models((PurchaseOperation, ))
+        }
 
     def update_shares_by_default_share(self):
         """ Обновление долей в операциях ИС установленного по умолчанию
-            в соответствии со значением default_share капиталов
+            в соответствии с расписанием долей и значением default_share капиталов.
+            Все доли обновляются одним UPDATE ... FROM, после чего
+            доход затронутых сделок пересчитывается (по одному разу на сделку)
+        """
+        sql = self._get_update_shares_sql('')
+        if is_sparse_storage():
+            # Доли по умолчанию не хранятся, достаточно удалить все явно заданные
+            sql = f"""
+                DELETE FROM {Share._meta.db_table} AS share
+                USING {Operation._meta.db_table} AS operation
+                WHERE share.operation_id = operation.id AND operation.investment_account_id = %(investment_account_id)s
+                RETURNING operation.deal_id
+            """
+        self._update_shares(sql, {'investment_account_id': self.pk})
+        logger.info('Доли обновлены по умолчанию')
+
+    def update_shares_by_schedule(self, co_owner_id: int, currency_id: str,
+                                  effective_from: datetime.datetime, effective_to: Optional[datetime.datetime]):
+        """ Обновление долей совладельца в операциях валюты за период расписания долей
+            при обычном хранении долей (при разреженном доли из расписания берутся в момент чтения).
+            Доля на дату операции берется из расписания, если его нет - доля по умолчанию
+        """
+        sql = self._get_update_shares_sql("""
+            AND share.co_owner_id = %(co_owner_id)s AND operation.currency_id = %(currency_id)s
+            AND operation.date >= %(effective_from)s
+            AND (%(effective_to)s::timestamptz IS NULL OR operation.date < %(effective_to)s)
+        """)
+        self._update_shares(sql, {
+            'investment_account_id': self.pk, 'co_owner_id': co_owner_id, 'currency_id': currency_id,
+            'effective_from': effective_from, 'effective_to': effective_to
+        })
+        logger.info(f'Доли совладельца {co_owner_id} обновлены по расписанию: {effective_from} - {effective_to}')
+
+    @staticmethod
+    def _get_update_shares_sql(condition: str) -> str:
+        """ Запрос обновления сохраненных долей ИС, отобранных condition, по расписанию и долям по умолчанию """
+        # Доля на дату операции из расписания, если его нет - доля по умолчанию
+        return f"""
+            UPDATE {Share._meta.db_table} AS share
+            SET value = effective.value
+            FROM (
+                SELECT share.id AS share_id, operation.deal_id,
+                    COALESCE(schedule.value, capital.default_share) AS value
+                FROM {Share._meta.db_table} AS share
+                JOIN {Operation._meta.db_table} AS operation ON operation.id = share.operation_id
+                JOIN {Capital._meta.db_table} AS capital
+                    ON capital.co_owner_id = share.co_owner_id AND capital.currency_id = operation.currency_id
+                LEFT JOIN {ShareSchedule._meta.db_table} AS schedule
+                    ON schedule.co_owner_id = share.co_owner_id AND schedule.currency_id = operation.currency_id
+                    AND schedule.effective_from <= operation.date
+                    AND (schedule.effective_to IS NULL OR schedule.effective_to > operation.date)
+                WHERE operation.investment_account_id = %(investment_account_id)s {condition}
+            ) AS effective
+            WHERE share.id = effective.share_id AND share.value <> effective.value
+            RETURNING effective.deal_id
         """
-        # XXX:
-        self.operations.filter()
 
-    def update_portfolio(self, now=None):
+    @staticmethod
+    def _update_shares(sql: str, params: dict) -> None:
+        """ Выполняет запрос изменения долей, возвращающий id сделок,
+            доход затронутых сделок пересчитывается (по одному разу на сделку)
+        """
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                deal_ids = {deal_id for deal_id, in cursor.fetchall() if deal_id is not None}
+            logger.info(f'Доли обновлены, затронуто сделок: {len(deal_ids)}')
+            Deal.objects.filter(pk__in=deal_ids).reset_income_state()
+        mark_deals_dirty(deal_ids)
+
+    def update_portfolio(self, now=None, on_progress: Optional[Callable[[str, int], None]] = None) -> bool:
         """ Обновление всего портфеля.
             Включает в себя обновление операций, сделок, валютных активов
         :param now: Текущий момент времени, до которого будут обновляться операции
+        :param on_progress: вызывается перед каждым этапом с названием этапа и процентом выполнения
+        :return: был ли портфель обновлен
         """
         logger.info(f'Обновление портфеля "{self}"')
         if now is None:
@@ -159,18 +300,46 @@ class InvestmentAccount(models.Model):
                 from_datetime = self.sync_at - datetime.timedelta(hours=6)
                 to_datetime = now
                 updater = Updater(from_datetime, to_datetime, self.id, token=self.token)
-                updater.update_currency_assets()
-                updater.update_operations()
-                updater.update_deals()
+                stages = (
+                    ('Валютные активы', updater.update_currency_assets),
+                    ('Операции', updater.update_operations),
+                    ('Сделки', updater.update_deals),
+                    ('Позиции', updater.update_holdings),
+                    ('Курсы валют', updater.update_currency_rates),
+                    ('Капитал', self.update_capital)
+                )
+                for number, (stage, update) in enumerate(stages):
+                    if on_progress is not None:
+                        on_progress(stage, number * 100 // len(stages))
+                    update()
                 self.sync_at = to_datetime
-                self.save()
+                self.sync_version += 1
+                self.save(update_fields=('sync_at', 'sync_version'))
                 logger.info('Обновление портфеля завершено')
+                return True
             else:
                 logger.info('Портфель обновлялся недавно')
         except InvalidTokenError:
             logger.warning('Обновление портфеля не удалось, токен невалидный')
         except requests.exceptions.ConnectionError:
             logger.warning('Обновление портфеля не удалось, сбой при подключении к Tinkoff API')
+        return False
+
+    def initialize_capital(self) -> None:
+        """ Начальный капитал создателя ИС - весь капитал ИС в каждой валюте """
+        co_owner = self.co_owners.get(investor_id=self.creator_id)
+        total_capital = self.capital_info()
+        co_owner_capital = co_owner.capital.select_related('currency').all()
+        bulk_updates = []
+        allocations = []
+        for co_owner_capital_item in co_owner_capital:
+            iso_code = co_owner_capital_item.currency.iso_code
+            if iso_code in total_capital:
+                allocations.append((co_owner_capital_item, co_owner_capital_item.value))
+                bulk_updates.append(co_owner_capital_item)
+                bulk_updates[-1].value = total_capital[iso_code]['total_capital']
+        Capital.objects.bulk_update(bulk_updates, fields=('value', ))
+        BalanceEntry.objects.append_allocations(allocations)
 
     def __str__(self):
         return f'{self.name} ({self.creator})'
@@ -235,11 +404,144 @@ class Capital(models.Model):
     )
     value = models.DecimalField(verbose_name='Капитал', max_digits=20, decimal_places=4, default=0)
     default_share = models.DecimalField(verbose_name='Доля по умолчанию', default=0, max_digits=9, decimal_places=8)
+    # Капитал и доход со всех сделок, обновляется вместе с журналом BalanceEntry
+    balance = models.DecimalField(verbose_name='Баланс', max_digits=20, decimal_places=4, default=0)
+
+    def balance_history(self, date_from=None, date_to=None):
+        """ Движения денег совладельца в валюте капитала за период, в порядке добавления """
+        entries = BalanceEntry.objects.filter(co_owner_id=self.co_owner_id, currency_id=self.currency_id)
+        if date_from is not None:
+            entries = entries.filter(date__gte=date_from)
+        if date_to is not None:
+            entries = entries.filter(date__lte=date_to)
+        return entries.order_by('date', 'id')
 
     def __str__(self):
         return f'{self.co_owner}::{self.currency}::{self.value}::{self.default_share}'
 
 
+class BalanceEntryManager(models.Manager):
+    def append(self, entries) -> None:
+        """ Добавляет записи в журнал и обновляет баланс капиталов (Capital.balance) одним запросом.
+            Баланс после каждой записи считается от обновленного баланса капитала, поэтому
+            параллельные добавления для одного капитала выстраиваются в очередь на блокировке его строки
+        :param entries: несохраненные BalanceEntry, записи с нулевой суммой пропускаются
+        """
+        entries = [entry for entry in entries if entry.amount]
+        if not entries:
+            return
+        params = []
+        for position, entry in enumerate(entries):
+            params.extend((position, entry.co_owner_id, entry.currency_id, entry.kind, entry.amount, entry.deal_id))
+        values = ', '.join(['(%s, %s, %s, %s, %s::numeric, %s::integer)'] * len(entries))
+        sql = f"""
+            WITH entry (position, co_owner_id, currency_id, kind, amount, deal_id) AS (
+                VALUES {values}
+            ), total AS (
+                SELECT co_owner_id, currency_id, SUM(amount) AS amount
+                FROM entry
+                GROUP BY co_owner_id, currency_id
+            ), capital AS (
+                INSERT INTO {Capital._meta.db_table} AS capital (
+                    co_owner_id, currency_id, value, default_share, balance
+                )
+                SELECT co_owner_id, currency_id, 0, 0, amount
+                FROM total
+                ON CONFLICT (co_owner_id, currency_id) DO UPDATE
+                SET balance = capital.balance + EXCLUDED.balance
+                RETURNING co_owner_id, currency_id, balance
+            )
+            INSERT INTO {self.model._meta.db_table} (co_owner_id, currency_id, kind, amount, deal_id, date, balance)
+            SELECT entry.co_owner_id, entry.currency_id, entry.kind, entry.amount, entry.deal_id, %s,
+                capital.balance - total.amount + SUM(entry.amount) OVER (
+                    PARTITION BY entry.co_owner_id, entry.currency_id ORDER BY entry.position
+                )
+            FROM entry
+            JOIN total USING (co_owner_id, currency_id)
+            JOIN capital USING (co_owner_id, currency_id)
+            ORDER BY entry.position
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [*params, timezone.now()])
+
+    def append_allocations(self, changes) -> None:
+        """ Записывает изменения капитала (Capital.value)
+        :param changes: пары (капитал с новым значением, старое значение)
+        """
+        self.append(
+            BalanceEntry(
+                co_owner_id=capital.co_owner_id, currency_id=capital.currency_id,
+                kind=BalanceEntryKinds.ALLOCATION, amount=capital.value - old_value
+            )
+            for capital, old_value in changes
+        )
+
+
+class BalanceEntry(models.Model):
+    """ Движение денег совладельца: изменение капитала, доход со сделки, комиссии и дивиденды.
+        Записи только добавляются, balance - баланс совладельца в валюте после записи
+    """
+    Kinds = BalanceEntryKinds
+
+    class Meta:
+        verbose_name = 'Движение денег совладельца'
+        verbose_name_plural = 'Движения денег совладельцев'
+        indexes = [
+            models.Index(fields=('co_owner', 'currency', 'date', 'id'), name='balance_entry_history')
+        ]
+
+    objects = BalanceEntryManager()
+    co_owner = models.ForeignKey(
+        CoOwner, verbose_name='Совладелец', on_delete=models.CASCADE, related_name='balance_entries'
+    )
+    currency = models.ForeignKey(
+        'operations.Currency', verbose_name='Валюта', on_delete=models.PROTECT, related_name='+'
+    )
+    kind = models.CharField(verbose_name='Тип', max_length=16, choices=Kinds.choices)
+    amount = models.DecimalField(verbose_name='Сумма', max_digits=20, decimal_places=4)
+    balance = models.DecimalField(verbose_name='Баланс после записи', max_digits=20, decimal_places=4)
+    deal = models.ForeignKey(
+        'market.Deal', verbose_name='Сделка', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    date = models.DateTimeField(verbose_name='Дата', default=timezone.now)
+
+    def __str__(self):
+        return f'{self.co_owner}::{self.currency}::{self.kind}: {self.amount}'
+
+
+class ShareSchedule(models.Model):
+    """ Доля совладельца в операциях определенной валюты за период времени.
+        Используется вместо доли по умолчанию для операций, попавших в период
+    """
+    class Meta:
+        verbose_name = 'Расписание доли совладельца'
+        verbose_name_plural = 'Расписания долей совладельцев'
+        ordering = ('co_owner', 'currency', 'effective_from')
+        constraints = [
+            models.CheckConstraint(
+                check=Q(effective_to__isnull=True) | Q(effective_to__gt=F('effective_from')),
+                name='share_schedule_period'
+            )
+        ]
+        indexes = [
+            models.Index(fields=('co_owner', 'currency', 'effective_from'), name='share_schedule_lookup')
+        ]
+
+    co_owner = models.ForeignKey(
+        CoOwner, verbose_name='Совладелец', on_delete=models.CASCADE, related_name='share_schedules'
+    )
+    currency = models.ForeignKey(
+        'operations.Currency', verbose_name='Валюта', on_delete=models.CASCADE, related_name='share_schedules'
+    )
+    value = models.DecimalField(verbose_name='Доля', max_digits=9, decimal_places=8)
+    effective_from = models.DateTimeField(verbose_name='Действует с')
+    # Не включительно, если не указано - бессрочно
+    effective_to = models.DateTimeField(verbose_name='Действует до', null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.co_owner}::{self.currency}::{self.value} ({self.effective_from} - {self.effective_to})'
+
+
 class CurrencyAsset(models.Model):
     """ Валютный актив в портфеле """
     class Meta:
@@ -261,6 +563,127 @@ class CurrencyAsset(models.Model):
         return f'{self.investment_account}::{self.currency}: {self.value}'
 
 
+class Holding(models.Model):
+    """ Позиция портфеля по ценной бумаге.
+        Считается при синхронизации по открытым сделкам и сверяется с портфелем Tinkoff API,
+        чтобы страницы не запрашивали портфель при каждом открытии
+    """
+    class Meta:
+        verbose_name = 'Позиция портфеля'
+        verbose_name_plural = 'Позиции портфеля'
+        ordering = ('instrument', )
+        constraints = [
+            models.UniqueConstraint(fields=('investment_account', 'instrument'), name='unique_holding')
+        ]
+
+    investment_account = models.ForeignKey(
+        InvestmentAccount, verbose_name='Инвестиционный счет', on_delete=models.CASCADE, related_name='holdings'
+    )
+    instrument = models.ForeignKey(
+        'market.InstrumentType', verbose_name='Ценная бумага', on_delete=models.PROTECT, related_name='+'
+    )
+    currency = models.ForeignKey(
+        'operations.Currency', verbose_name='Валюта', on_delete=models.PROTECT, related_name='+'
+    )
+    quantity = models.DecimalField(verbose_name='Количество', max_digits=20, decimal_places=4, default=0)
+    lots = models.PositiveIntegerField(verbose_name='Лотов', default=0)
+    average_position_price = models.DecimalField(
+        verbose_name='Средняя цена позиции', max_digits=20, decimal_places=4, default=0
+    )
+    # Последняя известная цена и ожидаемый доход есть только после сверки с Tinkoff API
+    last_price = models.DecimalField(verbose_name='Последняя цена', max_digits=20, decimal_places=4, null=True)
+    expected_yield = models.DecimalField(verbose_name='Ожидаемый доход', max_digits=20, decimal_places=4, default=0)
+    # Время последней сверки с Tinkoff API, None - позиция посчитана только по сделкам
+    reconciled_at = models.DateTimeField(verbose_name='Время сверки', null=True)
+
+    @property
+    def expected_percent_profit(self) -> 'decimal.Decimal':
+        """ Ожидаемый доход в процентах от стоимости позиции """
+        price = self.average_position_price * self.quantity
+        if not price:
+            return price
+        return self.expected_yield / price * 100
+
+    def __str__(self):
+        return f'{self.investment_account}::{self.instrument_id}: {self.quantity}'
+
+
+class PortfolioSnapshot(models.Model):
+    """ Портфель ИС из Tinkoff API на момент последней синхронизации """
+    class Meta:
+        verbose_name = 'Снимок портфеля'
+        verbose_name_plural = 'Снимки портфелей'
+
+    investment_account = models.OneToOneField(
+        InvestmentAccount, verbose_name='Инвестиционный счет', on_delete=models.CASCADE,
+        related_name='portfolio_snapshot'
+    )
+    # Позиции в формате Tinkoff API (payload.positions)
+    positions = JSONField(verbose_name='Позиции', default=list)
+    fetched_at = models.DateTimeField(verbose_name='Время получения')
+
+    def __str__(self):
+        return f'{self.investment_account} ({self.fetched_at})'
+
+
+class InvestmentAccountIncome(models.Model):
+    """ Доход ИС в одной валюте.
+        Обновляется при перерасчете дохода сделок (Deal.objects.update_income_summary),
+        комиссии уже учтены в доходе сделок и хранятся отдельно для отображения
+    """
+    class Meta:
+        verbose_name = 'Доход ИС'
+        verbose_name_plural = 'Доходы ИС'
+        ordering = ('currency', )
+        constraints = [
+            models.UniqueConstraint(fields=('investment_account', 'currency'), name='unique_investment_account_income')
+        ]
+
+    investment_account = models.ForeignKey(
+        InvestmentAccount, verbose_name='Инвестиционный счет', on_delete=models.CASCADE, related_name='income_set'
+    )
+    currency = models.ForeignKey(
+        'operations.Currency', verbose_name='Валюта', on_delete=models.PROTECT, related_name='+'
+    )
+    closed_deal_income = models.DecimalField(
+        verbose_name='Доход закрытых сделок', max_digits=20, decimal_places=4, default=0
+    )
+    opened_deal_income = models.DecimalField(
+        verbose_name='Реализованный доход открытых сделок', max_digits=20, decimal_places=4, default=0
+    )
+    dividend_income = models.DecimalField(verbose_name='Дивиденды', max_digits=20, decimal_places=4, default=0)
+    commission = models.DecimalField(verbose_name='Комиссии', max_digits=20, decimal_places=4, default=0)
+
+    @property
+    def total(self) -> 'decimal.Decimal':
+        return self.closed_deal_income + self.opened_deal_income + self.dividend_income
+
+    def __str__(self):
+        return f'{self.investment_account}::{self.currency}: {self.total}'
+
+
+class InvestmentAccountCapital(models.Model):
+    """ Общий капитал ИС в одной валюте, обновляется при синхронизации (InvestmentAccount.update_capital) """
+    class Meta:
+        verbose_name = 'Капитал ИС'
+        verbose_name_plural = 'Капиталы ИС'
+        ordering = ('currency', )
+        constraints = [
+            models.UniqueConstraint(fields=('investment_account', 'currency'), name='unique_investment_account_capital')
+        ]
+
+    investment_account = models.ForeignKey(
+        InvestmentAccount, verbose_name='Инвестиционный счет', on_delete=models.CASCADE, related_name='capital_set'
+    )
+    currency = models.ForeignKey(
+        'operations.Currency', verbose_name='Валюта', on_delete=models.PROTECT, related_name='+'
+    )
+    total_capital = models.DecimalField(verbose_name='Общий капитал', max_digits=20, decimal_places=4, default=0)
+
+    def __str__(self):
+        return f'{self.investment_account}::{self.currency}: {self.total_capital}'
+
+
 @receiver(post_save, sender=InvestmentAccount)
 def investment_account_post_save(**kwargs):
     if kwargs.get('created'):
@@ -273,19 +696,10 @@ def investment_account_post_save(**kwargs):
         creator.save(update_fields=('default_investment_account', ))
 
         # Создатель счета становится одним из совладельцев счета
-        co_owner = CoOwner.objects.create(investor=creator, investment_account=instance)
+        CoOwner.objects.create(investor=creator, investment_account=instance)
 
-        # Загружаем все операции из Тинькофф
-        instance.update_portfolio()
-        total_capital = instance.capital_info()
-        co_owner_capital = co_owner.capital.select_related('currency').all()
-        bulk_updates = []
-        for co_owner_capital_item in co_owner_capital:
-            iso_code = co_owner_capital_item.currency.iso_code
-            if iso_code in total_capital:
-                bulk_updates.append(co_owner_capital_item)
-                bulk_updates[-1].value = total_capital[iso_code]['total_capital']
-        Capital.objects.bulk_update(bulk_updates, fields=('value', ))
+        # Все операции из Тинькофф загружаются в фоне, после загрузки создателю назначается весь капитал
+        enqueue_import(instance)
 
 
 @receiver(post_save, sender=CoOwner)
@@ -299,13 +713,35 @@ def co_owner_post_save(**kwargs):
             for currency in Currency.objects.all()
         ]
         Capital.objects.bulk_create(bulk_create, ignore_conflicts=True)
+        if is_sparse_storage():
+            # Доли совладельца будут браться из default_share капитала
+            return
         operations = (
             Operation.objects
             .filter(proxy_instance_of=(PurchaseOperation, SaleOperation, DividendOperation))
-            .filter(investment_account=instance.investment_account).values_list('id', 'currency')
+            .filter(investment_account=instance.investment_account)
+            .order_by()
         )
-        bulk_create_shares = [
-            Share(operation_id=operation_id, co_owner=instance, value=default_share)
-            for operation_id, currency in operations
-        ]
-        Share.objects.bulk_create(bulk_create_shares, ignore_conflicts=True)
+        # Доли создаются на стороне БД через INSERT ... SELECT, без выгрузки операций в приложение.
+        # Для больших ИС вставка разбивается на диапазоны id операций
+        chunk_size = int(os.getenv('PROJECT_SHARE_FAN_OUT_CHUNK_SIZE', 0))
+        if chunk_size > 0:
+            id_range = operations.aggregate(min_id=Min('id'), max_id=Max('id'))
+            if id_range['min_id'] is None:
+                return
+            chunks = [
+                operations.filter(id__gte=start, id__lt=start + chunk_size)
+                for start in range(id_range['min_id'], id_range['max_id'] + 1, chunk_size)
+            ]
+        else:
+            chunks = [operations]
+        with transaction.atomic(), connection.cursor() as cursor:
+            for chunk in chunks:
+                select_sql, select_params = chunk.values('id').query.sql_with_params()
+                cursor.execute(
+                    f'INSERT INTO {Share._meta.db_table} (operation_id, co_owner_id, value) '
+                    f'SELECT operation.id, %s, %s FROM ({select_sql}) AS operation '
+                    f'ON CONFLICT DO NOTHING',
+                    [instance.pk, default_share, *select_params]
+                )
+        logger.info(f'Добавлены доли в операциях для {instance}')
@@ -0,0 +1,17 @@
+from django.db import models
+
+
+class BalanceEntryKinds(models.TextChoices):
+    ALLOCATION = 'Allocation', 'Изменение капитала'
+    DEAL_INCOME = 'DealIncome', 'Доход со сделки'
+    COMMISSION = 'Commission', 'Комиссия'
+    DIVIDEND = 'Dividend', 'Дивиденды'
+    # Доход со сделки до появления журнала, дивиденды и комиссии в нем не выделены
+    OPENING_DEAL_INCOME = 'OpeningIncome', 'Доход со сделки до ведения журнала'
+
+
+class ImportStatuses(models.TextChoices):
+    PENDING = 'Pending', 'Ожидает импорта'
+    RUNNING = 'Running', 'Импортируется'
+    DONE = 'Done', 'Импортирован'
+    FAILED = 'Failed', 'Ошибка импорта'
@@ -0,0 +1,131 @@
+""" Фоновое удаление ИС.
+    При удалении ИС только помечается (deleted_at) и пропадает из выдачи, а его данные удаляет
+    фоновый обработчик (manage.py worker): таблица за таблицей, диапазонами id по
+    PROJECT_ACCOUNT_DELETION_CHUNK_SIZE, каждый диапазон - в отдельной транзакции.
+    Так удаление ИС с миллионами операций не держит блокировки и не загружает объекты в память.
+    Прерванное удаление продолжается со следующего вызова - уже удаленные строки просто не находятся
+"""
+import logging
+import os
+from typing import List, Tuple
+
+from django.apps import apps
+from django.db import connection, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Таблица, по диапазонам id которой идет удаление, условие отбора ее строк,
+# запросы для каждого диапазона ({ids} - подзапрос id строк диапазона) и удалять ли сами строки
+T_STEP = Tuple[str, str, List[str], bool]
+
+
+def get_chunk_size() -> int:
+    return int(os.getenv('PROJECT_ACCOUNT_DELETION_CHUNK_SIZE', 10000))
+
+
+def mark_deleted(investment_account: 'users.InvestmentAccount') -> None:
+    """ Помечает ИС на удаление, у инвесторов он перестает быть ИС по умолчанию """
+    investment_account_model = apps.get_model('users', 'InvestmentAccount')
+    investor_model = apps.get_model('users', 'Investor')
+    with transaction.atomic():
+        investment_account_model.objects.filter(pk=investment_account.pk).update(deleted_at=timezone.now())
+        investor_model.objects.filter(default_investment_account=investment_account).update(
+            default_investment_account=None
+        )
+    logger.info(f'ИС {investment_account} помечен на удаление')
+
+
+def _get_steps() -> List[T_STEP]:
+    """ Шаги удаления данных ИС. Внешние ключи в PostgreSQL проверяются в конце транзакции,
+        поэтому после каждого диапазона не должно оставаться ссылок на удаленные строки:
+        сначала удаляются зависимые строки, потом те, на которые они ссылаются
+    """
+    def table(app_label: str, model_name: str) -> str:
+        return apps.get_model(app_label, model_name)._meta.db_table
+
+    in_investment_account = 'investment_account_id = %(investment_account_id)s'
+    of_co_owners = f'co_owner_id IN (SELECT id FROM {table("users", "CoOwner")} WHERE {in_investment_account})'
+    return [
+        # Журнал движения денег ссылается на сделки, и его может быть намного больше, чем совладельцев
+        (table('users', 'BalanceEntry'), of_co_owners, [], True),
+        # Сделки ссылаются на операции, а операции на сделки, поэтому сделки удаляются после операций
+        (table('market', 'Deal'), in_investment_account, [
+            f'UPDATE {table("market", "Deal")} SET last_processed_operation_id = NULL WHERE id IN ({{ids}})',
+            f'DELETE FROM {table("market", "DealIncomeSnapshot")} WHERE deal_id IN ({{ids}})',
+            f'DELETE FROM {table("market", "DealIncome")} WHERE deal_id IN ({{ids}})',
+            f'DELETE FROM {table("market", "DealLots")} WHERE deal_id IN ({{ids}})'
+        ], False),
+        (table('operations', 'Operation'), in_investment_account, [
+            f'DELETE FROM {table("operations", "Share")} WHERE operation_id IN ({{ids}})',
+            f'DELETE FROM {table("operations", "Transaction")} WHERE operation_id IN ({{ids}})'
+        ], True),
+        (table('market', 'Deal'), in_investment_account, [], True),
+        (table('users', 'CoOwner'), in_investment_account, [
+            f'DELETE FROM {table("users", "Capital")} WHERE co_owner_id IN ({{ids}})',
+            f'DELETE FROM {table("users", "ShareSchedule")} WHERE co_owner_id IN ({{ids}})'
+        ], True),
+        (table('users', 'CurrencyAsset'), in_investment_account, [], True),
+        (table('market', 'CurrencyRate'), in_investment_account, [], True),
+        (table('users', 'Holding'), in_investment_account, [], True),
+        (table('users', 'PortfolioSnapshot'), in_investment_account, [], True),
+        (table('users', 'InvestmentAccountIncome'), in_investment_account, [], True),
+        (table('users', 'InvestmentAccountCapital'), in_investment_account, [], True)
+    ]
+
+
+def purge(investment_account_id: int, chunk_size: int = None) -> int:
+    """ Удаляет данные помеченного на удаление ИС и сам ИС
+    :param chunk_size: размер диапазона id, по умолчанию - PROJECT_ACCOUNT_DELETION_CHUNK_SIZE
+    :return: количество удаленных строк
+    """
+    investment_account_model = apps.get_model('users', 'InvestmentAccount')
+    investor_model = apps.get_model('users', 'Investor')
+    chunk_size = chunk_size or get_chunk_size()
+    params = {'investment_account_id': investment_account_id}
+    deleted = 0
+    with connection.cursor() as cursor:
+        for range_table, condition, queries, delete_rows in _get_steps():
+            cursor.execute(f'SELECT MIN(id), MAX(id) FROM {range_table} WHERE {condition}', params)
+            min_id, max_id = cursor.fetchone()
+            if min_id is None:
+                continue
+            ids = f'SELECT id FROM {range_table} WHERE {condition} AND id >= %(start)s AND id < %(end)s'
+            if delete_rows:
+                queries = queries + [f'DELETE FROM {range_table} WHERE id IN ({{ids}})']
+            for start in range(min_id, max_id + 1, chunk_size):
+                with transaction.atomic():
+                    for query in queries:
+                        cursor.execute(query.format(ids=ids), {**params, 'start': start, 'end': start + chunk_size})
+                        if query.startswith('DELETE'):
+                            deleted += cursor.rowcount
+        with transaction.atomic():
+            # ИС мог быть выбран по умолчанию параллельным запросом во время пометки на удаление
+            cursor.execute(
+                f'UPDATE {investor_model._meta.db_table} SET default_investment_account_id = NULL '
+                f'WHERE default_investment_account_id = %(investment_account_id)s', params
+            )
+            cursor.execute(
+                f'DELETE FROM {investment_account_model._meta.db_table} '
+                f'WHERE id = %(investment_account_id)s AND deleted_at IS NOT NULL', params
+            )
+            deleted += cursor.rowcount
+    logger.info(f'ИС {investment_account_id} удален, удалено строк: {deleted}')
+    return deleted
+
+
+def process_queue(batch_size: int = 1) -> int:
+    """ Удаление ИС, помеченных на удаление, используется фоновым обработчиком
+    :param batch_size: максимальное количество ИС за один вызов
+    :return: количество удаленных ИС
+    """
+    investment_account_model = apps.get_model('users', 'InvestmentAccount')
+    investment_account_ids = list(
+        investment_account_model.all_objects
+        .filter(deleted_at__isnull=False)
+        .order_by('deleted_at')
+        .values_list('pk', flat=True)[:batch_size]
+    )
+    for investment_account_id in investment_account_ids:
+        purge(investment_account_id)
+    return len(investment_account_ids)
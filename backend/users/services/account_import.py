@@ -0,0 +1,180 @@
+""" Импорт истории нового ИС.
+    После создания ИС получает статус Pending, полную синхронизацию с Tinkoff API и
+    начальный капитал создателя выполняет фоновый обработчик (manage.py worker),
+    запрос на создание ИС не ждет импорта.
+    Если PROJECT_ACCOUNT_IMPORT_MODE=request, импорт выполняется сразу при создании ИС.
+    Во время импорта обработчик держит advisory-блокировку ИС и обновляет import_heartbeat_at,
+    импорт без отметки дольше PROJECT_ACCOUNT_IMPORT_STALE_TIMEOUT минут, блокировку которого
+    никто не держит, считается прерванным и забирается заново
+"""
+import contextlib
+import datetime
+import logging
+import os
+from typing import Iterator
+
+from django.apps import apps
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Импорт при создании ИС
+MODE_REQUEST = 'request'
+# Импорт фоновым обработчиком (manage.py worker)
+MODE_WORKER = 'worker'
+
+# Первый ключ advisory-блокировки импорта (второй - id ИС). Блокировка уровня сессии держится
+# всё время импорта, даже если этап идет дольше таймаута, и снимается вместе с соединением упавшего обработчика
+IMPORT_LOCK_KEY = 1049
+
+
+def get_mode() -> str:
+    mode = os.getenv('PROJECT_ACCOUNT_IMPORT_MODE', MODE_WORKER)
+    if mode not in (MODE_REQUEST, MODE_WORKER):
+        raise ValueError(f'Неизвестный режим импорта ИС: {mode}')
+    return mode
+
+
+def get_stale_timeout() -> datetime.timedelta:
+    return datetime.timedelta(minutes=float(os.getenv('PROJECT_ACCOUNT_IMPORT_STALE_TIMEOUT', 60)))
+
+
+def get_claimable_q() -> Q:
+    """ ИС, импорт которых можно забрать: в очереди или прерванные """
+    statuses = apps.get_model('users', 'InvestmentAccount').ImportStatuses
+    return Q(import_status=statuses.PENDING) | Q(
+        import_status=statuses.RUNNING, import_heartbeat_at__lt=timezone.now() - get_stale_timeout()
+    )
+
+
+def is_stale(investment_account: 'users.InvestmentAccount') -> bool:
+    """ Импорт ИС прерван: статус Running, обработчик давно не отмечался и не держит блокировку ИС """
+    return (
+        investment_account.import_status == investment_account.ImportStatuses.RUNNING and
+        investment_account.import_heartbeat_at is not None and
+        investment_account.import_heartbeat_at < timezone.now() - get_stale_timeout() and
+        not is_locked(investment_account.pk)
+    )
+
+
+@contextlib.contextmanager
+def import_lock(investment_account_id: int) -> Iterator[bool]:
+    """ Пытается взять advisory-блокировку импорта ИС, не дожидаясь ее
+    :return: взята ли блокировка (если нет - ИС импортирует другой обработчик)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [IMPORT_LOCK_KEY, investment_account_id])
+        is_locked_now, = cursor.fetchone()
+    try:
+        yield is_locked_now
+    finally:
+        if is_locked_now:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [IMPORT_LOCK_KEY, investment_account_id])
+
+
+def is_locked(investment_account_id: int) -> bool:
+    """ Держит ли какой-нибудь обработчик блокировку импорта ИС """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_locks WHERE locktype = 'advisory' "
+            "AND classid = %s AND objid = %s AND objsubid = 2 AND granted)",
+            [IMPORT_LOCK_KEY, investment_account_id]
+        )
+        return cursor.fetchone()[0]
+
+
+def enqueue_import(investment_account: 'users.InvestmentAccount') -> None:
+    """ Ставит ИС в очередь на импорт (или импортирует сразу в режиме request) """
+    investment_account_model = apps.get_model('users', 'InvestmentAccount')
+    investment_account_model.objects.filter(pk=investment_account.pk).update(
+        import_status=investment_account_model.ImportStatuses.PENDING,
+        import_stage='', import_progress=0, import_error=''
+    )
+    if get_mode() == MODE_REQUEST:
+        run_import(investment_account)
+    else:
+        logger.info(f'ИС {investment_account} поставлен в очередь на импорт')
+
+
+def run_import(investment_account: 'users.InvestmentAccount') -> bool:
+    """ Загружает всю историю ИС и назначает создателю весь капитал.
+        Этап и процент выполнения сохраняются в ИС по ходу импорта.
+        Если история уже загружена (повторный импорт после ошибки), синхронизация может быть
+        пропущена как недавняя, начальный капитал назначается в любом случае
+    :return: завершился ли импорт успешно
+    """
+    with import_lock(investment_account.pk) as is_locked_now:
+        if not is_locked_now:
+            logger.info(f'ИС {investment_account} уже импортирует другой обработчик')
+            return False
+        return _run_import(investment_account)
+
+
+def _run_import(investment_account: 'users.InvestmentAccount') -> bool:
+    """ Импорт ИС, блокировка которого уже взята """
+    investment_account_model = apps.get_model('users', 'InvestmentAccount')
+    statuses = investment_account_model.ImportStatuses
+    investment_account_queryset = investment_account_model.objects.filter(pk=investment_account.pk)
+
+    def on_progress(stage: str, progress: int) -> None:
+        logger.info(f'Импорт ИС {investment_account}: {stage} ({progress}%)')
+        investment_account_queryset.update(
+            import_stage=stage, import_progress=progress, import_heartbeat_at=timezone.now()
+        )
+
+    investment_account_queryset.update(import_status=statuses.RUNNING, import_heartbeat_at=timezone.now())
+    try:
+        is_updated = investment_account.update_portfolio(on_progress=on_progress)
+        if not is_updated:
+            # Недавняя синхронизация пропускается. Если sync_version уже увеличен,
+            # история была загружена предыдущей попыткой, которая упала позже
+            investment_account.refresh_from_db(fields=('sync_at', 'sync_version'))
+            is_updated = investment_account.sync_version > 0
+        if is_updated:
+            on_progress('Начальный капитал', 100)
+            investment_account.initialize_capital()
+    except Exception as e:
+        logger.exception(f'Импорт ИС {investment_account} не удался')
+        investment_account_queryset.update(import_status=statuses.FAILED, import_error=str(e))
+        return False
+    if not is_updated:
+        # Причина (невалидный токен, недоступность Tinkoff API) уже записана в лог update_portfolio
+        investment_account_queryset.update(
+            import_status=statuses.FAILED, import_error='Не удалось загрузить операции из Tinkoff API'
+        )
+        return False
+    investment_account_queryset.update(import_status=statuses.DONE, import_stage='', import_progress=100)
+    logger.info(f'Импорт ИС {investment_account} завершен')
+    return True
+
+
+def process_queue(batch_size: int = 10) -> int:
+    """ Импорт ИС, поставленных в очередь, и прерванных импортов, используется фоновым обработчиком
+    :param batch_size: максимальное количество ИС за один вызов
+    :return: количество успешно импортированных ИС
+    """
+    investment_account_model = apps.get_model('users', 'InvestmentAccount')
+    statuses = investment_account_model.ImportStatuses
+    investment_account_ids = list(
+        investment_account_model.objects
+        .filter(get_claimable_q())
+        .order_by('pk')
+        .values_list('pk', flat=True)[:batch_size]
+    )
+    processed = 0
+    for investment_account_id in investment_account_ids:
+        with import_lock(investment_account_id) as is_locked_now:
+            # Блокировку держит обработчик, импорт которого еще идет
+            if not is_locked_now:
+                continue
+            # ИС забирает тот обработчик, который первым сменил статус или отметку прерванного импорта
+            taken = investment_account_model.objects.filter(get_claimable_q(), pk=investment_account_id).update(
+                import_status=statuses.RUNNING, import_heartbeat_at=timezone.now()
+            )
+            if not taken:
+                continue
+            processed += _run_import(investment_account_model.objects.get(pk=investment_account_id))
+    return processed
@@ -0,0 +1,79 @@
+""" Снимки портфеля Tinkoff API.
+    Портфель запрашивается только при синхронизации ИС и сохраняется в PortfolioSnapshot.
+    В памяти процесса снимок хранится проиндексированным по figi и перечитывается из базы,
+    только когда меняется версия синхронизации ИС (InvestmentAccount.sync_version)
+"""
+import collections
+import datetime
+import logging
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from django.apps import apps
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Сколько портфелей хранить в памяти процесса, дольше всего не запрашивавшиеся вытесняются
+MAX_CACHED_PORTFOLIOS = 1000
+
+# Ключ - id ИС, порядок - от давно запрошенных к недавно запрошенным
+_portfolios: 'collections.OrderedDict[int, Portfolio]' = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+class Portfolio:
+    """ Позиции портфеля, проиндексированные по figi """
+    def __init__(self, positions: List[dict], fetched_at: Optional[datetime.datetime], sync_version: int):
+        self.positions: Dict[str, dict] = {position['figi']: position for position in positions}
+        self.fetched_at = fetched_at
+        self.sync_version = sync_version
+
+    def get(self, figi: str, default=None) -> Optional[dict]:
+        return self.positions.get(figi, default)
+
+    def __getitem__(self, figi: str) -> dict:
+        return self.positions[figi]
+
+    def __contains__(self, figi: str) -> bool:
+        return figi in self.positions
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self.positions.values())
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+
+def get_portfolio(investment_account: 'users.InvestmentAccount') -> Portfolio:
+    """ Портфель ИС на момент последней синхронизации.
+        Из базы читается один раз на каждую версию синхронизации
+    """
+    with _lock:
+        portfolio = _portfolios.get(investment_account.pk)
+        if portfolio is not None:
+            _portfolios.move_to_end(investment_account.pk)
+    if portfolio is not None and portfolio.sync_version == investment_account.sync_version:
+        return portfolio
+    snapshot_model = apps.get_model('users', 'PortfolioSnapshot')
+    snapshot = snapshot_model.objects.filter(investment_account=investment_account).first()
+    if snapshot is None:
+        portfolio = Portfolio([], None, investment_account.sync_version)
+    else:
+        portfolio = Portfolio(snapshot.positions, snapshot.fetched_at, investment_account.sync_version)
+    with _lock:
+        _portfolios[investment_account.pk] = portfolio
+        _portfolios.move_to_end(investment_account.pk)
+        while len(_portfolios) > MAX_CACHED_PORTFOLIOS:
+            _portfolios.popitem(last=False)
+    return portfolio
+
+
+def save_portfolio(investment_account_id: int, positions: List[dict]) -> None:
+    """ Сохраняет портфель, полученный при синхронизации ИС """
+    snapshot_model = apps.get_model('users', 'PortfolioSnapshot')
+    snapshot_model.objects.update_or_create(
+        investment_account_id=investment_account_id,
+        defaults={'positions': positions, 'fetched_at': timezone.now()}
+    )
+    logger.info(f'Портфель ИС {investment_account_id} сохранен, позиций: {len(positions)}')
@@ -4,18 +4,27 @@
 """
 import collections
 import datetime as dt
+import decimal
 import logging
 from typing import Optional, List, Dict
 
 import dateutil.parser
+import requests
 from django.apps import apps
-from django.db.models import Min
+from django.db.transaction import atomic
+from django.db.models import Q, Sum, Min, Max
+from django.utils import timezone
 
 from core.utils import is_proxy_instance
 from market.models import CurrencyInstrument, InstrumentType, StockInstrument, Deal
+from market.models_constraints import LotAccountingMethods
+from market.services.currency_rates import get_quote_currency, save_candle_rates, update_rates_from_trades
+from market.services.shares import ShareResolver, is_sparse_storage
 from operations.models import Operation, SaleOperation, DividendOperation, \
     Transaction, PurchaseOperation, Share
 from tinkoff_api import TinkoffProfile
+from users.services.portfolio import save_portfolio
+from tinkoff_api.exceptions import UnknownError
 
 logger = logging.getLogger(__name__)
 
@@ -204,7 +213,9 @@ class Updater:
         # Словарь операций, которым принадлежат транзакции
         # Ключ - id в БД, значение id в Tinkoff API
         operation_by_tinkoff_api_operation_id = dict(
-            Operation.objects.filter(_id__in=self.transactions).values_list('_id', 'id')
+            Operation.objects
+            .filter(investment_account_id=self.investment_account_id, _id__in=self.transactions)
+            .values_list('_id', 'id')
         )
         bulk_create_transactions = []
         for operation_id, transactions in self.transactions.items():
@@ -242,6 +253,8 @@ class Updater:
                     dividend_obj.dividend_tax = operation['payment']
                     dividend_obj.dividend_tax_date = operation_date
                     dividend_obj.save(update_fields=('dividend_tax', 'dividend_tax_date'))
+                    # Дивиденды уже могли быть учтены в доходе сделки
+                    Deal.objects.filter(pk=dividend_obj.deal_id).reset_income_state()
                 self.operations.remove(operation)
         logger.info('Вторичные операции добавлены')
         if self.operations:
@@ -259,7 +272,6 @@ class Updater:
 
     def update_deals(self) -> None:
         """ Обновление сделок """
-        investment_account_model = apps.get_model('users', 'InvestmentAccount')
         logger.info('Обновление сделок')
         operations = (
             Operation.objects
@@ -268,52 +280,160 @@ class Updater:
             .order_by('date')
         )
 
-        # Сделки, у которых надо пересчитать доход
-        recalculation_income_deals = set()
-        # Список всех совладельцев счета
-        co_owners = (
-            investment_account_model(id=self.investment_account_id).co_owners
-            .prefetch_related('capital').all()
-        )
-        logger.info(f'Список совладельцев: {co_owners}')
+        # Доли по умолчанию всех совладельцев счета
+        share_resolver = ShareResolver(self.investment_account_id)
+        # В разреженном режиме доли по умолчанию не сохраняются
+        is_sparse_shares = is_sparse_storage()
         bulk_create_share = []
+        # Сделки, в которые добавлены операции, ключ - id сделки.
+        # Состояние сделок (количество, открыта/закрыта) меняется в памяти и сохраняется в конце
+        deals: Dict[int, Deal] = {}
+        # Ключ - id сделки, значение - id добавленных в нее операций
+        deal_operations: Dict[int, List[int]] = collections.defaultdict(list)
+        # Открытые сделки, ключ - figi
+        opened_deals: Dict[str, Deal] = {}
         for operation in operations:
             logger.info(f'Операция: {operation}')
             # Добавление долей для операций
-            for co_owner in co_owners:
-                logger.info(f'Добавление доли операции для {co_owner}')
-                default_share = co_owner.capital.get(currency=operation.currency).default_share
-                bulk_create_share.append(
-                    Share(operation=operation, co_owner_id=co_owner.pk, value=default_share)
-                )
+            if not is_sparse_shares:
+                for co_owner, default_share in share_resolver.get_default_shares(operation).items():
+                    logger.info(f'Добавление доли операции для {co_owner}')
+                    bulk_create_share.append(
+                        Share(operation=operation, co_owner_id=co_owner.pk, value=default_share)
+                    )
             if is_proxy_instance(operation, (PurchaseOperation, SaleOperation)):
-                deal, created = (
-                    Deal.objects.opened()
-                    .get_or_create(instrument=operation.instrument,
-                                   investment_account_id=self.investment_account_id)
-                )
-                if created:
-                    logger.info('Сделка создана')
+                deal = opened_deals.get(operation.instrument_id)
+                if deal is None:
+                    # Сделки, закрытые в этом обновлении, в базе еще отмечены открытыми
+                    closed_deal_ids = [pk for pk, d in deals.items() if d.is_closed]
+                    deal, created = (
+                        Deal.objects.opened().exclude(pk__in=closed_deal_ids)
+                        .get_or_create(instrument_id=operation.instrument_id,
+                                       investment_account_id=self.investment_account_id)
+                    )
+                    if created:
+                        logger.info('Сделка создана')
+                    else:
+                        logger.info('Сделка существовала')
+                    deal = deals.setdefault(deal.pk, deal)
+                deal.apply_operation(operation)
+                if deal.is_closed:
+                    opened_deals.pop(operation.instrument_id, None)
                 else:
-                    logger.info('Сделка существовала')
-                deal.operations.add(operation)
-                recalculation_income_deals.add(deal)
+                    opened_deals[operation.instrument_id] = deal
             elif is_proxy_instance(operation, DividendOperation):
-                deal = (
-                    Deal.objects
-                    .filter(instrument=operation.instrument, investment_account_id=self.investment_account_id)
-                    .annotate(opened_date=Min('operations__date'))
-                    .filter(opened_date__lte=operation.date)
-                    .latest('opened_date')
-                )
-                deal.operations.add(operation)
-                recalculation_income_deals.add(deal)
+                deal = self._get_dividend_deal(operation, deals)
+                if deal is None:
+                    logger.warning(f'Не найдена сделка для дивидендов {operation}')
+                    continue
+                deal.apply_operation(operation)
+            else:
+                continue
+            deals[deal.pk] = deal
+            deal_operations[deal.pk].append(operation.pk)
         Share.objects.bulk_create(bulk_create_share, ignore_conflicts=True)
-        for deal in recalculation_income_deals:
+        for deal_id, operation_ids in deal_operations.items():
+            Operation.objects.filter(pk__in=operation_ids).update(deal_id=deal_id)
+        Deal.objects.bulk_update(deals.values(), fields=Deal.STATE_FIELDS)
+        for deal in deals.values():
             logger.info(f'Пересчет прибыли у {deal}')
             deal.recalculation_income()
         logger.info('Обновление сделок завершено')
 
+    def _get_dividend_deal(self, operation: DividendOperation, deals: Dict[int, Deal]) -> Optional[Deal]:
+        """ Последняя сделка по инструменту, открытая не позже получения дивидендов.
+            Учитываются сделки, которые еще не сохранены (deals)
+        """
+        candidates = [
+            deal for deal in deals.values()
+            if deal.instrument_id == operation.instrument_id and deal.opened_at <= operation.date
+        ]
+        deal = (
+            Deal.objects
+            .filter(instrument_id=operation.instrument_id, investment_account_id=self.investment_account_id,
+                    opened_at__lte=operation.date)
+            .exclude(pk__in=deals)
+            .order_by('-opened_at')
+            .first()
+        )
+        if deal is not None:
+            candidates.append(deal)
+        return max(candidates, key=lambda d: d.opened_at, default=None)
+
+    def update_holdings(self) -> None:
+        """ Обновление позиций портфеля.
+            Позиции считаются по открытым сделкам ИС и сверяются с портфелем Tinkoff API,
+            при расхождении приоритет у данных брокера
+        """
+        logger.info('Обновление позиций портфеля')
+        holding_model = apps.get_model('users', 'Holding')
+        average = Q(lots__method=LotAccountingMethods.AVERAGE)
+        opened_deals = (
+            Deal.objects.opened()
+            .filter(investment_account_id=self.investment_account_id)
+            .annotate(
+                open_quantity=Sum('lots__open_quantity', filter=average),
+                cost_basis=Sum('lots__cost_basis', filter=average)
+            )
+            .select_related('instrument')
+        )
+        # Ключ - figi
+        holdings: Dict[str, 'users.Holding'] = {}
+        for deal in opened_deals:
+            quantity = deal.bought_quantity - deal.sold_quantity
+            holdings[deal.instrument_id] = holding_model(
+                investment_account_id=self.investment_account_id, instrument_id=deal.instrument_id,
+                currency_id=deal.instrument.currency_id, quantity=quantity,
+                lots=quantity // deal.instrument.lot,
+                average_position_price=deal.cost_basis / deal.open_quantity if deal.open_quantity else 0
+            )
+
+        try:
+            positions = self.tinkoff_profile.portfolio()['payload']['positions']
+        except (UnknownError, requests.exceptions.ConnectionError):
+            logger.warning('Не удалось получить портфель, позиции посчитаны только по сделкам')
+        else:
+            save_portfolio(self.investment_account_id, positions)
+            holdings = self._reconcile_holdings(holdings, positions)
+        with atomic():
+            holding_model.objects.filter(investment_account_id=self.investment_account_id).delete()
+            holding_model.objects.bulk_create(holdings.values())
+        logger.info('Обновление позиций портфеля завершено')
+
+    def _reconcile_holdings(self, holdings: Dict[str, 'users.Holding'],
+                            positions: List[dict]) -> Dict[str, 'users.Holding']:
+        """ Сверка позиций, посчитанных по сделкам, с позициями портфеля Tinkoff API """
+        holding_model = apps.get_model('users', 'Holding')
+        currency_by_figi = dict(
+            InstrumentType.objects.filter(figi__in=[p['figi'] for p in positions]).values_list('figi', 'currency')
+        )
+        now = timezone.now()
+        reconciled_holdings = {}
+        for position in positions:
+            figi = position['figi']
+            if figi not in currency_by_figi:
+                logger.warning(f'Неизвестная ценная бумага в портфеле: {figi}')
+                continue
+            quantity = decimal.Decimal(str(position['balance']))
+            local_holding = holdings.get(figi)
+            if local_holding is None:
+                logger.warning(f'Позиции {figi} нет среди открытых сделок')
+            elif local_holding.quantity != quantity:
+                logger.warning(f'Количество {figi} по сделкам ({local_holding.quantity}) '
+                               f'не совпадает с портфелем ({quantity})')
+            average_position_price = decimal.Decimal(str(position.get('averagePositionPrice', {}).get('value', 0)))
+            expected_yield = decimal.Decimal(str(position.get('expectedYield', {}).get('value', 0)))
+            reconciled_holdings[figi] = holding_model(
+                investment_account_id=self.investment_account_id, instrument_id=figi,
+                currency_id=currency_by_figi[figi], quantity=quantity, lots=position['lots'],
+                average_position_price=average_position_price, expected_yield=expected_yield,
+                last_price=average_position_price + expected_yield / quantity if quantity else None,
+                reconciled_at=now
+            )
+        for figi in holdings.keys() - reconciled_holdings.keys():
+            logger.warning(f'Позиция {figi} открыта по сделкам, но отсутствует в портфеле')
+        return reconciled_holdings
+
     def update_currency_assets(self):
         """ Обновление валютных активов портфеля """
         logger.info('Обновление валютных активов')
@@ -337,3 +457,56 @@ class Updater:
                 obj.value = currency['balance']
                 obj.save(update_fields=['value'])
         logger.info('Обновление валютных активов завершено')
+
+    def update_currency_rates(self) -> None:
+        """ Обновление курсов валют по дневным свечам валютных инструментов.
+            Свечи запрашиваются с первой операции ИС до первого сохраненного курса по свечам
+            и с последнего сохраненного курса по свечам до текущего момента,
+            курсы на даты без свечей берутся из сделок ИС с валютными инструментами
+        """
+        logger.info('Обновление курсов валют')
+        currency_rate_model = apps.get_model('market', 'CurrencyRate')
+        first_operation_date = (
+            Operation.objects
+            .filter(investment_account_id=self.investment_account_id)
+            .aggregate(date=Min('date'))['date']
+        ) or self.from_datetime
+        first_operation_date = first_operation_date.astimezone(self.timezone)
+        currency_instruments = CurrencyInstrument.objects.filter(
+            base_currency__isnull=False, currency_id=get_quote_currency()
+        )
+        for currency_instrument in currency_instruments:
+            rate_dates = (
+                currency_rate_model.objects
+                .filter(currency_id=currency_instrument.base_currency_id, quote_currency=currency_instrument.currency,
+                        source=currency_rate_model.Sources.CANDLE)
+                .aggregate(first=Min('date'), last=Max('date'))
+            )
+            if rate_dates['first'] is None:
+                periods = [(first_operation_date, self.to_datetime)]
+            else:
+                first_rate_datetime = dt.datetime.combine(rate_dates['first'], dt.time(), self.timezone)
+                last_rate_datetime = dt.datetime.combine(rate_dates['last'], dt.time(), self.timezone)
+                periods = [
+                    (first_operation_date, first_rate_datetime),
+                    (max(first_operation_date, last_rate_datetime), self.to_datetime)
+                ]
+            for from_datetime, period_end in periods:
+                self._update_candle_rates(currency_instrument, from_datetime, period_end)
+        update_rates_from_trades(self.investment_account_id)
+        logger.info('Обновление курсов валют завершено')
+
+    def _update_candle_rates(self, currency_instrument: CurrencyInstrument, from_datetime, to_datetime) -> None:
+        """ Сохраняет курсы по дневным свечам валютного инструмента за период """
+        # Дневные свечи отдаются не больше чем за год
+        while from_datetime < to_datetime:
+            period_end = min(from_datetime + dt.timedelta(days=365), to_datetime)
+            try:
+                candles = self.tinkoff_profile.market_candles(
+                    currency_instrument.figi, from_datetime, period_end
+                )['payload']['candles']
+            except (UnknownError, requests.exceptions.ConnectionError):
+                logger.warning(f'Не удалось получить свечи {currency_instrument}')
+                break
+            save_candle_rates(currency_instrument, candles)
+            from_datetime = period_end
@@ -1,9 +1,9 @@
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView as SuperLoginView, LogoutView as SuperLogoutView
-from django.db.models import Sum, F, Q
 from django.urls import reverse
 from django.views.generic import FormView, TemplateView, ListView
 
+from market.services.currency_rates import get_quote_currency
 from market.views import UpdateInvestmentAccountMixin
 from users.forms import SignupForm, LoginForm
 from users.models import InvestmentAccount, CoOwner
@@ -61,9 +61,7 @@ class InvestmentAccountSettings(LoginRequiredMixin, UpdateInvestmentAccountMixin
             return (
                 self.investment_account.co_owners
                 .with_is_creator_annotations()
-                .annotate(
-                    limit=F('capital') +
-                    Sum('deal_income_set__value', filter=Q(investment_account=self.investment_account)))
+                .prefetch_related('capital__currency')
                 .order_by('-is_creator', 'investor__username')
             )
         return CoOwner.objects.none()
@@ -73,4 +71,6 @@ class InvestmentAccountSettings(LoginRequiredMixin, UpdateInvestmentAccountMixin
         # FIXME: сделать для всех валют
         if self.investment_account:
             context['capital_info'] = self.request.user.default_investment_account.capital_info()
+            context['rate_currency'] = get_quote_currency()
+            context['converted_total_capital'] = self.investment_account.total_capital_in(context['rate_currency'])
         return context